@@ -1,6 +1,7 @@
 from vector import Vector
 from materials import create_standard_materials
 from lighting import PointLight, DirectionalLight
+from ray import CheckerMaterial
 from scene_utils import create_rotated_shape
 
 def setup_scene(raster):
@@ -12,29 +13,11 @@ def setup_scene(raster):
     # Create materials
     materials = create_standard_materials()
     
-    # Add checkerboard floor
+    # Add checkerboard floor: one plane facing up whose material alternates per square
     floor_y = 0
     checker_size = 100
-    checker_count = 6
-    
-    # Add checkerboard floor
-    for row in range(-checker_count, checker_count):
-        for col in range(-checker_count, checker_count):
-            # Skip some squares that are far from center for better performance
-            if abs(row) > 8 and abs(col) > 8:
-                continue
-                
-            is_white = (row + col) % 2 == 0
-            material = materials['metal_black'] if is_white else materials['metal_white']
-            
-            x1 = col * checker_size
-            x2 = (col + 1) * checker_size
-            z1 = row * checker_size
-            z2 = (row + 1) * checker_size
-            
-            # Create the checkerboard triangles
-            raster.add_triangle(Vector(x1, floor_y, z1), Vector(x2, floor_y, z2), Vector(x2, floor_y, z1), material)
-            raster.add_triangle(Vector(x1, floor_y, z1), Vector(x1, floor_y, z2), Vector(x2, floor_y, z2), material)
+    raster.add_plane(Vector(0, floor_y, 0), Vector(0, 1, 0),
+                     CheckerMaterial(materials['metal_black'], materials['metal_white'], checker_size))
     
     # Yellow sphere (right front)
     raster.add_sphere(Vector(-160, 90, 10), 80, materials['yellow'])
@@ -77,8 +60,8 @@ def setup_scene(raster):
     cylinder_center = Vector(500, 150, 220)
     radius = 100
     height = 300
-    segments = 100  # Higher number means smoother cylinder
-    raster.add_cylinder(cylinder_center, radius, height, segments, materials['chrome'])
+    segments = 100  # Only used by the triangle version; the analytic cylinder is exactly round
+    raster.add_cylinder(cylinder_center, radius, height, segments, materials['chrome'], analytic=True)
 
     # Clear default lights
     raster.clear_lights()
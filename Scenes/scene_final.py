@@ -29,7 +29,7 @@ def setup_scene(renderer):
     green_metal = Material((50, 200, 100), reflectivity=0.6)
     gold = Material((255, 215, 0), reflectivity=0.7)
     
-    # Create the room walls using triangles
+    # Create the room walls as analytic quads
     half_width = room_width / 2
     half_height = room_height / 2
     half_depth = room_depth / 2
@@ -46,25 +46,21 @@ def setup_scene(renderer):
     cl_tr = Vector(half_width, -half_height, half_depth)
     cl_tl = Vector(-half_width, -half_height, half_depth)
     
-    # Add floor triangles
-    renderer.add_triangle(fl_bl, fl_br, fl_tr, materials['white'])
-    renderer.add_triangle(fl_bl, fl_tr, fl_tl, materials['white'])
+    # Each quad is a corner and its two edges; their order sets the lit side like a triangle's winding
+    # Floor
+    renderer.add_quad(fl_bl, fl_br - fl_bl, fl_tl - fl_bl, materials['white'])
     
-    # Add ceiling triangles
-    renderer.add_triangle(cl_bl, cl_tr, cl_br, materials['white'])
-    renderer.add_triangle(cl_bl, cl_tl, cl_tr, materials['white'])
+    # Ceiling
+    renderer.add_quad(cl_bl, cl_tl - cl_bl, cl_br - cl_bl, materials['white'])
     
     # Back wall
-    renderer.add_triangle(fl_tl, fl_tr, cl_tr, materials['white'])
-    renderer.add_triangle(fl_tl, cl_tr, cl_tl, materials['white'])
+    renderer.add_quad(fl_tl, fl_tr - fl_tl, cl_tl - fl_tl, materials['white'])
     
     # Left wall
-    renderer.add_triangle(fl_bl, fl_tl, cl_tl, materials['white'])
-    renderer.add_triangle(fl_bl, cl_tl, cl_bl, materials['white'])
+    renderer.add_quad(fl_bl, fl_tl - fl_bl, cl_bl - fl_bl, materials['white'])
     
     # Right wall
-    renderer.add_triangle(fl_br, cl_br, cl_tr, materials['white'])
-    renderer.add_triangle(fl_br, cl_tr, fl_tr, materials['white'])
+    renderer.add_quad(fl_br, cl_br - fl_br, fl_tr - fl_br, materials['white'])
     
     # Add lights that are positioned entirely within the scene
     # Main central light
@@ -1,39 +1,26 @@
+import math
 from vector import Vector
 from materials import create_standard_materials
 from lighting import DirectionalLight
-from scene_utils import create_rotated_shape
+from ray import CheckerMaterial
+from scene_utils import create_rotated_shape, rotate_vertex
+
+# Objects moved by update_frame, filled in by setup_scene
+animated = {}
 
 def setup_scene(raster):
     # Create materials
     materials = create_standard_materials()
 
-    # Add checkerboard floor
+    # Add checkerboard floor: one plane facing up whose material alternates per square
     floor_y = -100
     checker_size = 500
-    checker_count = 2
-    
-    # Add checkerboard floor
-    for row in range(-checker_count, checker_count):
-        for col in range(-checker_count, checker_count):
-            # Skip some squares that are far from center for better performance
-            if abs(row) > 8 and abs(col) > 8:
-                continue
-                
-            is_white = (row + col) % 2 == 0
-            material = materials['black'] if is_white else materials['white']
-            
-            x1 = col * checker_size
-            x2 = (col + 1) * checker_size
-            z1 = row * checker_size
-            z2 = (row + 1) * checker_size
-            
-            
-            # Add reverse-facing triangles
-            raster.add_triangle(Vector(x1, floor_y, z1), Vector(x2, floor_y, z2), Vector(x2, floor_y, z1), material)
-            raster.add_triangle(Vector(x1, floor_y, z1), Vector(x1, floor_y, z2), Vector(x2, floor_y, z2), material)
+    raster.add_plane(Vector(0, floor_y, 0), Vector(0, 1, 0),
+                     CheckerMaterial(materials['black'], materials['white'], checker_size))
     
     # Create a large red sphere
     raster.add_sphere(Vector(0, 0, 200), 200, materials['red'])
+    animated['sphere'] = raster.objects[-1]
     
     # Add a rotated cube in the middle of the scene    
     cube_center = Vector(-120, 100, 50)
@@ -64,4 +51,11 @@ def setup_scene(raster):
         position=Vector(0, 200, -600),  # Higher and further back for better view
         look_at=Vector(0, 0, 200),      # Looking at the center of the large sphere
         fov=45                          # Narrower field of view for less distortion
-    )
\ No newline at end of file
+    )
+
+def update_frame(raster, frame, frame_count):
+    # The big sphere bounces once while the camera swings half way around it
+    phase = frame / frame_count
+    animated['sphere'].center = Vector(0, 150 * abs(math.sin(math.pi * phase)), 200)
+    position = rotate_vertex(Vector(0, 200, -600), Vector(0, 0, 200), (0, 180 * phase, 0))
+    raster.set_camera(position=position, look_at=Vector(0, 0, 200), fov=45)
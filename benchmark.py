@@ -0,0 +1,337 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import platform
+import contextlib
+import importlib.util
+import multiprocessing
+import numpy as np
+from vector import Vector
+from ray import Material
+from lighting import PointLight, DirectionalLight
+from renderer import Renderer
+from tiles import make_tiles
+from wavefront import WavefrontTracer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SEED = 1234
+WIDTH = 160
+HEIGHT = 120
+DEFAULT_THRESHOLD = 0.1
+SCENE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Scenes")
+
+
+def scene_file_setup(name):
+    path = os.path.join(SCENE_DIR, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.setup_scene
+
+
+def stress_lights(raster):
+    raster.clear_lights()
+    raster.add_light(DirectionalLight(direction=Vector(0.3, -1, 0.4).normalize(), intensity=0.6))
+    raster.add_light(PointLight(Vector(-400, 600, -300), intensity=0.4))
+    raster.set_camera(position=Vector(0, 250, -700), look_at=Vector(0, 0, 0), fov=50)
+
+
+def setup_spheres(raster, count=400):
+    # Small matte and mirror spheres scattered over a floor
+    rng = random.Random(SEED)
+    matte = Material((200, 80, 60))
+    mirror = Material((230, 230, 230), reflectivity=0.6)
+    raster.add_plane(Vector(0, -60, 0), Vector(0, 1, 0), Material((180, 180, 180)))
+    for i in range(count):
+        center = Vector(rng.uniform(-500, 500), rng.uniform(-50, 250), rng.uniform(-200, 800))
+        raster.add_sphere(center, rng.uniform(8, 25), mirror if i % 5 == 0 else matte)
+    stress_lights(raster)
+
+
+def setup_triangles(raster, grid=40):
+    # A rolling height field of 2 * grid * grid loose triangles
+    material = Material((90, 170, 90))
+    size = 1200.0 / grid
+
+    def corner(i, j):
+        x, z = -600 + i * size, -300 + j * size
+        return Vector(x, 40 * math.sin(x / 90) * math.cos(z / 120) - 40, z)
+
+    for i in range(grid):
+        for j in range(grid):
+            a, b, c, d = corner(i, j), corner(i + 1, j), corner(i + 1, j + 1), corner(i, j + 1)
+            raster.add_triangle(a, c, b, material)
+            raster.add_triangle(a, d, c, material)
+    stress_lights(raster)
+
+
+def setup_lights(raster, count=48):
+    # A few objects lit by a ring of point lights, so shading is dominated by shadow rays
+    raster.add_plane(Vector(0, -60, 0), Vector(0, 1, 0), Material((200, 200, 200)))
+    raster.add_sphere(Vector(-150, 40, 200), 100, Material((220, 60, 60)))
+    raster.add_sphere(Vector(150, 40, 200), 100, Material((60, 60, 220), reflectivity=0.3))
+    raster.add_box(Vector(-60, -60, -40), Vector(60, 60, 80), Material((240, 220, 80)), rotation=(0, 30, 0))
+    stress_lights(raster)
+    raster.clear_lights()
+    for i in range(count):
+        angle = 2 * math.pi * i / count
+        raster.add_light(PointLight(Vector(700 * math.cos(angle), 300 + 100 * (i % 3), 200 + 700 * math.sin(angle)),
+                                    intensity=1.0 / count))
+
+
+def setup_glass(raster, count=6, depth=5):
+    # Glass panes stacked in front of colored spheres: every pixel refracts through them and
+    # each surface splits the ray in two, so the ray tree fills up to max_depth
+    raster.max_depth = depth
+    glass = Material((255, 255, 255), reflectivity=0.05, transparency=0.95, refractive_index=1.3)
+    raster.add_plane(Vector(0, -120, 0), Vector(0, 1, 0), Material((180, 180, 180)))
+    for i in range(count):
+        z = -250 + i * 40
+        raster.add_box(Vector(-320, -120, z), Vector(320, 220, z + 12), glass)
+    for i, color in enumerate(((220, 60, 60), (60, 200, 60), (60, 60, 220))):
+        raster.add_sphere(Vector(-220 + 220 * i, 0, 300), 90, Material(color, reflectivity=0.2))
+    stress_lights(raster)
+
+
+CASES = {
+    'test_scene': lambda raster: scene_file_setup('test_scene')(raster),
+    'scene_1': lambda raster: scene_file_setup('scene_1')(raster),
+    'scene_text': lambda raster: scene_file_setup('scene_text')(raster),
+    'scene_final': lambda raster: scene_file_setup('scene_final')(raster),
+    'spheres': setup_spheres,
+    'triangles': setup_triangles,
+    'lights': setup_lights,
+    'glass': setup_glass,
+}
+
+
+# Counts the rays one renderer traces in this process; shadow rays count once per light
+# and point, however many transparent surfaces they cross
+class RayCounter:
+    def __init__(self):
+        self.rays = 0
+        self.shadowing = False
+
+    def install(self, raster):
+        if raster.backend == "wavefront":
+            scene = raster.wavefront_scene
+            intersect = scene.intersect
+            shadow_transmittance = WavefrontTracer.shadow_transmittance
+
+            def counted_intersect(origins, directions, max_distance):
+                if not self.shadowing:
+                    self.rays += len(origins)
+                return intersect(origins, directions, max_distance)
+
+            def counted_shadow_transmittance(tracer, origins, directions, max_distance):
+                self.rays += len(origins)
+                self.shadowing = True
+                try:
+                    return shadow_transmittance(tracer, origins, directions, max_distance)
+                finally:
+                    self.shadowing = False
+
+            scene.intersect = counted_intersect
+            WavefrontTracer.shadow_transmittance = counted_shadow_transmittance
+            return
+
+        cast_ray = raster.cast_ray
+        transmittance = raster.transmittance
+
+        def counted_cast_ray(*args):
+            self.rays += 1
+            return cast_ray(*args)
+
+        def counted_transmittance(*args):
+            self.rays += 1
+            return transmittance(*args)
+
+        raster.cast_ray = counted_cast_ray
+        raster.transmittance = counted_transmittance
+
+
+def peak_memory():
+    # Peak resident size of this process in MiB; ru_maxrss is in KiB on Linux, bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_case(name, backend, width, height):
+    # Tiles are rendered one after another without a pool so that the seeded random streams,
+    # and with them the image, are the same on every run
+    random.seed(SEED)
+    np.random.seed(SEED)
+    raster = Renderer(width, height)
+    raster.backend = backend
+    counter = RayCounter()
+    digest = hashlib.sha256()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        CASES[name](raster)
+        setup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        raster.prepare_render(verbose=False)
+        build_time = time.perf_counter() - start
+
+        counter.install(raster)
+        random.seed(SEED)
+        np.random.seed(SEED)
+        start = time.perf_counter()
+        for tile in make_tiles(width, height, raster.tile_size, "scanline"):
+            digest.update(raster.compute_tile(tile)[4])
+        render_time = time.perf_counter() - start
+
+    primary_rays = width * height * raster.samples_per_pixel
+    return {
+        'setup_seconds': setup_time,
+        'build_seconds': build_time,
+        'render_seconds': render_time,
+        'primary_rays': primary_rays,
+        'total_rays': counter.rays,
+        'primary_rays_per_second': primary_rays / render_time,
+        'rays_per_second': counter.rays / render_time,
+        'peak_memory_mib': peak_memory(),
+        'image_sha256': digest.hexdigest(),
+    }
+
+
+def measure(name, backend, width, height, repeat):
+    # Every run gets a fresh process, so peak memory and module state belong to that case
+    # alone; the fastest of repeat runs is kept
+    context = multiprocessing.get_context("spawn")
+    best = None
+    for _ in range(repeat):
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (name, backend, width, height))
+        if best is None or result['render_seconds'] < best['render_seconds']:
+            best = result
+    return best
+
+
+def compare(results, baseline, threshold):
+    # A case regresses below (1 - threshold) times the baseline's rays per second; a changed
+    # image hash is only reported
+    regressions = []
+    if (baseline.get('backend'), baseline.get('width'), baseline.get('height')) != \
+            (results['backend'], results['width'], results['height']):
+        print("Warning: the baseline was measured with a different backend or resolution")
+    for name, case in results['cases'].items():
+        old = baseline.get('cases', {}).get(name)
+        if old is None or 'error' in old or 'error' in case:
+            continue
+        change = case['rays_per_second'] / old['rays_per_second'] - 1.0
+        note = ""
+        if change < -threshold:
+            regressions.append(name)
+            note = "  REGRESSION"
+        if case['image_sha256'] != old['image_sha256']:
+            note += "  (image changed)"
+        print(f"  {name:<12} {old['rays_per_second']:>10.0f} -> {case['rays_per_second']:>10.0f} rays/s  {change:+7.1%}{note}")
+    return regressions
+
+
+def run_benchmarks(names, backend="recursive", width=WIDTH, height=HEIGHT, repeat=1, output_file="benchmark.json",
+                   baseline_file=None, threshold=DEFAULT_THRESHOLD):
+    results = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'backend': backend,
+        'width': width,
+        'height': height,
+        'seed': SEED,
+        'cases': {},
+    }
+
+    print(f"Benchmarking {len(names)} cases at {width}x{height} with the {backend} backend")
+    for name in names:
+        try:
+            case = measure(name, backend, width, height, repeat)
+        except Exception as e:
+            print(f"  {name:<12} failed: {e}")
+            results['cases'][name] = {'error': str(e)}
+            continue
+        results['cases'][name] = case
+        memory = f"{case['peak_memory_mib']:.0f} MiB" if case['peak_memory_mib'] is not None else "n/a"
+        print(f"  {name:<12} setup {case['setup_seconds']:6.2f}s  build {case['build_seconds']:6.2f}s  "
+              f"render {case['render_seconds']:7.2f}s  {case['primary_rays_per_second']:9.0f} primary/s  "
+              f"{case['rays_per_second']:9.0f} rays/s  peak {memory}")
+
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_file}")
+
+    if baseline_file is None:
+        return []
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline_file} (threshold {threshold:.0%}):")
+    regressions = compare(results, baseline, threshold)
+    if regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+    return regressions
+
+
+if __name__ == "__main__":
+    if '-h' in sys.argv or '--help' in sys.argv:
+        print("Benchmark Usage:")
+        print("  python benchmark.py [case ...] [options]")
+        print("\nCases (default: all):")
+        print("  " + ", ".join(CASES))
+        print("\nOptions:")
+        print("  --backend NAME       Rendering backend: recursive or wavefront (default: recursive)")
+        print(f"  --size W H           Image size of every case (default: {WIDTH} {HEIGHT})")
+        print("  --repeat N           Render every case N times and keep the fastest run (default: 1)")
+        print("  --output FILE        Where to write the JSON results (default: benchmark.json)")
+        print("  --baseline FILE      Compare with an earlier results file; exits with status 1 on a regression")
+        print(f"  --threshold X        Allowed drop in rays per second before a case counts as regressed (default: {DEFAULT_THRESHOLD})")
+        print("\nExamples:")
+        print("  python benchmark.py --output baseline.json")
+        print("  python benchmark.py --baseline baseline.json")
+        print("  python benchmark.py glass lights --backend wavefront --repeat 3")
+        sys.exit(0)
+
+    args = sys.argv[1:]
+    options = {}
+    names = []
+    i = 0
+    while i < len(args):
+        if args[i] == '--size' and i + 2 < len(args):
+            options['size'] = (int(args[i + 1]), int(args[i + 2]))
+            i += 3
+        elif args[i].startswith('--') and i + 1 < len(args):
+            options[args[i]] = args[i + 1]
+            i += 2
+        else:
+            names.append(args[i])
+            i += 1
+
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        print(f"Unknown cases: {', '.join(unknown)}; choose from {', '.join(CASES)}")
+        sys.exit(1)
+
+    width, height = options.get('size', (WIDTH, HEIGHT))
+    backend = options.get('--backend', "recursive")
+    if backend not in ('recursive', 'wavefront'):
+        print(f"Unknown backend: {backend}")
+        sys.exit(1)
+
+    regressions = run_benchmarks(names or list(CASES), backend, width, height, max(1, int(options.get('--repeat', 1))),
+                                 options.get('--output', "benchmark.json"), options.get('--baseline'),
+                                 float(options.get('--threshold', DEFAULT_THRESHOLD)))
+    sys.exit(1 if regressions else 0)
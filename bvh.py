@@ -0,0 +1,434 @@
+import math
+from ray import Ray, EnhancedTriangle, EnhancedQuad
+
+INF = float("inf")
+
+
+def _surface_area(bounds):
+    dx = bounds[3] - bounds[0]
+    dy = bounds[4] - bounds[1]
+    dz = bounds[5] - bounds[2]
+    if dx < 0 or dy < 0 or dz < 0:
+        return 0.0
+    return 2.0 * (dx * dy + dy * dz + dz * dx)
+
+
+def _union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]),
+            max(a[3], b[3]), max(a[4], b[4]), max(a[5], b[5]))
+
+
+EMPTY_BOUNDS = (INF, INF, INF, -INF, -INF, -INF)
+
+
+def build_nodes(prim_bounds, max_leaf_size=4, bin_count=12):
+    # Binned SAH build over (min_x, min_y, min_z, max_x, max_y, max_z) boxes.
+    # Nodes are [bounds, left, right, start, count, axis]; leaves have count > 0
+    # and cover order[start:start + count].
+    order = list(range(len(prim_bounds)))
+    centroids = [((b[0] + b[3]) * 0.5, (b[1] + b[4]) * 0.5, (b[2] + b[5]) * 0.5) for b in prim_bounds]
+    nodes = []
+
+    if not order:
+        return nodes, order
+
+    nodes.append([None, -1, -1, 0, len(order), 0])
+    stack = [0]
+
+    while stack:
+        node_index = stack.pop()
+        node = nodes[node_index]
+        start, count = node[3], node[4]
+
+        bounds = EMPTY_BOUNDS
+        c_min = [INF, INF, INF]
+        c_max = [-INF, -INF, -INF]
+        for i in range(start, start + count):
+            prim = order[i]
+            bounds = _union(bounds, prim_bounds[prim])
+            c = centroids[prim]
+            for axis in range(3):
+                if c[axis] < c_min[axis]:
+                    c_min[axis] = c[axis]
+                if c[axis] > c_max[axis]:
+                    c_max[axis] = c[axis]
+        node[0] = bounds
+
+        if count <= max_leaf_size:
+            continue
+
+        best_cost = INF
+        best_axis = -1
+        best_split = 0
+        for axis in range(3):
+            extent = c_max[axis] - c_min[axis]
+            if extent <= 0:
+                continue
+            scale = bin_count / extent
+            bin_bounds = [EMPTY_BOUNDS] * bin_count
+            bin_counts = [0] * bin_count
+            for i in range(start, start + count):
+                prim = order[i]
+                b = min(bin_count - 1, int((centroids[prim][axis] - c_min[axis]) * scale))
+                bin_counts[b] += 1
+                bin_bounds[b] = _union(bin_bounds[b], prim_bounds[prim])
+
+            left_area = [0.0] * bin_count
+            left_count = [0] * bin_count
+            acc_bounds = EMPTY_BOUNDS
+            acc_count = 0
+            for b in range(bin_count - 1):
+                acc_bounds = _union(acc_bounds, bin_bounds[b])
+                acc_count += bin_counts[b]
+                left_area[b] = _surface_area(acc_bounds)
+                left_count[b] = acc_count
+
+            acc_bounds = EMPTY_BOUNDS
+            acc_count = 0
+            for b in range(bin_count - 1, 0, -1):
+                acc_bounds = _union(acc_bounds, bin_bounds[b])
+                acc_count += bin_counts[b]
+                if left_count[b - 1] == 0 or acc_count == 0:
+                    continue
+                cost = left_area[b - 1] * left_count[b - 1] + _surface_area(acc_bounds) * acc_count
+                if cost < best_cost:
+                    best_cost = cost
+                    best_axis = axis
+                    best_split = b
+
+        parent_area = _surface_area(bounds)
+        if best_axis >= 0 and parent_area > 0:
+            best_cost = 0.125 + best_cost / parent_area
+
+        if best_axis < 0:
+            if count <= max_leaf_size * 8:
+                continue
+            # Degenerate centroids: fall back to an even split so leaves stay small
+            mid = start + count // 2
+            node[5] = 0
+        else:
+            if best_cost >= count and count <= max_leaf_size * 8:
+                continue
+            extent = c_max[best_axis] - c_min[best_axis]
+            scale = bin_count / extent
+            lo, hi = start, start + count - 1
+            while lo <= hi:
+                b = min(bin_count - 1, int((centroids[order[lo]][best_axis] - c_min[best_axis]) * scale))
+                if b < best_split:
+                    lo += 1
+                else:
+                    order[lo], order[hi] = order[hi], order[lo]
+                    hi -= 1
+            mid = lo
+            node[5] = best_axis
+
+        left_index = len(nodes)
+        nodes.append([None, -1, -1, start, mid - start, 0])
+        nodes.append([None, -1, -1, mid, start + count - mid, 0])
+        node[1] = left_index
+        node[2] = left_index + 1
+        node[4] = 0
+        stack.append(left_index)
+        stack.append(left_index + 1)
+
+    return nodes, order
+
+
+def ray_inverse(ray_direction):
+    return (1.0 / ray_direction.x if ray_direction.x != 0 else math.copysign(1e300, ray_direction.x),
+            1.0 / ray_direction.y if ray_direction.y != 0 else math.copysign(1e300, ray_direction.y),
+            1.0 / ray_direction.z if ray_direction.z != 0 else math.copysign(1e300, ray_direction.z))
+
+
+def box_entry(bounds, ox, oy, oz, ix, iy, iz, limit):
+    if ix >= 0:
+        t0 = (bounds[0] - ox) * ix
+        t1 = (bounds[3] - ox) * ix
+    else:
+        t0 = (bounds[3] - ox) * ix
+        t1 = (bounds[0] - ox) * ix
+    if iy >= 0:
+        ty0 = (bounds[1] - oy) * iy
+        ty1 = (bounds[4] - oy) * iy
+    else:
+        ty0 = (bounds[4] - oy) * iy
+        ty1 = (bounds[1] - oy) * iy
+    if ty0 > t0:
+        t0 = ty0
+    if ty1 < t1:
+        t1 = ty1
+    if iz >= 0:
+        tz0 = (bounds[2] - oz) * iz
+        tz1 = (bounds[5] - oz) * iz
+    else:
+        tz0 = (bounds[5] - oz) * iz
+        tz1 = (bounds[2] - oz) * iz
+    if tz0 > t0:
+        t0 = tz0
+    if tz1 < t1:
+        t1 = tz1
+    if t0 < 0:
+        t0 = 0.0
+    if t1 > limit:
+        t1 = limit
+    if t0 <= t1:
+        return t0
+    return None
+
+
+def triangle_distance(row, ox, oy, oz, dx, dy, dz):
+    # EnhancedTriangle.intersects on precomputed (v0, edge1, edge2) floats, same arithmetic
+    v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z = row
+    hx = dy * e2z - dz * e2y
+    hy = dz * e2x - dx * e2z
+    hz = dx * e2y - dy * e2x
+    a = e1x * hx + e1y * hy + e1z * hz
+    if -0.0000001 < a < 0.0000001:
+        return None
+    f = 1.0 / a
+    sx, sy, sz = ox - v0x, oy - v0y, oz - v0z
+    u = f * (sx * hx + sy * hy + sz * hz)
+    if u < 0.0 or u > 1.0:
+        return None
+    qx = sy * e1z - sz * e1y
+    qy = sz * e1x - sx * e1z
+    qz = sx * e1y - sy * e1x
+    v = f * (dx * qx + dy * qy + dz * qz)
+    if v < 0.0 or u + v > 1.0:
+        return None
+    t = f * (e2x * qx + e2y * qy + e2z * qz)
+    if t > 0.0000001:
+        return t
+    return None
+
+
+def triangle_row(triangle):
+    v0, v1, v2 = triangle.v0, triangle.v1, triangle.v2
+    return (v0.x, v0.y, v0.z, v1.x - v0.x, v1.y - v0.y, v1.z - v0.z, v2.x - v0.x, v2.y - v0.y, v2.z - v0.z)
+
+
+def quad_distance(row, ox, oy, oz, dx, dy, dz):
+    # EnhancedQuad.intersects on (corner, edge1, edge2) floats: triangle_distance without the u + v limit
+    cx, cy, cz, e1x, e1y, e1z, e2x, e2y, e2z = row
+    hx = dy * e2z - dz * e2y
+    hy = dz * e2x - dx * e2z
+    hz = dx * e2y - dy * e2x
+    a = e1x * hx + e1y * hy + e1z * hz
+    if -0.0000001 < a < 0.0000001:
+        return None
+    f = 1.0 / a
+    sx, sy, sz = ox - cx, oy - cy, oz - cz
+    u = f * (sx * hx + sy * hy + sz * hz)
+    if u < 0.0 or u > 1.0:
+        return None
+    qx = sy * e1z - sz * e1y
+    qy = sz * e1x - sx * e1z
+    qz = sx * e1y - sy * e1x
+    v = f * (dx * qx + dy * qy + dz * qz)
+    if v < 0.0 or v > 1.0:
+        return None
+    t = f * (e2x * qx + e2y * qy + e2z * qz)
+    if t > 0.0000001:
+        return t
+    return None
+
+
+def quad_row(quad):
+    c, e1, e2 = quad.corner, quad.edge1, quad.edge2
+    return (c.x, c.y, c.z, e1.x, e1.y, e1.z, e2.x, e2.y, e2.z)
+
+
+def shadow_test(obj):
+    # Shadow rays test loose triangles and quads on precomputed floats instead of Vectors
+    if type(obj) is EnhancedTriangle:
+        return triangle_distance, triangle_row(obj)
+    if type(obj) is EnhancedQuad:
+        return quad_distance, quad_row(obj)
+    return None
+
+
+class BVH:
+    def __init__(self, objects, max_leaf_size=4, bin_count=12):
+        self.objects = list(objects)
+        self.max_leaf_size = max_leaf_size
+        self.bin_count = bin_count
+        # A RayStats instance while the renderer collects statistics
+        self.stats = None
+        self.build()
+
+    @staticmethod
+    def object_bounds(obj):
+        lo, hi = obj.get_bounds()
+        pad = 1e-6 * max(1.0, hi.x - lo.x, hi.y - lo.y, hi.z - lo.z,
+                         abs(lo.x), abs(lo.y), abs(lo.z), abs(hi.x), abs(hi.y), abs(hi.z))
+        return (lo.x - pad, lo.y - pad, lo.z - pad, hi.x + pad, hi.y + pad, hi.z + pad)
+
+    def build(self):
+        # Objects that cannot report finite bounds are tested on every ray
+        self.unbounded = []
+        bounded = []
+        prim_bounds = []
+        for index, obj in enumerate(self.objects):
+            item = (index, obj, hasattr(obj, 'cast'))
+            bounds = self.object_bounds(obj) if hasattr(obj, 'get_bounds') else None
+            if bounds is None or not all(math.isfinite(v) for v in bounds):
+                self.unbounded.append(item)
+            else:
+                bounded.append(item)
+                prim_bounds.append(bounds)
+
+        self.nodes, order = build_nodes(prim_bounds, self.max_leaf_size, self.bin_count)
+        self.leaf_items = [bounded[i] for i in order]
+        # Shadow rays only need to know how much light each leaf object lets through
+        self.leaf_transparency = [Ray.transparency_of(obj) for _, obj, _ in self.leaf_items]
+        self.leaf_tests = [shadow_test(obj) for _, obj, _ in self.leaf_items]
+        self.unbounded_names = [type(obj).__name__ for _, obj, _ in self.unbounded]
+        self.leaf_names = [type(obj).__name__ for _, obj, _ in self.leaf_items]
+
+    def refit(self, objects):
+        # Keeps the tree from the last build and recomputes its bounds bottom-up for objects that
+        # have moved. Returns False when the objects no longer line up with the tree.
+        objects = list(objects)
+        if len(objects) != len(self.objects) or any(type(a) is not type(b) for a, b in zip(objects, self.objects)):
+            return False
+
+        self.unbounded = [(index, objects[index], aggregate) for index, _, aggregate in self.unbounded]
+        self.leaf_items = [(index, objects[index], aggregate) for index, _, aggregate in self.leaf_items]
+        prim_bounds = [self.object_bounds(obj) for _, obj, _ in self.leaf_items]
+        if not all(math.isfinite(v) for bounds in prim_bounds for v in bounds):
+            return False
+
+        # Children are always stored after their parent
+        nodes = self.nodes
+        for node in reversed(nodes):
+            if node[4]:
+                bounds = EMPTY_BOUNDS
+                for i in range(node[3], node[3] + node[4]):
+                    bounds = _union(bounds, prim_bounds[i])
+                node[0] = bounds
+            else:
+                node[0] = _union(nodes[node[1]][0], nodes[node[2]][0])
+
+        self.objects = objects
+        self.leaf_transparency = [Ray.transparency_of(obj) for _, obj, _ in self.leaf_items]
+        self.leaf_tests = [shadow_test(obj) for _, obj, _ in self.leaf_items]
+        return True
+
+    def cast_ray(self, ray_origin, ray_direction, max_distance=INF, ignore_object=None):
+        closest_t = INF
+        closest_obj = None
+        closest_index = -1
+        stats = self.stats
+        if stats is not None:
+            stats.count_tests(self.unbounded_names)
+
+        for index, obj, aggregate in self.unbounded:
+            if obj == ignore_object:
+                continue
+            if aggregate:
+                obj, t = obj.cast(ray_origin, ray_direction, max_distance)
+                if obj is None:
+                    continue
+            else:
+                t = obj.intersects(ray_origin, ray_direction)
+            if t and t < closest_t and t < max_distance:
+                closest_t = t
+                closest_obj = obj
+                closest_index = index
+
+        if not self.nodes:
+            return closest_obj, closest_t
+
+        nodes = self.nodes
+        leaf_items = self.leaf_items
+        ox, oy, oz = ray_origin.x, ray_origin.y, ray_origin.z
+        ix, iy, iz = ray_inverse(ray_direction)
+        negative = (ix < 0, iy < 0, iz < 0)
+
+        stack = [0]
+        while stack:
+            node = nodes[stack.pop()]
+            limit = closest_t if closest_t < max_distance else max_distance
+            if box_entry(node[0], ox, oy, oz, ix, iy, iz, limit) is None:
+                continue
+
+            count = node[4]
+            if count:
+                start = node[3]
+                if stats is not None:
+                    stats.count_tests(self.leaf_names[start:start + count])
+                for i in range(start, start + count):
+                    index, obj, aggregate = leaf_items[i]
+                    if obj == ignore_object:
+                        continue
+                    if aggregate:
+                        obj, t = obj.cast(ray_origin, ray_direction, max_distance if index < closest_index else limit)
+                        if obj is None:
+                            continue
+                    else:
+                        t = obj.intersects(ray_origin, ray_direction)
+                    # Ties resolve to the earlier object, exactly like the linear scan
+                    if t and t < max_distance and (t < closest_t or (t == closest_t and index < closest_index)):
+                        closest_t = t
+                        closest_obj = obj
+                        closest_index = index
+            elif negative[node[5]]:
+                stack.append(node[1])
+                stack.append(node[2])
+            else:
+                stack.append(node[2])
+                stack.append(node[1])
+
+        return closest_obj, closest_t
+
+    def transmittance(self, ray_origin, ray_direction, max_distance=INF):
+        # Any-hit query: the first opaque hit ends the walk, transparent ones are gathered in one pass
+        hits = []
+        stats = self.stats
+        if stats is not None:
+            stats.count_tests(self.unbounded_names)
+        for _, obj, _ in self.unbounded:
+            if not Ray.collect_occlusion(obj, ray_origin, ray_direction, max_distance, hits):
+                return 0.0
+
+        if not self.nodes:
+            return Ray.combine_transmittance(hits)
+
+        nodes = self.nodes
+        leaf_items = self.leaf_items
+        leaf_transparency = self.leaf_transparency
+        leaf_tests = self.leaf_tests
+        ox, oy, oz = ray_origin.x, ray_origin.y, ray_origin.z
+        dx, dy, dz = ray_direction.x, ray_direction.y, ray_direction.z
+        ix, iy, iz = ray_inverse(ray_direction)
+        negative = (ix < 0, iy < 0, iz < 0)
+
+        stack = [0]
+        while stack:
+            node = nodes[stack.pop()]
+            if box_entry(node[0], ox, oy, oz, ix, iy, iz, max_distance) is None:
+                continue
+
+            count = node[4]
+            if count:
+                start = node[3]
+                if stats is not None:
+                    stats.count_tests(self.leaf_names[start:start + count])
+                for i in range(start, start + count):
+                    test = leaf_tests[i]
+                    if test is not None:
+                        t = test[0](test[1], ox, oy, oz, dx, dy, dz)
+                        if t and t < max_distance:
+                            if leaf_transparency[i] <= 0:
+                                return 0.0
+                            hits.append((t, leaf_transparency[i]))
+                    elif not Ray.collect_occlusion(leaf_items[i][1], ray_origin, ray_direction, max_distance, hits):
+                        return 0.0
+            elif negative[node[5]]:
+                stack.append(node[1])
+                stack.append(node[2])
+            else:
+                stack.append(node[2])
+                stack.append(node[1])
+
+        return Ray.combine_transmittance(hits)
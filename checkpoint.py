@@ -0,0 +1,106 @@
+import os
+import time
+import pickle
+import struct
+import hashlib
+from shared_scene import flatten_objects, RENDERER_SKIPPED
+
+MAGIC = b"RTCHECKPOINT1\n"
+# Settings that change how the work is scheduled but not a single output pixel
+IGNORED_SETTINGS = RENDERER_SKIPPED + ('tile_order', 'scene_distribution', 'use_bvh', 'progressive', 'preview_interval',
+                                       'checkpoint', 'resume', 'checkpoint_interval', 'collect_stats', 'cost_heatmap',
+                                       'tile_stats', 'serve_address',
+                                       'serve_timeout')
+
+
+def scene_key(renderer, mode, ignored=()):
+    layout, arrays, materials = flatten_objects(renderer.objects)
+    digest = hashlib.sha256()
+    for name in sorted(arrays):
+        digest.update(name.encode())
+        digest.update(arrays[name].tobytes())
+    settings = {key: value for key, value in sorted(renderer.__dict__.items()) if key not in IGNORED_SETTINGS and key not in ignored}
+    digest.update(pickle.dumps((mode, layout, materials, settings), protocol=4))
+    return digest.hexdigest()
+
+
+class RenderCheckpoint:
+    def __init__(self, path, key, interval=10.0):
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.completed = {}
+        self.stale = False
+        self.file = None
+        self.last_sync = time.time()
+
+    def load(self):
+        # Records are appended as they finish; a record cut short by a kill is simply dropped
+        self.completed = {}
+        self.stale = False
+        if not os.path.exists(self.path):
+            return self.completed
+
+        with open(self.path, "rb") as f:
+            header = f.readline()
+            if header != MAGIC or f.readline().strip().decode("ascii", "replace") != self.key:
+                self.stale = True
+                return self.completed
+            while True:
+                raw = f.read(2)
+                if len(raw) < 2:
+                    break
+                count = struct.unpack("<H", raw)[0]
+                raw = f.read(4 * count + 4)
+                if len(raw) < 4 * count + 4:
+                    break
+                task = struct.unpack(f"<{count}i", raw[:4 * count])
+                size = struct.unpack("<I", raw[4 * count:])[0]
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                self.completed[task] = data
+        return self.completed
+
+    def open(self, resume=False):
+        if resume:
+            self.load()
+        else:
+            self.completed = {}
+
+        self.file = open(self.path, "wb")
+        self.file.write(MAGIC)
+        self.file.write(self.key.encode("ascii") + b"\n")
+        # Rewrite what was kept so a truncated tail from the last run does not linger
+        for task, data in self.completed.items():
+            self.write_record(task, data)
+        self.sync()
+
+    def write_record(self, task, data):
+        self.file.write(struct.pack("<H", len(task)))
+        self.file.write(struct.pack(f"<{len(task)}i", *task))
+        self.file.write(struct.pack("<I", len(data)))
+        self.file.write(data)
+
+    def add(self, task, data):
+        self.completed[task] = data
+        self.write_record(task, data)
+        self.file.flush()
+        if time.time() - self.last_sync >= self.interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
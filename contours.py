@@ -0,0 +1,186 @@
+import numpy as np
+
+# Marching squares: cell corners are numbered 0 top-left, 1 top-right, 2 bottom-right,
+# 3 bottom-left and a set bit i means corner i is inside. Each case lists the pairs of cell
+# edges (0 top, 1 right, 2 bottom, 3 left) its contour segments join; the two saddle cases
+# are resolved separately from the value at the cell center.
+SEGMENTS = {
+    1: ((3, 0),), 2: ((0, 1),), 3: ((3, 1),), 4: ((1, 2),), 6: ((0, 2),), 7: ((2, 3),),
+    8: ((2, 3),), 9: ((0, 2),), 11: ((1, 2),), 12: ((3, 1),), 13: ((0, 1),), 14: ((3, 0),),
+}
+SADDLES = {
+    (5, True): ((0, 1), (2, 3)), (5, False): ((3, 0), (1, 2)),
+    (10, True): ((3, 0), (1, 2)), (10, False): ((0, 1), (2, 3)),
+}
+
+
+def trace_contours(values, threshold):
+    # Closed outlines of values > threshold as (u, v) loops in pixel units, v downwards;
+    # crossings are interpolated so antialiased edges give smooth outlines
+    f = np.pad(np.asarray(values, dtype=np.float64), 1)
+    inside = f > threshold
+    cases = (inside[:-1, :-1] * 1 + inside[:-1, 1:] * 2 + inside[1:, 1:] * 4 + inside[1:, :-1] * 8)
+    columns = f.shape[1]
+
+    def crossing(edge):
+        r, c = divmod(edge // 2, columns)
+        r2, c2 = (r, c + 1) if edge % 2 == 0 else (r + 1, c)
+        a, b = f[r, c], f[r2, c2]
+        t = (threshold - a) / (b - a)
+        # Sample (c, r) of the padded array is the center of pixel (c - 1, r - 1)
+        return c + (c2 - c) * t - 0.5, r + (r2 - r) * t - 0.5
+
+    neighbours = {}
+    for r, c in zip(*np.nonzero((cases != 0) & (cases != 15))):
+        r, c = int(r), int(c)
+        case = int(cases[r, c])
+        edges = (2 * (r * columns + c), 2 * (r * columns + c + 1) + 1,
+                 2 * ((r + 1) * columns + c), 2 * (r * columns + c) + 1)
+        if case in (5, 10):
+            center = (f[r, c] + f[r, c + 1] + f[r + 1, c + 1] + f[r + 1, c]) / 4 > threshold
+            segments = SADDLES[(case, bool(center))]
+        else:
+            segments = SEGMENTS[case]
+        for a, b in segments:
+            neighbours.setdefault(edges[a], []).append(edges[b])
+            neighbours.setdefault(edges[b], []).append(edges[a])
+
+    loops = []
+    visited = set()
+    for start in neighbours:
+        if start in visited:
+            continue
+        loop = [start]
+        visited.add(start)
+        previous, current = start, neighbours[start][0]
+        while current != start:
+            loop.append(current)
+            visited.add(current)
+            a, b = neighbours[current]
+            previous, current = current, (b if a == previous else a)
+        loops.append([crossing(edge) for edge in loop])
+    return loops
+
+
+def signed_area(points):
+    x, y = np.asarray(points, dtype=np.float64).T
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+
+def simplify_loop(points, tolerance):
+    # Douglas-Peucker on a closed loop, split at the first point and the point farthest from it
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) <= 4:
+        return points
+    far = int(np.argmax(((points - points[0]) ** 2).sum(axis=1)))
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[far] = True
+    closed = np.vstack((points, points[:1]))
+    stack = [(0, far), (far, len(points))]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        p, q = closed[a], closed[b]
+        between = closed[a + 1:b]
+        dx, dy = q - p
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distance = np.hypot(*(between - p).T)
+        else:
+            distance = np.abs(dx * (between[:, 1] - p[1]) - dy * (between[:, 0] - p[0])) / length
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            keep[a + 1 + i] = True
+            stack.append((a, a + 1 + i))
+            stack.append((a + 1 + i, b))
+    return points[keep]
+
+
+def contains(loop, point):
+    x, y = point
+    inside = False
+    for (x0, y0), (x1, y1) in zip(loop, loop[1:] + loop[:1]):
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+    return inside
+
+
+def nest_loops(loops):
+    # (outer, holes) polygons by nesting depth; outer loops counter-clockwise, holes clockwise
+    loops = [[tuple(p) for p in loop] for loop in loops]
+    depth = [sum(contains(other, loop[0]) for j, other in enumerate(loops) if j != i) for i, loop in enumerate(loops)]
+    polygons = {}
+    for i, loop in enumerate(loops):
+        if depth[i] % 2 == 0:
+            polygons[i] = (loop if signed_area(loop) > 0 else loop[::-1], [])
+    for i, loop in enumerate(loops):
+        if depth[i] % 2 == 1:
+            # The hole belongs to the innermost outer loop around it
+            owners = [j for j in polygons if depth[j] == depth[i] - 1 and contains(loops[j], loop[0])]
+            if owners:
+                polygons[owners[0]][1].append(loop if signed_area(loop) < 0 else loop[::-1])
+    return list(polygons.values())
+
+
+def cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def segments_cross(p, q, a, b):
+    # Proper crossing only; segments that merely touch at an end do not count
+    d1, d2 = cross(p, q, a), cross(p, q, b)
+    d3, d4 = cross(a, b, p), cross(a, b, q)
+    return ((d1 > 0 and d2 < 0) or (d1 < 0 and d2 > 0)) and ((d3 > 0 and d4 < 0) or (d3 < 0 and d4 > 0))
+
+
+def bridge_holes(outer, holes):
+    # Cuts each hole open towards the nearest outer vertex it can see, turning the polygon
+    # with holes into a single loop ear clipping can handle
+    polygon = list(outer)
+    holes = sorted(holes, key=lambda hole: -max(p[0] for p in hole))
+    for n, hole in enumerate(holes):
+        m = max(range(len(hole)), key=lambda i: hole[i][0])
+        start = hole[m]
+        edges = [(a, b) for loop in [polygon] + holes[n:] for a, b in zip(loop, loop[1:] + loop[:1])]
+        candidates = sorted(range(len(polygon)), key=lambda i: (polygon[i][0] - start[0]) ** 2 + (polygon[i][1] - start[1]) ** 2)
+        target = candidates[0]
+        for i in candidates:
+            if not any(segments_cross(start, polygon[i], a, b) for a, b in edges):
+                target = i
+                break
+        polygon = polygon[:target + 1] + hole[m:] + hole[:m + 1] + polygon[target:]
+    return polygon
+
+
+def ear_clip(polygon):
+    # Triangles (as point triples) of a counter-clockwise simple polygon
+    index = list(range(len(polygon)))
+    triangles = []
+    k = 0
+    while len(index) > 3:
+        count = len(index)
+        for step in range(count):
+            i = (k + step) % count
+            a, b, c = polygon[index[i - 1]], polygon[index[i]], polygon[index[(i + 1) % count]]
+            if cross(a, b, c) <= 0:
+                continue
+            corners = (a, b, c)
+            if any(p not in corners and cross(a, b, p) >= 0 and cross(b, c, p) >= 0 and cross(c, a, p) >= 0
+                   for p in (polygon[j] for j in index)):
+                continue
+            triangles.append(corners)
+            del index[i]
+            k = (i - 1) % len(index)
+            break
+        else:
+            # Only flat or self-touching corners are left; drop the flattest one
+            i = min(range(count), key=lambda i: abs(cross(polygon[index[i - 1]], polygon[index[i]], polygon[index[(i + 1) % count]])))
+            del index[i]
+    if len(index) == 3 and cross(*(polygon[i] for i in index)) > 0:
+        triangles.append(tuple(polygon[i] for i in index))
+    return triangles
+
+
+def triangulate(outer, holes):
+    return ear_clip(bridge_holes(outer, holes))
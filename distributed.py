@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import queue
+import pickle
+import socket
+import struct
+import threading
+import collections
+import multiprocessing
+from shared_scene import flatten_objects, restore_objects, renderer_settings, build_worker_renderer, ignore_interrupts
+from ray_stats import RayStats
+
+DEFAULT_PORT = 7341
+RETRY_SECONDS = 60.0
+WORKER_TIMEOUT = 600.0
+# Every message is a JSON header and an optional binary body, preceded by both sizes
+FRAME = struct.Struct("<II")
+
+
+def parse_address(address, default_host="127.0.0.1"):
+    # "host:port", ":port" or just "host"
+    host, separator, port = address.rpartition(":")
+    if not separator:
+        return address or default_host, DEFAULT_PORT
+    return host or default_host, int(port)
+
+
+def send_message(connection, header, body=b""):
+    data = json.dumps(header).encode()
+    connection.sendall(FRAME.pack(len(data), len(body)) + data)
+    if body:
+        connection.sendall(body)
+
+
+def receive_exactly(connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def receive_message(connection):
+    header_size, body_size = FRAME.unpack(receive_exactly(connection, FRAME.size))
+    header = json.loads(receive_exactly(connection, header_size))
+    return header, receive_exactly(connection, body_size)
+
+
+def scene_payload(renderer):
+    # The flattened scene as the workers rebuild it; they never run setup_scene
+    layout, arrays, materials = flatten_objects(renderer.objects)
+    settings = renderer_settings(renderer)
+    settings['serve_address'] = None
+    settings['serve_timeout'] = None
+    return pickle.dumps({
+        'renderer_class': type(renderer),
+        'layout': layout,
+        'arrays': arrays,
+        'materials': materials,
+        'settings': settings,
+    }, protocol=4)
+
+
+# Stands in for draw_scene's multiprocessing.Pool. Workers unpickle the scene it sends, so
+# only point them at a coordinator you trust; it reads nothing but JSON and pixel bytes.
+class TileServer:
+    def __init__(self, renderer, address, timeout=WORKER_TIMEOUT):
+        self.payload = scene_payload(renderer)
+        self.timeout = timeout
+        self.connected = 0
+        self.idle_since = time.time()
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.results = queue.Queue()
+        self.busy = {}
+        self.finished = False
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(parse_address(address, "0.0.0.0"))
+        self.listener.listen()
+        self.listener.settimeout(0.5)
+        self.address = "{}:{}".format(*self.listener.getsockname()[:2])
+        self.accepter = threading.Thread(target=self.accept, daemon=True)
+        self.accepter.start()
+        print(f"Serving {len(self.payload) / 1024:.0f} KiB of scene data on {self.address}; "
+              f"start workers with: python distributed.py HOST:{self.address.split(':')[1]}")
+
+    def accept(self):
+        # Polls so that terminate does not have to interrupt a blocked accept
+        while not self.finished:
+            try:
+                connection, peer = self.listener.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            threading.Thread(target=self.serve, args=(connection, "{}:{}".format(*peer[:2])), daemon=True).start()
+        self.listener.close()
+
+    def next_tile(self, connection):
+        with self.condition:
+            while not self.pending and not self.finished:
+                self.condition.wait()
+            if self.finished:
+                return None
+            tile = self.busy[connection] = self.pending.popleft()
+            return tile
+
+    def release(self, connection, requeue):
+        with self.condition:
+            tile = self.busy.pop(connection, None)
+            if requeue and tile is not None and not self.finished:
+                self.pending.appendleft(tile)
+                self.condition.notify()
+
+    def serve(self, connection, peer):
+        joined = False
+        try:
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            send_message(connection, {'type': "scene"}, self.payload)
+            header, _ = receive_message(connection)
+            name = f"{header['host']}:{header['pid']}"
+            with self.condition:
+                self.connected += 1
+                joined = True
+            print(f"Worker {name} joined from {peer}")
+            while True:
+                tile = self.next_tile(connection)
+                if tile is None:
+                    send_message(connection, {'type': "done"})
+                    return
+                send_message(connection, {'type': "tile", 'tile': list(tile)})
+                header, data = receive_message(connection)
+                x, y, width, height = tile
+                if header.get('type') != "result" or tuple(header.get('tile', ())) != tile or len(data) != width * height * 3:
+                    raise ValueError(f"unexpected reply for tile {tile}")
+                result = (x, y, width, height, data)
+                if 'stats' in header:
+                    result += (RayStats.from_json(header['stats']),)
+                self.release(connection, requeue=False)
+                self.results.put(result)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not self.finished:
+                print(f"Worker at {peer} dropped out ({e}), its tile goes back in the queue")
+        finally:
+            self.release(connection, requeue=True)
+            connection.close()
+            if joined:
+                with self.condition:
+                    self.connected -= 1
+                    if not self.connected:
+                        self.idle_since = time.time()
+
+    def imap_unordered(self, task, tiles):
+        # task is only there to match Pool.imap_unordered; workers always run compute_tile
+        with self.condition:
+            self.pending.extend(tiles)
+            self.condition.notify_all()
+        waiting = False
+        for _ in range(len(tiles)):
+            while True:
+                try:
+                    yield self.results.get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    pass
+                # Without any worker the render can only go on once one (re)connects
+                with self.condition:
+                    idle = None if self.connected else time.time() - self.idle_since
+                    left = len(self.pending)
+                if idle is None:
+                    waiting = False
+                elif idle >= self.timeout:
+                    raise TimeoutError(f"no worker connected to {self.address} for {idle:.0f} seconds, {left} tiles left")
+                elif not waiting:
+                    print(f"Waiting for workers on {self.address}, {left} tiles left "
+                          f"(giving up after {self.timeout:.0f} seconds without one)")
+                    waiting = True
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def terminate(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+            busy = list(self.busy)
+        # Waiting workers are told they are done; those still rendering lose their connection
+        for connection in busy:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def join(self):
+        self.accepter.join()
+
+
+def connect(address, retry):
+    deadline = time.time() + retry
+    while True:
+        try:
+            return socket.create_connection(parse_address(address))
+        except OSError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(1.0)
+
+
+def run_worker(address, retry=RETRY_SECONDS):
+    # Renders tiles for one render of the coordinator at address; returns the tile count
+    connection = connect(address, retry)
+    tiles = 0
+    try:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        _, body = receive_message(connection)
+        manifest = pickle.loads(body)
+        objects = restore_objects(manifest['layout'], manifest['arrays'], manifest['materials'])
+        renderer = build_worker_renderer(manifest['renderer_class'], manifest['settings'], objects)
+        name = f"{socket.gethostname()}:{os.getpid()}"
+        send_message(connection, {'type': "ready", 'host': socket.gethostname(), 'pid': os.getpid()})
+        while True:
+            header, _ = receive_message(connection)
+            if header['type'] == "done":
+                return tiles
+            result = renderer.compute_tile(tuple(header['tile']))
+            reply = {'type': "result", 'tile': list(result[:4])}
+            if len(result) > 5:
+                result[5].worker = name
+                reply['stats'] = result[5].to_json()
+            send_message(connection, reply, result[4])
+            tiles += 1
+    finally:
+        connection.close()
+
+
+def worker_process(address, retry, forever):
+    ignore_interrupts()
+    while True:
+        try:
+            tiles = run_worker(address, retry)
+            print(f"Worker {os.getpid()} rendered {tiles} tiles for {address}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Worker {os.getpid()} lost {address}: {e}")
+        if not forever:
+            return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help', 'help'):
+        print("Distributed Worker Usage:")
+        print("  python distributed.py HOST[:PORT] [options]")
+        print(f"\nConnects to a coordinator started with main.py --serve (default port: {DEFAULT_PORT}) and renders")
+        print("tiles for it. Workers need the same renderer sources as the coordinator, not the scene file.")
+        print("\nOptions:")
+        print("  --processes N        Number of worker processes on this host (default: number of CPUs)")
+        print(f"  --retry S            Seconds to keep trying to reach the coordinator (default: {RETRY_SECONDS:.0f})")
+        print("  --forever            Wait for the next render after each one instead of exiting")
+        print("\nExamples:")
+        print("  python main.py scene_final.py 4000 3000 --serve :7341")
+        print("  python distributed.py render-head:7341 --processes 16")
+        sys.exit(0 if len(sys.argv) > 1 else 1)
+
+    address = sys.argv[1]
+    processes = multiprocessing.cpu_count()
+    if '--processes' in sys.argv:
+        idx = sys.argv.index('--processes')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].isdigit():
+            processes = max(1, int(sys.argv[idx + 1]))
+    retry = RETRY_SECONDS
+    if '--retry' in sys.argv:
+        idx = sys.argv.index('--retry')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].replace('.', '', 1).isdigit():
+            retry = float(sys.argv[idx + 1])
+
+    workers = [multiprocessing.Process(target=worker_process, args=(address, retry, '--forever' in sys.argv))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
@@ -1,22 +1,85 @@
+import os
+import hashlib
+from collections import OrderedDict
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from vector import Vector
 from ray import EnhancedTriangle
+from triangle_mesh import TriangleMesh
+from instancing import Transform, MeshInstance
+from contours import trace_contours, simplify_loop, signed_area, nest_loops, triangulate
+from scene_cache import record_data_file
+
+# Bump whenever a mesher changes its output so stale disk cache entries are not reused
+MESHER_VERSION = 1
+TEXT_CACHE_SIZE = 64
+
+# Text meshes at the origin by mesh_key, shared by every FontRenderer in the process
+_text_meshes = OrderedDict()
+
+
+def runs(mask):
+    # Maximal runs of True along each row of mask as (row, start, end) arrays, end exclusive
+    edges = np.diff(np.pad(mask.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends
+
+
+def greedy_rectangles(mask):
+    # Covers mask with (x0, y0, x1, y1) rectangles, ends exclusive: the runs of each row are
+    # maximal and a run repeated unchanged on the next row extends the rectangle above it
+    row_runs = {}
+    for row, start, end in zip(*(values.tolist() for values in runs(mask))):
+        row_runs.setdefault(row, []).append((start, end))
+    
+    rectangles = []
+    active = {}
+    for row in range(mask.shape[0] + 1):
+        current = {run: active.pop(run, row) for run in row_runs.get(row, ())}
+        rectangles.extend((start, top, end, row) for (start, end), top in active.items())
+        active = current
+    return np.array(rectangles, dtype=np.int64).reshape(-1, 4)
+
+
+def to_enhanced_triangles(triangles, material):
+    return [EnhancedTriangle(Vector(*v0), Vector(*v1), Vector(*v2), material) for v0, v1, v2 in triangles.tolist()]
+
+
+def triangle_array(*corners):
+    # corners are (x, y, z) tuples of arrays or scalars, one triangle per array entry
+    return np.stack([np.stack(np.broadcast_arrays(*corner), axis=-1).reshape(-1, 3) for corner in corners], axis=1)
+
+
+def quad_triangles(a, b, c, d, winding):
+    corners = (a, b, c, d)
+    return np.stack([triangle_array(*(corners[i] for i in triangle)) for triangle in winding], axis=1).reshape(-1, 3, 3)
+
 
 class FontRenderer:
-    def __init__(self, ttf_path, size=32, depth=5):
+    def __init__(self, ttf_path, size=32, depth=5, cache_dir=".text_cache"):
         self.ttf_path = ttf_path
         self.size = size
         self.depth = depth
+        self.cache_dir = cache_dir
         self.font = None
+        self.font_source = None
+        self.glyph_meshes = {}
+        # Also recorded when missing, so a font that shows up later invalidates scenes
+        # compiled with the default one
+        record_data_file(ttf_path)
         
         try:
             self.font = ImageFont.truetype(ttf_path, size)
+            self.font_source = ttf_path
+            if os.path.exists(ttf_path):
+                self.font_source = (os.path.abspath(ttf_path), os.path.getsize(ttf_path), os.path.getmtime(ttf_path))
             print(f"Successfully loaded font: {ttf_path}")
         except Exception as e:
             print(f"Error loading font: {e}")
             try:
                 self.font = ImageFont.load_default()
+                self.font_source = "default"
                 print("Using default font instead")
             except:
                 print("Could not load any font")
@@ -57,68 +120,205 @@ class FontRenderer:
         
         return img
     
+    def extrude_bitmap(self, bitmap, position, scale=1.0, rotation=(0, 0, 0)):
+        # The extruded bitmap as an (n, 3, 3) array of triangles. Lit pixels are merged into
+        # rectangles for the front and back, and side walls are only emitted along the outline,
+        # with the same corners and winding as a wall of single pixels would have.
+        width, height = bitmap.size
+        pixels = np.array(bitmap)
+        threshold = 128
+        
+        # The last row and column are never extruded; the border stays unlit
+        lit = np.zeros((height + 1, width + 1), dtype=bool)
+        lit[1:-1, 1:-1] = pixels[:height-1, :width-1] > threshold
+        inside = lit[1:-1, 1:-1]
+        
+        grid_x = position.x + (np.arange(width) - width/2) * scale
+        grid_y = position.y - (np.arange(height) - height/2) * scale
+        front, back = position.z, position.z + self.depth
+        
+        x0, y0, x1, y1 = greedy_rectangles(inside).T
+        faces = [
+            quad_triangles((grid_x[x0], grid_y[y0], front), (grid_x[x1], grid_y[y0], front),
+                           (grid_x[x0], grid_y[y1], front), (grid_x[x1], grid_y[y1], front), ((0, 1, 2), (1, 3, 2))),
+            quad_triangles((grid_x[x0], grid_y[y0], back), (grid_x[x1], grid_y[y0], back),
+                           (grid_x[x0], grid_y[y1], back), (grid_x[x1], grid_y[y1], back), ((0, 2, 1), (1, 2, 3))),
+        ]
+        
+        row, start, end = runs(inside & ~lit[:-2, 1:-1])
+        faces.append(quad_triangles((grid_x[start], grid_y[row], front), (grid_x[end], grid_y[row], front),
+                                    (grid_x[start], grid_y[row], back), (grid_x[end], grid_y[row], back), ((0, 2, 1), (1, 2, 3))))
+        row, start, end = runs(inside & ~lit[2:, 1:-1])
+        faces.append(quad_triangles((grid_x[start], grid_y[row + 1], front), (grid_x[end], grid_y[row + 1], front),
+                                    (grid_x[start], grid_y[row + 1], back), (grid_x[end], grid_y[row + 1], back), ((0, 1, 2), (1, 3, 2))))
+        column, start, end = runs((inside & ~lit[1:-1, :-2]).T)
+        faces.append(quad_triangles((grid_x[column], grid_y[start], front), (grid_x[column], grid_y[end], front),
+                                    (grid_x[column], grid_y[start], back), (grid_x[column], grid_y[end], back), ((0, 1, 2), (1, 3, 2))))
+        column, start, end = runs((inside & ~lit[1:-1, 2:]).T)
+        faces.append(quad_triangles((grid_x[column + 1], grid_y[start], front), (grid_x[column + 1], grid_y[end], front),
+                                    (grid_x[column + 1], grid_y[start], back), (grid_x[column + 1], grid_y[end], back), ((0, 2, 1), (1, 2, 3))))
+        
+        return self.rotate_triangles(np.concatenate(faces), position, rotation)
+    
+    def rotate_triangles(self, triangles, position, rotation):
+        # Text turns about the middle of its slab, like rotate_vertex does for every vertex
+        if rotation == (0, 0, 0):
+            return triangles
+        from scene_utils import rotate_points
+        center = Vector(position.x, position.y, position.z + self.depth/2)
+        return rotate_points(triangles.reshape(-1, 3), center, rotation).reshape(-1, 3, 3)
+    
+    def place_triangles(self, triangles, position, rotation=(0, 0, 0)):
+        # The meshers add the position to offsets from the origin, so moving a mesh built at
+        # the origin gives the same coordinates as building it in place
+        return self.rotate_triangles(triangles + np.array((position.x, position.y, position.z), dtype=np.float64), position, rotation)
+    
     def bitmap_to_triangles(self, bitmap, position, material, scale=1.0, rotation=(0, 0, 0)):
         if bitmap is None:
             return []
         
-        width, height = bitmap.size
-        pixels = np.array(bitmap)
-        triangles = []
-        threshold = 128
+        triangles = self.extrude_bitmap(bitmap, position, scale, rotation)
+        return to_enhanced_triangles(triangles, material)
+    
+    def text_to_triangles(self, text, position, material, scale=1.0, rotation=(0, 0, 0)):
+        triangles = self.text_mesh(text, scale)
+        return to_enhanced_triangles(self.place_triangles(triangles, position, rotation), material)
+    
+    def mesh_key(self, text, scale, mesher, detail_level):
+        return repr((MESHER_VERSION, self.font_source, self.size, self.depth, text, float(scale), mesher, float(detail_level)))
+    
+    def text_mesh(self, text, scale=1.0, mesher="voxel", detail_level=1.0):
+        # Triangles of the text built at the origin without rotation, from the in-memory
+        # cache, the disk cache or the mesher, in that order
+        if self.font is None:
+            return np.zeros((0, 3, 3))
+        
+        key = self.mesh_key(text, scale, mesher, detail_level)
+        if key in _text_meshes:
+            _text_meshes.move_to_end(key)
+            return _text_meshes[key]
         
-        for y in range(height-1):
-            for x in range(width-1):
-                if pixels[y, x] > threshold:
-                    x_pos = position.x + (x - width/2) * scale
-                    y_pos = position.y - (y - height/2) * scale
-                    z_pos = position.z
-                    
-                    v0 = Vector(x_pos, y_pos, z_pos)
-                    v1 = Vector(x_pos + scale, y_pos, z_pos)
-                    v2 = Vector(x_pos, y_pos - scale, z_pos)
-                    v3 = Vector(x_pos + scale, y_pos - scale, z_pos)
-                    
-                    v4 = Vector(x_pos, y_pos, z_pos + self.depth)
-                    v5 = Vector(x_pos + scale, y_pos, z_pos + self.depth)
-                    v6 = Vector(x_pos, y_pos - scale, z_pos + self.depth)
-                    v7 = Vector(x_pos + scale, y_pos - scale, z_pos + self.depth)
-                    
-                    if rotation != (0, 0, 0):
-                        from scene_utils import rotate_vertex
-                        center = Vector(position.x, position.y, position.z + self.depth/2)
-                        v0 = rotate_vertex(v0, center, rotation)
-                        v1 = rotate_vertex(v1, center, rotation)
-                        v2 = rotate_vertex(v2, center, rotation)
-                        v3 = rotate_vertex(v3, center, rotation)
-                        v4 = rotate_vertex(v4, center, rotation)
-                        v5 = rotate_vertex(v5, center, rotation)
-                        v6 = rotate_vertex(v6, center, rotation)
-                        v7 = rotate_vertex(v7, center, rotation)
-                    
-                    triangles.append(EnhancedTriangle(v0, v1, v2, material))
-                    triangles.append(EnhancedTriangle(v1, v3, v2, material))
-                    
-                    triangles.append(EnhancedTriangle(v4, v6, v5, material))
-                    triangles.append(EnhancedTriangle(v5, v6, v7, material))
-                    
-                    if y == 0 or pixels[y-1, x] <= threshold:
-                        triangles.append(EnhancedTriangle(v0, v4, v1, material))
-                        triangles.append(EnhancedTriangle(v1, v4, v5, material))
-                    
-                    if y == height-2 or pixels[y+1, x] <= threshold:
-                        triangles.append(EnhancedTriangle(v2, v3, v6, material))
-                        triangles.append(EnhancedTriangle(v3, v7, v6, material))
-                    
-                    if x == 0 or pixels[y, x-1] <= threshold:
-                        triangles.append(EnhancedTriangle(v0, v2, v4, material))
-                        triangles.append(EnhancedTriangle(v2, v6, v4, material))
-                    
-                    if x == width-2 or pixels[y, x+1] <= threshold:
-                        triangles.append(EnhancedTriangle(v1, v5, v3, material))
-                        triangles.append(EnhancedTriangle(v3, v5, v7, material))
+        triangles = self.load_cached_mesh(key)
+        if triangles is None:
+            bitmap = self.rasterize_text(text)
+            if mesher == "contour":
+                triangles = self.extrude_outline(bitmap, Vector(0, 0, 0), scale, detail_level=detail_level)
+            else:
+                triangles = self.extrude_bitmap(bitmap, Vector(0, 0, 0), scale)
+            self.store_cached_mesh(key, triangles)
         
+        _text_meshes[key] = triangles
+        while len(_text_meshes) > TEXT_CACHE_SIZE:
+            _text_meshes.popitem(last=False)
         return triangles
     
-    def text_to_triangles(self, text, position, material, scale=1.0, rotation=(0, 0, 0)):
+    def cache_path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest()[:32] + ".npy")
+    
+    def load_cached_mesh(self, key):
+        path = self.cache_path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            # Mapped rather than read; placing the text copies what it needs
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable text cache entry {path}: {e}")
+            return None
+    
+    def store_cached_mesh(self, key, triangles):
+        path = self.cache_path(key)
+        if path is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as f:
+                np.save(f, np.ascontiguousarray(triangles, dtype=np.float64))
+            os.replace(temporary, path)
+        except OSError as e:
+            print(f"Could not write text cache entry {path}: {e}")
+    
+    def extrude_outline(self, bitmap, position, scale=1.0, rotation=(0, 0, 0), detail_level=1.0):
+        # The extruded bitmap as an (n, 3, 3) array of triangles built from its traced outline:
+        # one cap polygon per letter part instead of one square per pixel. Lower detail levels
+        # allow the simplified outline to stray further from the traced one.
+        width, height = bitmap.size
+        tolerance = 0.2 + 0.6 * max(0.0, 1.0 - detail_level)
+        loops = []
+        for loop in trace_contours(np.array(bitmap), 128):
+            # v runs down the bitmap; flip it so the plane has the same handedness as the scene
+            loop = simplify_loop([(u, -v) for u, v in loop], tolerance)
+            if len(loop) >= 3 and abs(signed_area(loop)) > 0.25:
+                loops.append(loop.tolist())
+        
+        caps = []
+        walls = []
+        for outer, holes in nest_loops(loops):
+            caps.extend(triangulate(outer, holes))
+            for loop in [outer] + holes:
+                walls.extend(zip(loop, loop[1:] + loop[:1]))
+        
+        def to_plane(points):
+            points = np.array(points, dtype=np.float64).reshape(-1, 2)
+            return (position.x + (points[:, 0] - width/2) * scale, position.y + (points[:, 1] + height/2) * scale)
+        
+        front, back = position.z, position.z + self.depth
+        caps = [to_plane([triangle[i] for triangle in caps]) for i in range(3)]
+        starts = to_plane([p for p, _ in walls])
+        ends = to_plane([q for _, q in walls])
+        # Caps face -z at the front and +z at the back; walls face away from the filled side
+        triangles = np.concatenate((
+            triangle_array(caps[0] + (front,), caps[2] + (front,), caps[1] + (front,)),
+            triangle_array(caps[0] + (back,), caps[1] + (back,), caps[2] + (back,)),
+            quad_triangles(starts + (front,), ends + (front,), starts + (back,), ends + (back,), ((0, 1, 2), (1, 3, 2))),
+        ))
+        return self.rotate_triangles(triangles, position, rotation)
+    
+    def text_to_triangles_contour(self, text, position, material, scale=1.0, rotation=(0, 0, 0), detail_level=1.0):
+        # Same placement as text_to_triangles with smooth outlines and far fewer triangles
+        triangles = self.text_mesh(text, scale, "contour", detail_level)
+        return to_enhanced_triangles(self.place_triangles(triangles, position, rotation), material)
+    
+    def glyph_mesh(self, char, material):
+        # Each character is meshed once at unit scale on a canvas tall enough for any glyph,
+        # so they all share one baseline; the cache holds (mesh, canvas width)
+        if char not in self.glyph_meshes:
+            padding = 5
+            ascent, descent = self.font.getmetrics()
+            right = self.font.getbbox(char)[2]
+            width = max(int(np.ceil(self.font.getlength(char))), right) + padding * 2
+            img = Image.new('L', (width, ascent + descent + padding * 2), 0)
+            ImageDraw.Draw(img).text((padding, padding), char, font=self.font, fill=255)
+            triangles = self.extrude_bitmap(img, Vector(0, 0, 0))
+            vertices, indices = np.unique(triangles.reshape(-1, 3), axis=0, return_inverse=True)
+            mesh = TriangleMesh(vertices, indices.reshape(-1, 3), material) if len(triangles) else None
+            self.glyph_meshes[char] = (mesh, width)
+        return self.glyph_meshes[char]
+    
+    def text_to_instances(self, text, position, material, scale=1.0, rotation=(0, 0, 0)):
+        # Same placement as text_to_triangles, but repeated characters share one glyph mesh
         bitmap = self.rasterize_text(text)
-        return self.bitmap_to_triangles(bitmap, position, material, scale, rotation)
\ No newline at end of file
+        if bitmap is None:
+            return []
+        
+        width, height = bitmap.size
+        ascent, descent = self.font.getmetrics()
+        glyph_height = ascent + descent + 10
+        center = Vector(position.x, position.y, position.z + self.depth/2)
+        placement = Transform.rotation(rotation, center) if rotation != (0, 0, 0) else Transform()
+        
+        instances = []
+        for i, char in enumerate(text):
+            mesh, glyph_width = self.glyph_mesh(char, material)
+            if mesh is None:
+                continue
+            advance = round(self.font.getlength(text[:i]))
+            offset = Vector(position.x + (advance + glyph_width/2 - width/2) * scale,
+                            position.y + (height - glyph_height) / 2 * scale,
+                            position.z)
+            transform = Transform.scaling(scale, scale, 1.0).then(Transform.translation(offset)).then(placement)
+            instances.append(MeshInstance(mesh, transform, material))
+        return instances
@@ -0,0 +1,147 @@
+import os
+import numpy as np
+from triangle_mesh import TriangleMesh
+from instancing import MeshInstance
+from lighting import PointLight, DirectionalLight
+from checkpoint import scene_key
+
+FIELDS = ('sample_x', 'sample_y', 'point', 'normal', 'material', 'object')
+# Settings a relight may change without invalidating the primary hits
+LIGHTING_SETTINGS = ('lights', 'ambient_factor', 'backend', 'light_samples', 'min_contribution', 'roulette_depth',
+                     'branch_sampling')
+
+
+def gbuffer_key(renderer):
+    return scene_key(renderer, "gbuffer", ignored=LIGHTING_SETTINGS)
+
+
+def material_table(objects):
+    # Every material in the scene in first-use order; G-buffer material ids index into it
+    materials = []
+    index = {}
+
+    def add(material):
+        # Checker materials are resolved per sample, so only the two they pick from get ids
+        if hasattr(material, 'material_at'):
+            add(material.material1)
+            add(material.material2)
+            return
+        if id(material) not in index:
+            index[id(material)] = len(materials)
+            materials.append(material)
+
+    for obj in objects:
+        if isinstance(obj, MeshInstance) and obj.material is not None:
+            add(obj.material)
+        elif isinstance(obj, MeshInstance):
+            for material in obj.mesh.materials:
+                add(material)
+        elif isinstance(obj, TriangleMesh):
+            for material in obj.materials:
+                add(material)
+        elif hasattr(obj, 'get_material'):
+            add(obj.get_material())
+    return materials, index
+
+
+def hit_owner(hit):
+    # Mesh faces and instance faces stand for the scene object they belong to
+    if hasattr(hit, 'instance'):
+        return hit.instance
+    if hasattr(hit, 'mesh'):
+        return hit.mesh
+    return hit
+
+
+def light_key(light):
+    # What a light's shadows and falloff depend on; its intensity is left out so that the
+    # stored terms stay valid while it is tuned. Other light types are never reused.
+    if type(light) is PointLight:
+        return "point {!r} {!r} {!r}".format(*(float(v) for v in (light.position.x, light.position.y, light.position.z)))
+    if type(light) is DirectionalLight:
+        return "directional {!r} {!r} {!r}".format(*(float(v) for v in (light.direction.x, light.direction.y, light.direction.z)))
+    return None
+
+
+def split_samples(material, materials):
+    # Indices of the opaque diffuse hits, which are shaded from the buffer, and of the
+    # reflective or transparent ones, which are traced again
+    plain = np.array([m.reflectivity <= 0 and m.transparency <= 0 for m in materials] + [False])
+    hit = material >= 0
+    return np.nonzero(hit & plain[material])[0], np.nonzero(hit & ~plain[material])[0]
+
+
+def empty_terms(count):
+    # Per sample: the cosine factor and the fraction of the light that reaches the point
+    return np.zeros(count), np.zeros(count)
+
+
+def empty_samples(count):
+    return {
+        'sample_x': np.zeros(count),
+        'sample_y': np.zeros(count),
+        'point': np.zeros((count, 3)),
+        'normal': np.zeros((count, 3)),
+        'material': np.full(count, -1, dtype=np.int32),
+        'object': np.full(count, -1, dtype=np.int32),
+    }
+
+
+class GBuffer:
+    def __init__(self, width, height, samples_per_pixel, key, tiles, samples, light_terms=None):
+        # Samples run tile by tile, pixel by pixel, samples_per_pixel entries each; material
+        # -1 is background. light_terms keeps the last light rig's terms by light_key.
+        self.width = width
+        self.height = height
+        self.samples_per_pixel = samples_per_pixel
+        self.key = key
+        self.tiles = [tuple(tile) for tile in tiles]
+        self.starts = np.cumsum([0] + [w * h * samples_per_pixel for _, _, w, h in self.tiles])
+        self.samples = samples
+        self.light_terms = light_terms or {}
+
+    @classmethod
+    def from_tiles(cls, renderer, results):
+        tiles = [tile for tile, _ in results]
+        samples = {name: np.concatenate([data[name] for _, data in results]) if results else empty_samples(0)[name]
+                   for name in FIELDS}
+        return cls(renderer.width, renderer.height, renderer.samples_per_pixel, gbuffer_key(renderer), tiles, samples)
+
+    def tile_samples(self, index):
+        start, end = self.starts[index], self.starts[index + 1]
+        return {name: values[start:end] for name, values in self.samples.items()}
+
+    def tile_light_terms(self, index, keys):
+        start, end = self.starts[index], self.starts[index + 1]
+        return [tuple(values[start:end] for values in self.light_terms[key]) if key in self.light_terms else None
+                for key in keys]
+
+    def store_light_terms(self, keys, tile_terms):
+        # tile_terms holds one list of per-light terms for each tile in order
+        self.light_terms = {key: tuple(np.concatenate([terms[i][part] for terms in tile_terms]) for part in range(2))
+                            for i, key in enumerate(keys) if key is not None}
+
+    def matches(self, renderer):
+        return ((self.width, self.height, self.samples_per_pixel) == (renderer.width, renderer.height, renderer.samples_per_pixel)
+                and self.key == gbuffer_key(renderer))
+
+    def save(self, path):
+        keys = list(self.light_terms)
+        terms = {}
+        for i, key in enumerate(keys):
+            terms[f"light{i}.diffuse"], terms[f"light{i}.visibility"] = self.light_terms[key]
+        with open(path, "wb") as f:
+            np.savez(f, size=np.array((self.width, self.height, self.samples_per_pixel)), key=np.array(self.key),
+                     tiles=np.array(self.tiles, dtype=np.int64).reshape(-1, 4), light_keys=np.array(keys, dtype=str),
+                     **self.samples, **terms)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            width, height, samples_per_pixel = data['size'].tolist()
+            samples = {name: data[name] for name in FIELDS}
+            light_terms = {key: (data[f"light{i}.diffuse"], data[f"light{i}.visibility"])
+                           for i, key in enumerate(data['light_keys'].tolist())}
+            return cls(width, height, samples_per_pixel, str(data['key']), data['tiles'].tolist(), samples, light_terms)
@@ -0,0 +1,192 @@
+import math
+import numpy as np
+from vector import Vector
+from ray_batch import INF, normalize
+
+
+def rotation_matrix(rotation_degrees):
+    # Same axis order as scene_utils.rotate_vertex: about x, then y, then z
+    ax, ay, az = (math.radians(angle) for angle in rotation_degrees)
+    cx, sx = math.cos(ax), math.sin(ax)
+    cy, sy = math.cos(ay), math.sin(ay)
+    cz, sz = math.cos(az), math.sin(az)
+
+    columns = []
+    for x, y, z in ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)):
+        y1 = y * cx - z * sx
+        z1 = y * sx + z * cx
+        x2 = x * cy + z1 * sy
+        z2 = -x * sy + z1 * cy
+        columns.append((x2 * cz - y1 * sz, x2 * sz + y1 * cz, z2))
+    return tuple(columns[col][row] for row in range(3) for col in range(3))
+
+
+def multiply(a, b):
+    return tuple(sum(a[3 * row + k] * b[3 * k + col] for k in range(3)) for row in range(3) for col in range(3))
+
+
+def invert(m):
+    a, b, c, d, e, f, g, h, i = m
+    det = a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+    if det == 0:
+        raise ValueError("Instance transform is not invertible")
+    s = 1.0 / det
+    return ((e * i - f * h) * s, (c * h - b * i) * s, (b * f - c * e) * s,
+            (f * g - d * i) * s, (a * i - c * g) * s, (c * d - a * f) * s,
+            (d * h - e * g) * s, (b * g - a * h) * s, (a * e - b * d) * s)
+
+
+# Affine map p -> M p + offset with M stored row-major
+class Transform:
+    def __init__(self, matrix=(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0), offset=(0.0, 0.0, 0.0)):
+        self.matrix = tuple(float(v) for v in matrix)
+        self.offset = tuple(float(v) for v in offset)
+        self.inverse = invert(self.matrix)
+        m = self.inverse
+        self.normal_matrix = (m[0], m[3], m[6], m[1], m[4], m[7], m[2], m[5], m[8])
+
+    @classmethod
+    def translation(cls, offset):
+        return cls(offset=(offset.x, offset.y, offset.z))
+
+    @classmethod
+    def scaling(cls, sx, sy=None, sz=None):
+        sy = sx if sy is None else sy
+        sz = sx if sz is None else sz
+        return cls((sx, 0.0, 0.0, 0.0, sy, 0.0, 0.0, 0.0, sz))
+
+    @classmethod
+    def rotation(cls, rotation_degrees, origin=None):
+        matrix = rotation_matrix(rotation_degrees)
+        if origin is None:
+            return cls(matrix)
+        # Rotating about origin: R (p - c) + c
+        rx, ry, rz = cls(matrix).vector(origin.x, origin.y, origin.z)
+        return cls(matrix, (origin.x - rx, origin.y - ry, origin.z - rz))
+
+    def then(self, other):
+        # The transform that applies self first and other second
+        m = multiply(other.matrix, self.matrix)
+        ox, oy, oz = other.vector(*self.offset)
+        return Transform(m, (ox + other.offset[0], oy + other.offset[1], oz + other.offset[2]))
+
+    def vector(self, x, y, z):
+        m = self.matrix
+        return (m[0] * x + m[1] * y + m[2] * z, m[3] * x + m[4] * y + m[5] * z, m[6] * x + m[7] * y + m[8] * z)
+
+    def point(self, x, y, z):
+        vx, vy, vz = self.vector(x, y, z)
+        return vx + self.offset[0], vy + self.offset[1], vz + self.offset[2]
+
+    def to_local(self, ray_origin, ray_direction):
+        # The direction is not renormalised, so distances along the ray are the same in both spaces
+        m = self.inverse
+        x, y, z = ray_origin.x - self.offset[0], ray_origin.y - self.offset[1], ray_origin.z - self.offset[2]
+        dx, dy, dz = ray_direction.x, ray_direction.y, ray_direction.z
+        return (Vector(m[0] * x + m[1] * y + m[2] * z, m[3] * x + m[4] * y + m[5] * z, m[6] * x + m[7] * y + m[8] * z),
+                Vector(m[0] * dx + m[1] * dy + m[2] * dz, m[3] * dx + m[4] * dy + m[5] * dz,
+                       m[6] * dx + m[7] * dy + m[8] * dz))
+
+    def to_local_batch(self, origins, directions):
+        inverse = np.array(self.inverse).reshape(3, 3)
+        return (origins - np.array(self.offset)) @ inverse.T, directions @ inverse.T
+
+    def normals_to_world(self, normals):
+        return normalize(normals @ np.array(self.normal_matrix).reshape(3, 3).T)
+
+    def __eq__(self, other):
+        return isinstance(other, Transform) and self.matrix == other.matrix and self.offset == other.offset
+
+    def __hash__(self):
+        return hash((self.matrix, self.offset))
+
+
+class InstanceFace:
+    __slots__ = ('instance', 'index', 'material', 'color')
+
+    def __init__(self, instance, index):
+        self.instance = instance
+        self.index = index
+        self.material = instance.face_material(index)
+        self.color = self.material.color
+
+    def __eq__(self, other):
+        return isinstance(other, InstanceFace) and other.instance is self.instance and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.instance), self.index))
+
+    def intersects(self, ray_origin, ray_direction):
+        local_origin, local_direction = self.instance.transform.to_local(ray_origin, ray_direction)
+        t, _ = self.instance.mesh.intersect(local_origin, local_direction, faces=np.array([self.index]))
+        return t if t < INF else None
+
+    def get_normal(self, _):
+        nx, ny, nz = self.instance.mesh.normals[self.index].tolist()
+        m = self.instance.transform.normal_matrix
+        x = m[0] * nx + m[1] * ny + m[2] * nz
+        y = m[3] * nx + m[4] * ny + m[5] * nz
+        z = m[6] * nx + m[7] * ny + m[8] * nz
+        length = math.sqrt(x * x + y * y + z * z)
+        return Vector(x / length, y / length, z / length)
+
+    def get_material(self):
+        return self.material
+
+    def get_bounds(self):
+        transform = self.instance.transform
+        corners = [transform.point(*v) for v in self.instance.mesh.vertices[self.instance.mesh.indices[self.index]].tolist()]
+        return (Vector(*(min(c[axis] for c in corners) for axis in range(3))),
+                Vector(*(max(c[axis] for c in corners) for axis in range(3))))
+
+
+# A placement of a shared TriangleMesh; rays move into the mesh's object space, so any
+# number of placements share one copy of the geometry
+class MeshInstance:
+    def __init__(self, mesh, transform, material=None):
+        self.mesh = mesh
+        self.transform = transform
+        self.material = material
+        self.color = self.get_material().color
+
+    def face_material(self, index):
+        if self.material is not None:
+            return self.material
+        return self.mesh.materials[self.mesh.material_ids[index]]
+
+    def intersect(self, ray_origin, ray_direction, max_distance=INF):
+        local_origin, local_direction = self.transform.to_local(ray_origin, ray_direction)
+        return self.mesh.intersect(local_origin, local_direction, max_distance)
+
+    def intersect_batch(self, origins, directions, max_distance=INF):
+        local_origins, local_directions = self.transform.to_local_batch(origins, directions)
+        return self.mesh.intersect_batch(local_origins, local_directions, max_distance)
+
+    def intersects(self, ray_origin, ray_direction):
+        t, _ = self.intersect(ray_origin, ray_direction)
+        return t if t < INF else None
+
+    def cast(self, ray_origin, ray_direction, max_distance=INF):
+        t, face = self.intersect(ray_origin, ray_direction, max_distance)
+        if face < 0:
+            return None, INF
+        return InstanceFace(self, face), t
+
+    def occluders(self, ray_origin, ray_direction, max_distance=INF):
+        local_origin, local_direction = self.transform.to_local(ray_origin, ray_direction)
+        transparencies = None
+        if self.material is not None:
+            transparencies = [getattr(self.material, 'transparency', 0.0)] * len(self.mesh.materials)
+        return self.mesh.occluders(local_origin, local_direction, max_distance, transparencies)
+
+    def face(self, index):
+        return InstanceFace(self, index)
+
+    def get_bounds(self):
+        lo, hi = self.mesh.get_bounds()
+        corners = [self.transform.point(x, y, z) for x in (lo.x, hi.x) for y in (lo.y, hi.y) for z in (lo.z, hi.z)]
+        return (Vector(*(min(c[axis] for c in corners) for axis in range(3))),
+                Vector(*(max(c[axis] for c in corners) for axis in range(3))))
+
+    def get_material(self):
+        return self.material if self.material is not None else self.mesh.material
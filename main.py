@@ -2,9 +2,19 @@ import time
 import os
 import sys
 import importlib.util
-from renderer import Renderer, ConsoleProgressListener
+from renderer import Renderer, ConsoleProgressListener, PreviewImageWriter
+from scene_utils import make_turntable
+from gbuffer import GBuffer
+from telemetry import TelemetryListener
+from scene_cache import settings_snapshot, setup_key, compile_scene, load_compiled_scene
 
-def run_scene(scene_file, width=800, height=600, preview=False, preview_scale=0.25, preview_depth=2):
+def run_scene(scene_file, width=800, height=600, preview=False, preview_scale=0.25, preview_depth=2, backend="recursive",
+              tile_size=32, tile_order="spiral", scene_distribution="shared", adaptive=False, min_samples=4,
+              max_samples=64, noise_threshold=2.0, progressive=False, preview_interval=2.0,
+              resume=False, frames=0, save_gbuffer=False, relight=False, scene_cache=True, light_samples=0,
+              min_contribution=0.0, roulette_depth=0, branch_sampling=False, collect_stats=False, cost_heatmap=False,
+              telemetry=None, telemetry_interval=5.0, serve_address=None,
+              serve_timeout=600.0):
     if not os.path.exists(scene_file):
         print(f"Error: Scene file '{scene_file}' not found")
         return 0
@@ -25,15 +35,79 @@ def run_scene(scene_file, width=800, height=600, preview=False, preview_scale=0.
     
     start_time = time.time()
     raster = Renderer(width, height)
+    raster.backend = backend
+    raster.tile_size = tile_size
+    raster.tile_order = tile_order
+    raster.scene_distribution = scene_distribution
+    raster.adaptive_sampling = adaptive
+    raster.min_samples = min_samples
+    raster.max_samples = max_samples
+    raster.noise_threshold = noise_threshold
+    raster.light_samples = light_samples
+    raster.min_contribution = min_contribution
+    raster.roulette_depth = roulette_depth
+    raster.branch_sampling = branch_sampling
+    raster.collect_stats = collect_stats or cost_heatmap
+    raster.cost_heatmap = cost_heatmap
+    if serve_address and (frames or preview or progressive or relight):
+        print("--serve only distributes full still renders, rendering locally")
+        serve_address = None
+    raster.serve_address = serve_address
+    raster.serve_timeout = serve_timeout
     
     raster.add_progress_listener(ConsoleProgressListener())
+    if telemetry:
+        try:
+            raster.add_progress_listener(TelemetryListener(telemetry, telemetry_interval))
+            raster.tile_stats = True
+        except OSError as e:
+            print(f"Telemetry disabled, cannot open {telemetry}: {e}")
     
-    print(f"Setting up scene from {scene_file}...")
-    scene_module.setup_scene(raster)
+    raster.progressive = progressive
+    raster.preview_interval = preview_interval
+    if progressive:
+        raster.add_progress_listener(PreviewImageWriter(f"{scene_name}_progress.png"))
+    
+    # Scenes that animate themselves keep references to what setup_scene built, so they
+    # always run it
+    compiled_file = f"{scene_name}.scene"
+    if frames and hasattr(scene_module, 'update_frame'):
+        scene_cache = False
+    
+    raster.notify_phase("setup")
+    key = setup_key(raster)
+    if scene_cache and load_compiled_scene(compiled_file, raster, key):
+        print(f"Loaded compiled scene {compiled_file} in {time.time() - start_time:.2f} seconds")
+    else:
+        print(f"Setting up scene from {scene_file}...")
+        before = settings_snapshot(raster)
+        scene_module.setup_scene(raster)
+        if scene_cache:
+            size = compile_scene(compiled_file, raster, scene_file, key, before)
+            print(f"Compiled scene to {compiled_file} ({size // 1024} KiB of geometry)")
     
     output_file = f"{scene_name}.png"
+    gbuffer_file = f"{scene_name}.gbuffer.npz"
+    
+    if relight:
+        # Only the light rig may differ from the render that wrote the G-buffer
+        gbuffer = GBuffer.load(gbuffer_file)
+        if gbuffer is not None and gbuffer.matches(raster):
+            raster.draw_relit(gbuffer, output_file, gbuffer_file)
+            print(f"Total execution time: {time.time() - start_time:.2f} seconds")
+            return time.time() - start_time
+        print(f"No usable G-buffer in {gbuffer_file} for this scene, rendering in full")
+        save_gbuffer = True
     
-    if preview:
+    if frames:
+        # Scenes animate themselves through update_frame; anything else gets a turntable
+        update_frame = getattr(scene_module, 'update_frame', None) or make_turntable(raster)
+        try:
+            raster.render_animation(frames, update_frame, f"{scene_name}_{{:04d}}.png")
+        except KeyboardInterrupt:
+            print("Rendering interrupted")
+            return 0
+    elif preview:
         print(f"Rendering preview (scale={preview_scale}, depth={preview_depth})...")
         raster.render_preview(
             scale=preview_scale, 
@@ -42,7 +116,18 @@ def run_scene(scene_file, width=800, height=600, preview=False, preview_scale=0.
             samples=samples
         )
     else:
-        raster.run(output_file)
+        # Full renders checkpoint finished tiles next to the output so a killed job can resume
+        raster.checkpoint = True
+        try:
+            raster.run(output_file, resume=resume)
+            if save_gbuffer:
+                raster.save_gbuffer(gbuffer_file)
+        except KeyboardInterrupt:
+            print("Rendering interrupted")
+            return 0
+        except TimeoutError as e:
+            print(f"Rendering stopped: {e}")
+            return 0
     
     end_time = time.time()
     time_taken = end_time - start_time
@@ -69,8 +154,34 @@ if __name__ == "__main__":
             print("  --preview [scale]    Render a preview (default scale: 0.25)")
             print("  --depth N            Set recursion depth for preview (default: 2)")
             print("  --progress           Show detailed progress updates")
+            print("  --backend NAME       Rendering backend: recursive or wavefront (default: recursive)")
+            print("  --tile-size N        Edge length of the render tiles in pixels (default: 32)")
+            print("  --tile-order NAME    Tile order: spiral, hilbert or scanline (default: spiral)")
+            print("  --scene-distribution MODE  How workers receive the scene: shared or pickle (default: shared)")
+            print("  --adaptive           Spend extra samples only on noisy pixels")
+            print("  --min-samples N      Initial samples per pixel in adaptive mode (default: 4)")
+            print("  --max-samples N      Sample limit per pixel in adaptive mode (default: 64)")
+            print("  --noise-threshold X  Standard error (0-255 scale) a pixel must reach to stop early (default: 2.0)")
+            print("  --progressive [s]    Refine from 16x16 blocks and write scene_progress.png every s seconds (default: 2)")
+            print("  --resume             Continue an interrupted render from its .checkpoint file")
+            print("  --save-gbuffer       Also store the primary hits in scene.gbuffer.npz for later relighting")
+            print("  --relight            Re-shade scene.gbuffer.npz with the scene's current lights instead of a full render")
+            print("  --frames N           Render N animation frames as scene_0000.png, ... (turntable unless the scene has update_frame)")
+            print("  --no-scene-cache     Always run setup_scene instead of loading scene.scene compiled by an earlier run")
+            print("  --light-samples N    Shadow rays per hit for scenes with more than N lights, picked by importance (default: 0, all lights)")
+            print("  --min-contribution X Stop reflection and refraction rays whose share of the pixel is below X (default: 0)")
+            print("  --roulette-depth N   Russian roulette on reflection and refraction rays from depth N on (default: 0, off)")
+            print("  --branch-sampling    Trace either the reflection or the refraction ray at glass, not both")
+            print("  --stats              Count rays by kind and intersection tests by primitive type")
+            print("  --heatmap            Also save the time spent per pixel as scene_cost.png (implies --stats)")
+            print("  --telemetry TARGET   Append JSON progress lines to a file, unix:/path or tcp:host:port")
+            print("  --telemetry-interval S  Seconds between telemetry progress lines (default: 5)")
+            print("  --serve [HOST]:PORT  Hand the tiles to workers started with distributed.py instead of local processes")
+            print("  --serve-timeout S    Stop a served render after S seconds without any worker (default: 600)")
             print("\nExamples:")
             print("  python main.py scene_glass 800 600 --preview 0.2")
+            print("  python main.py scene_glass 800 600 --adaptive --max-samples 128")
+            print("  python main.py scene_glass 400 300 --frames 36")
             sys.exit(0)
     else:
         print("Usage: python main.py scene_file [width height] [options]")
@@ -102,4 +213,112 @@ if __name__ == "__main__":
     else:
         samples = 1
     
-    run_scene(scene_file, width, height, preview_mode, preview_scale, preview_depth)
\ No newline at end of file
+    backend = "recursive"
+    if '--backend' in sys.argv:
+        idx = sys.argv.index('--backend')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1] in ('recursive', 'wavefront'):
+            backend = sys.argv[idx + 1]
+    
+    tile_size = 32
+    if '--tile-size' in sys.argv:
+        idx = sys.argv.index('--tile-size')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].isdigit():
+            tile_size = max(1, int(sys.argv[idx + 1]))
+    
+    tile_order = "spiral"
+    if '--tile-order' in sys.argv:
+        idx = sys.argv.index('--tile-order')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1] in ('spiral', 'hilbert', 'scanline'):
+            tile_order = sys.argv[idx + 1]
+    
+    scene_distribution = "shared"
+    if '--scene-distribution' in sys.argv:
+        idx = sys.argv.index('--scene-distribution')
+        if idx + 1 < len(sys.argv):
+            scene_distribution = sys.argv[idx + 1]
+        if scene_distribution not in ('shared', 'pickle'):
+            print(f"Error: Unknown scene distribution '{scene_distribution}', choose shared or pickle")
+            sys.exit(1)
+    
+    adaptive = '--adaptive' in sys.argv
+    
+    min_samples = 4
+    if '--min-samples' in sys.argv:
+        idx = sys.argv.index('--min-samples')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].isdigit():
+            min_samples = max(1, int(sys.argv[idx + 1]))
+    
+    max_samples = 64
+    if '--max-samples' in sys.argv:
+        idx = sys.argv.index('--max-samples')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].isdigit():
+            max_samples = max(1, int(sys.argv[idx + 1]))
+    
+    noise_threshold = 2.0
+    if '--noise-threshold' in sys.argv:
+        idx = sys.argv.index('--noise-threshold')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].replace('.', '', 1).isdigit():
+            noise_threshold = float(sys.argv[idx + 1])
+    
+    progressive = False
+    preview_interval = 2.0
+    if '--progressive' in sys.argv:
+        progressive = True
+        idx = sys.argv.index('--progressive')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].replace('.', '', 1).isdigit():
+            preview_interval = float(sys.argv[idx + 1])
+    
+    frames = 0
+    if '--frames' in sys.argv:
+        idx = sys.argv.index('--frames')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].isdigit():
+            frames = int(sys.argv[idx + 1])
+    
+    light_samples = 0
+    if '--light-samples' in sys.argv:
+        idx = sys.argv.index('--light-samples')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].isdigit():
+            light_samples = int(sys.argv[idx + 1])
+    
+    min_contribution = 0.0
+    if '--min-contribution' in sys.argv:
+        idx = sys.argv.index('--min-contribution')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].replace('.', '', 1).isdigit():
+            min_contribution = float(sys.argv[idx + 1])
+    
+    roulette_depth = 0
+    if '--roulette-depth' in sys.argv:
+        idx = sys.argv.index('--roulette-depth')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].isdigit():
+            roulette_depth = int(sys.argv[idx + 1])
+    
+    telemetry = None
+    if '--telemetry' in sys.argv:
+        idx = sys.argv.index('--telemetry')
+        if idx + 1 < len(sys.argv):
+            telemetry = sys.argv[idx + 1]
+    
+    telemetry_interval = 5.0
+    if '--telemetry-interval' in sys.argv:
+        idx = sys.argv.index('--telemetry-interval')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].replace('.', '', 1).isdigit():
+            telemetry_interval = max(0.1, float(sys.argv[idx + 1]))
+    
+    serve_address = None
+    if '--serve' in sys.argv:
+        idx = sys.argv.index('--serve')
+        if idx + 1 < len(sys.argv):
+            serve_address = sys.argv[idx + 1]
+    
+    serve_timeout = 600.0
+    if '--serve-timeout' in sys.argv:
+        idx = sys.argv.index('--serve-timeout')
+        if idx + 1 < len(sys.argv) and sys.argv[idx + 1].replace('.', '', 1).isdigit():
+            serve_timeout = float(sys.argv[idx + 1])
+    
+    run_scene(scene_file, width, height, preview_mode, preview_scale, preview_depth, backend, tile_size, tile_order,
+              scene_distribution, adaptive, min_samples, max_samples, noise_threshold, progressive, preview_interval,
+              '--resume' in sys.argv, frames, '--save-gbuffer' in sys.argv, '--relight' in sys.argv,
+              '--no-scene-cache' not in sys.argv, light_samples, min_contribution, roulette_depth,
+              '--branch-sampling' in sys.argv, '--stats' in sys.argv, '--heatmap' in sys.argv,
+              telemetry, telemetry_interval, serve_address, serve_timeout)
\ No newline at end of file
@@ -0,0 +1,238 @@
+import os
+import re
+import numpy as np
+from ray import Material
+from triangle_mesh import TriangleMesh
+from scene_cache import record_data_file
+
+CHUNK_LINES = 1 << 16
+CHUNK_RECORDS = 1 << 18
+DEFAULT_MATERIAL = Material((200, 200, 200))
+
+# First integer of every whitespace separated token, i.e. the vertex index of "7", "7/2" or "7//3"
+FACE_INDEX = re.compile(rb"(?<!\S)-?\d+")
+
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+
+# Collects vertex and face chunks into one TriangleMesh; faces are numbered against the
+# vertices read so far, so OBJ's negative indices resolve chunk by chunk
+class MeshAssembler:
+    def __init__(self, material=None, group_materials=None):
+        self.materials = [material or DEFAULT_MATERIAL]
+        self.group_materials = group_materials or {}
+        self.material_index = {}
+        self.vertex_chunks = []
+        self.index_chunks = []
+        self.material_chunks = []
+        self.vertex_count = 0
+
+    def material_id(self, name):
+        material = self.group_materials.get(name)
+        if material is None:
+            return 0
+        if id(material) not in self.material_index:
+            self.material_index[id(material)] = len(self.materials)
+            self.materials.append(material)
+        return self.material_index[id(material)]
+
+    def add_vertices(self, vertices):
+        if len(vertices):
+            self.vertex_chunks.append(np.ascontiguousarray(vertices, dtype=np.float64))
+            self.vertex_count += len(vertices)
+
+    def add_polygons(self, indices, counts, material_ids):
+        # indices holds the zero-based corners of polygons with counts corners each; polygons
+        # are split into fans around their first corner
+        counts = np.asarray(counts, dtype=np.int64)
+        keep = counts >= 3
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[keep]
+        fans = counts[keep] - 2
+        if not len(fans):
+            return
+        first = np.repeat(starts, fans)
+        step = np.arange(fans.sum()) - np.repeat(np.cumsum(fans) - fans, fans)
+        triangles = np.stack((indices[first], indices[first + step + 1], indices[first + step + 2]), axis=1)
+        self.index_chunks.append(triangles.astype(np.int32))
+        self.material_chunks.append(np.repeat(np.asarray(material_ids, dtype=np.uint16)[keep], fans))
+
+    def mesh(self, path):
+        vertices = np.concatenate(self.vertex_chunks) if self.vertex_chunks else np.zeros((0, 3))
+        indices = np.concatenate(self.index_chunks) if self.index_chunks else np.zeros((0, 3), dtype=np.int32)
+        material_ids = np.concatenate(self.material_chunks) if self.material_chunks else np.zeros(0, dtype=np.uint16)
+        self.vertex_chunks = self.index_chunks = self.material_chunks = []
+        if not len(indices):
+            raise ValueError(f"{path} contains no faces")
+        if indices.min() < 0 or indices.max() >= len(vertices):
+            raise ValueError(f"{path} has faces that refer to missing vertices")
+        return TriangleMesh(vertices, indices, self.materials, material_ids)
+
+
+def load_obj(path, material=None, group_materials=None):
+    # Positions and faces only, polygons as fans; group_materials maps usemtl, group or
+    # object names to the material of the faces that follow
+    assembler = MeshAssembler(material, group_materials)
+    current = 0
+
+    def flush(lines):
+        nonlocal current
+        vertex_lines = []
+        face_lines = []
+        face_bases = []
+        face_materials = []
+        for line in lines:
+            tag = line[:2]
+            if tag == b"v " or tag == b"v\t":
+                vertex_lines.append(line[2:])
+            elif tag == b"f " or tag == b"f\t":
+                face_lines.append(line[2:])
+                face_bases.append(assembler.vertex_count + len(vertex_lines))
+                face_materials.append(current)
+            elif line.startswith((b"usemtl", b"g ", b"o ")):
+                parts = line.split(None, 1)
+                name = parts[1].strip().decode("utf-8", "replace") if len(parts) > 1 else ""
+                # usemtl always switches material; groups and objects only when they are mapped
+                if line.startswith(b"usemtl") or name in assembler.group_materials:
+                    current = assembler.material_id(name)
+
+        if vertex_lines:
+            values = b" ".join(vertex_lines).split()
+            widths = {len(line.split()) for line in vertex_lines}
+            if len(widths) == 1:
+                vertices = np.array(values, dtype=np.float64).reshape(len(vertex_lines), -1)[:, :3]
+            else:
+                vertices = np.array([[float(v) for v in line.split()[:3]] for line in vertex_lines])
+            assembler.add_vertices(vertices)
+
+        if face_lines:
+            counts = np.array([len(line.split()) for line in face_lines], dtype=np.int64)
+            indices = np.array(FACE_INDEX.findall(b"\n".join(face_lines)), dtype=np.int64)
+            if len(indices) != counts.sum():
+                raise ValueError(f"{path} has a face line that cannot be read")
+            bases = np.repeat(np.array(face_bases, dtype=np.int64), counts)
+            # Positive indices count from 1, negative ones back from the last vertex read
+            indices = np.where(indices < 0, bases + indices, indices - 1)
+            assembler.add_polygons(indices, counts, face_materials)
+
+    with open(path, "rb") as f:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) >= CHUNK_LINES:
+                flush(lines)
+                lines = []
+        flush(lines)
+    return assembler.mesh(path)
+
+
+def read_ply_header(f, path):
+    if f.readline().strip() != b"ply":
+        raise ValueError(f"{path} is not a PLY file")
+    elements = []
+    endian = None
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError(f"{path} ends inside its header")
+        parts = line.decode("ascii", "replace").split()
+        if not parts or parts[0] in ("comment", "obj_info"):
+            continue
+        if parts[0] == "end_header":
+            break
+        if parts[0] == "format":
+            if parts[1] == "binary_little_endian":
+                endian = "<"
+            elif parts[1] == "binary_big_endian":
+                endian = ">"
+            else:
+                raise ValueError(f"{path} is {parts[1]} PLY; only binary PLY is supported")
+        elif parts[0] == "element":
+            elements.append((parts[1], int(parts[2]), []))
+        elif parts[0] == "property" and parts[1] == "list":
+            elements[-1][2].append((parts[4], PLY_TYPES[parts[2]], PLY_TYPES[parts[3]]))
+        elif parts[0] == "property":
+            elements[-1][2].append((parts[2], PLY_TYPES[parts[1]], None))
+    if endian is None:
+        raise ValueError(f"{path} has no format line")
+    return endian, elements
+
+
+def load_ply(path, material=None):
+    # Binary PLY read block by block straight into numpy arrays; polygons as fans
+    assembler = MeshAssembler(material)
+    with open(path, "rb") as f:
+        endian, elements = read_ply_header(f, path)
+        for name, count, properties in elements:
+            if name == "vertex":
+                read_ply_vertices(f, endian, count, properties, assembler, path)
+            elif name == "face":
+                read_ply_faces(f, endian, count, properties, assembler, path)
+            elif any(list_type for _, _, list_type in properties):
+                raise ValueError(f"{path}: cannot skip the list properties of element {name}")
+            else:
+                f.seek(count * np.dtype([(p, endian + t) for p, t, _ in properties]).itemsize, os.SEEK_CUR)
+    return assembler.mesh(path)
+
+
+def read_ply_vertices(f, endian, count, properties, assembler, path):
+    if any(list_type for _, _, list_type in properties):
+        raise ValueError(f"{path}: vertex elements with list properties are not supported")
+    record = np.dtype([(p, endian + t) for p, t, _ in properties])
+    vertices = np.empty((count, 3), dtype=np.float64)
+    for start in range(0, count, CHUNK_RECORDS):
+        block = np.fromfile(f, dtype=record, count=min(CHUNK_RECORDS, count - start))
+        if len(block) < min(CHUNK_RECORDS, count - start):
+            raise ValueError(f"{path} ends inside its vertices")
+        for axis, field in enumerate("xyz"):
+            vertices[start:start + len(block), axis] = block[field]
+    assembler.add_vertices(vertices)
+
+
+def read_ply_faces(f, endian, count, properties, assembler, path):
+    lists = [p for p, _, list_type in properties if list_type]
+    if lists not in (["vertex_indices"], ["vertex_index"]):
+        raise ValueError(f"{path}: faces need exactly one vertex_indices list")
+
+    # Faces are read in blocks of records with the corner count of the face at hand; a block
+    # is used up to the first face with a different count and the next one starts there
+    prefix = [(p, endian + t) for p, t, _ in properties[:next(i for i, (_, _, lt) in enumerate(properties) if lt)]]
+    list_index = len(prefix)
+    count_type = endian + properties[list_index][1]
+    head = np.dtype(prefix + [("corner_count", count_type)])
+    done = 0
+    size = 1024
+    while done < count:
+        position = f.tell()
+        peek = np.fromfile(f, dtype=head, count=1)
+        if not len(peek):
+            raise ValueError(f"{path} ends inside its faces")
+        corners = int(peek['corner_count'][0])
+        fields = prefix + [("corner_count", count_type), ("corners", endian + properties[list_index][2], (corners,))]
+        fields += [(p, endian + t) for p, t, _ in properties[list_index + 1:]]
+        record = np.dtype(fields)
+
+        f.seek(position)
+        block = np.fromfile(f, dtype=record, count=min(size, count - done))
+        other = np.nonzero(block['corner_count'] != corners)[0]
+        usable = int(other[0]) if len(other) else len(block)
+        if not usable:
+            raise ValueError(f"{path} ends inside its faces")
+        assembler.add_polygons(block['corners'][:usable].astype(np.int64).ravel(), np.full(usable, corners), np.zeros(usable))
+        done += usable
+        f.seek(position + usable * record.itemsize)
+        size = min(CHUNK_RECORDS, size * 2) if usable == len(block) else max(16, usable * 2)
+
+
+def load_mesh(path, material=None, group_materials=None):
+    record_data_file(path)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".obj":
+        return load_obj(path, material, group_materials)
+    if extension == ".ply":
+        return load_ply(path, material)
+    raise ValueError(f"Unsupported mesh format: {path}")
@@ -1,4 +1,8 @@
 import math
+import numpy as np
+from vector import Vector
+from ray_batch import INF, EPSILON, dot, cross, normalize
+from instancing import rotation_matrix
 
 class Ray:
     @staticmethod
@@ -10,6 +14,14 @@ class Ray:
             if obj == ignore_object:
                 continue
             
+            # Aggregates such as meshes report which of their parts was hit
+            if hasattr(obj, 'cast'):
+                part, t = obj.cast(ray_origin, ray_direction, max_distance)
+                if part is not None and t < closest_t:
+                    closest_t = t
+                    closest_obj = part
+                continue
+            
             t = obj.intersects(ray_origin, ray_direction)
             
             if t and t < closest_t and t < max_distance:
@@ -18,6 +30,59 @@ class Ray:
 
         return closest_obj, closest_t
 
+    @staticmethod
+    def transparency_of(obj):
+        material = obj.get_material() if hasattr(obj, 'get_material') else None
+        return getattr(material, 'transparency', 0.0)
+
+    @staticmethod
+    def collect_occlusion(obj, ray_origin, ray_direction, max_distance, hits):
+        # Adds the object's transparent hits to hits; False as soon as anything opaque blocks the segment
+        if hasattr(obj, 'occluders'):
+            found = obj.occluders(ray_origin, ray_direction, max_distance)
+            if found is None:
+                return False
+            hits.extend(found)
+            return True
+
+        transparency = Ray.transparency_of(obj)
+        if transparency <= 0:
+            t = obj.intersects(ray_origin, ray_direction)
+            return not (t and t < max_distance)
+
+        if hasattr(obj, 'intersections'):
+            found = obj.intersections(ray_origin, ray_direction)
+        else:
+            t = obj.intersects(ray_origin, ray_direction)
+            found = [t] if t else []
+        for t in found:
+            if t < max_distance:
+                hits.append((t, transparency))
+        return True
+
+    @staticmethod
+    def combine_transmittance(hits):
+        # Surfaces less than 0.001 behind the last counted one are skipped, like stepping past
+        # each occluder did, so a ray through a shared triangle edge is not dimmed twice
+        transmittance = 1.0
+        last_t = -1.0
+        for t, transparency in sorted(hits):
+            if t <= last_t + 0.001:
+                continue
+            transmittance *= transparency
+            if transmittance < 0.01:
+                return 0.0
+            last_t = t
+        return transmittance
+
+    @staticmethod
+    def transmittance(objects, ray_origin, ray_direction, max_distance=float("inf")):
+        hits = []
+        for obj in objects:
+            if not Ray.collect_occlusion(obj, ray_origin, ray_direction, max_distance, hits):
+                return 0.0
+        return Ray.combine_transmittance(hits)
+
 
 class Material:
     def __init__(self, color, reflectivity=0.0, transparency=0.0, refractive_index=1.0):
@@ -32,6 +97,52 @@ class Material:
             self.transparency /= total
 
 
+# Squares in the two world axes closest to the surface at the hit; without a hit point,
+# and for shadow rays, it stands for material1, so both must share their transparency
+class CheckerMaterial:
+    def __init__(self, material1, material2, size):
+        if material1.transparency != material2.transparency:
+            raise ValueError("Both checker materials need the same transparency")
+        self.material1 = material1
+        self.material2 = material2
+        self.size = size
+    
+    @property
+    def color(self):
+        return self.material1.color
+    
+    @property
+    def reflectivity(self):
+        return self.material1.reflectivity
+    
+    @property
+    def transparency(self):
+        return self.material1.transparency
+    
+    @property
+    def refractive_index(self):
+        return self.material1.refractive_index
+    
+    def material_at(self, point, normal):
+        coords = (point.x, point.y, point.z)
+        extent = (abs(normal.x), abs(normal.y), abs(normal.z))
+        drop = 0
+        for axis in (1, 2):
+            if extent[axis] > extent[drop]:
+                drop = axis
+        a, b = (coords[axis] for axis in range(3) if axis != drop)
+        if (math.floor(a / self.size) + math.floor(b / self.size)) % 2 == 0:
+            return self.material1
+        return self.material2
+    
+    def first_at(self, points, normals):
+        # material_at for (R, 3) arrays; True where the first material applies
+        drop = np.abs(normals).argmax(axis=1)
+        cells = np.floor(points / self.size)
+        total = cells.sum(axis=1) - cells[np.arange(len(points)), drop]
+        return total % 2 == 0
+
+
 class EnhancedSphere:
     def __init__(self, center, radius, material):
         self.center = center
@@ -59,8 +170,29 @@ class EnhancedSphere:
             return t2
         return None
 
+    def intersections(self, ray_origin, ray_direction):
+        # Both surface crossings in front of the origin; a shadow ray passes through the entry and the exit
+        oc = ray_origin - self.center
+        
+        a = ray_direction.dot(ray_direction)
+        b = 2.0 * oc.dot(ray_direction)
+        c = oc.dot(oc) - self.radius ** 2
+        discriminant = b * b - 4 * a * c
+
+        if discriminant < 0:
+            return []
+
+        t1 = (-b - math.sqrt(discriminant)) / (2.0 * a)
+        t2 = (-b + math.sqrt(discriminant)) / (2.0 * a)
+        return [t for t in (t1, t2) if t > 0]
+
     def get_normal(self, point):
         return (point - self.center).normalize()
+
+    def get_bounds(self):
+        r = abs(self.radius)
+        return (Vector(self.center.x - r, self.center.y - r, self.center.z - r),
+                Vector(self.center.x + r, self.center.y + r, self.center.z + r))
     
     def get_material(self):
         return self.material
@@ -109,8 +241,374 @@ class EnhancedTriangle:
 
         return None
     
+    def get_normal(self, _):
+        return self.normal
+
+    def get_bounds(self):
+        return (Vector(min(self.v0.x, self.v1.x, self.v2.x),
+                       min(self.v0.y, self.v1.y, self.v2.y),
+                       min(self.v0.z, self.v1.z, self.v2.z)),
+                Vector(max(self.v0.x, self.v1.x, self.v2.x),
+                       max(self.v0.y, self.v1.y, self.v2.y),
+                       max(self.v0.z, self.v1.z, self.v2.z)))
+    
+    def get_material(self):
+        return self.material
+
+def vector_array(v):
+    return np.array((v.x, v.y, v.z), dtype=np.float64)
+
+
+# Infinite plane through point; the normal decides which side is lit, as for triangles.
+# The analytic primitives pair scalar intersects with intersect_rays/normals_at on (R, 3)
+# arrays for the wavefront backend, which return inf for misses.
+class EnhancedPlane:
+    def __init__(self, point, normal, material):
+        self.point = point
+        self.normal = normal.normalize()
+        self.material = material
+        self.color = material.color
+    
+    def plane_distance(self, ray_origin, ray_direction):
+        denom = ray_direction.dot(self.normal)
+        if -EPSILON < denom < EPSILON:
+            return None
+        t = (self.point - ray_origin).dot(self.normal) / denom
+        if t > EPSILON:
+            return t
+        return None
+    
+    def plane_distances(self, origins, directions):
+        normal = vector_array(self.normal)
+        denom = dot(directions, normal)
+        parallel = (denom > -EPSILON) & (denom < EPSILON)
+        t = dot(vector_array(self.point) - origins, normal) / np.where(parallel, 1.0, denom)
+        return np.where(~parallel & (t > EPSILON), t, INF)
+    
+    def intersects(self, ray_origin, ray_direction):
+        return self.plane_distance(ray_origin, ray_direction)
+    
+    def intersect_rays(self, origins, directions):
+        return self.plane_distances(origins, directions)
+    
+    def get_normal(self, _):
+        return self.normal
+    
+    def normals_at(self, points):
+        return np.tile(vector_array(self.normal), (len(points), 1))
+    
+    def get_bounds(self):
+        return Vector(-INF, -INF, -INF), Vector(INF, INF, INF)
+    
+    def get_material(self):
+        return self.material
+
+
+class EnhancedDisk(EnhancedPlane):
+    def __init__(self, center, normal, radius, material):
+        self.center = center
+        self.normal = normal.normalize()
+        self.radius = radius
+        self.material = material
+        self.color = material.color
+    
+    @property
+    def point(self):
+        return self.center
+    
+    def intersects(self, ray_origin, ray_direction):
+        t = self.plane_distance(ray_origin, ray_direction)
+        if t is None:
+            return None
+        offset = ray_origin + ray_direction * t - self.center
+        if offset.dot(offset) <= self.radius * self.radius:
+            return t
+        return None
+    
+    def intersect_rays(self, origins, directions):
+        t = self.plane_distances(origins, directions)
+        hit = t < INF
+        offset = origins + directions * np.where(hit, t, 0.0)[:, None] - vector_array(self.center)
+        return np.where(hit & (dot(offset, offset) <= self.radius * self.radius), t, INF)
+    
+    def get_bounds(self):
+        # Along each axis the disk reaches less far the more its normal points that way
+        c = self.center
+        ex, ey, ez = (self.radius * math.sqrt(max(0.0, 1.0 - n * n)) for n in (self.normal.x, self.normal.y, self.normal.z))
+        return Vector(c.x - ex, c.y - ey, c.z - ez), Vector(c.x + ex, c.y + ey, c.z + ez)
+
+
+# Parallelogram corner + u * edge1 + v * edge2, 0 <= u, v <= 1: the triangle test without
+# the u + v <= 1 limit
+class EnhancedQuad:
+    def __init__(self, corner, edge1, edge2, material):
+        self.corner = corner
+        self.edge1 = edge1
+        self.edge2 = edge2
+        self.material = material
+        self.color = material.color
+        self.normal = edge1.cross(edge2).normalize()
+    
+    def intersects(self, ray_origin, ray_direction):
+        h = ray_direction.cross(self.edge2)
+        a = self.edge1.dot(h)
+        
+        if -EPSILON < a < EPSILON:
+            return None
+        
+        f = 1.0 / a
+        s = ray_origin - self.corner
+        u = f * s.dot(h)
+        
+        if u < 0.0 or u > 1.0:
+            return None
+        
+        q = s.cross(self.edge1)
+        v = f * ray_direction.dot(q)
+        
+        if v < 0.0 or v > 1.0:
+            return None
+        
+        t = f * self.edge2.dot(q)
+        
+        if t > EPSILON:
+            return t
+        
+        return None
+    
+    def intersect_rays(self, origins, directions):
+        edge1, edge2 = vector_array(self.edge1), vector_array(self.edge2)
+        h = cross(directions, edge2)
+        a = dot(edge1, h)
+        parallel = (a > -EPSILON) & (a < EPSILON)
+        f = 1.0 / np.where(parallel, 1.0, a)
+        s = origins - vector_array(self.corner)
+        u = f * dot(s, h)
+        q = cross(s, edge1)
+        v = f * dot(directions, q)
+        t = f * dot(edge2, q)
+        valid = ~parallel & (u >= 0.0) & (u <= 1.0) & (v >= 0.0) & (v <= 1.0) & (t > EPSILON)
+        return np.where(valid, t, INF)
+    
     def get_normal(self, _):
         return self.normal
     
+    def normals_at(self, points):
+        return np.tile(vector_array(self.normal), (len(points), 1))
+    
+    def get_bounds(self):
+        corners = (self.corner, self.corner + self.edge1, self.corner + self.edge2, self.corner + self.edge1 + self.edge2)
+        return (Vector(min(c.x for c in corners), min(c.y for c in corners), min(c.z for c in corners)),
+                Vector(max(c.x for c in corners), max(c.y for c in corners), max(c.z for c in corners)))
+    
     def get_material(self):
-        return self.material
\ No newline at end of file
+        return self.material
+
+
+# Box turned by rotation degrees about its center (scene_utils.rotate_vertex order),
+# slab-tested in its own frame
+class EnhancedBox:
+    def __init__(self, min_corner, max_corner, material, rotation=(0, 0, 0)):
+        self.center = (min_corner + max_corner) * 0.5
+        self.half_sizes = tuple(abs(v) * 0.5 for v in (max_corner.x - min_corner.x, max_corner.y - min_corner.y,
+                                                       max_corner.z - min_corner.z))
+        m = rotation_matrix(rotation)
+        self.axes = (Vector(m[0], m[3], m[6]), Vector(m[1], m[4], m[7]), Vector(m[2], m[5], m[8]))
+        self.material = material
+        self.color = material.color
+    
+    def slabs(self, ray_origin, ray_direction):
+        # Entry and exit distance along the ray, None when it misses
+        oc = ray_origin - self.center
+        near, far = -INF, INF
+        for axis, half in zip(self.axes, self.half_sizes):
+            o = oc.dot(axis)
+            d = ray_direction.dot(axis)
+            if d == 0:
+                if abs(o) > half:
+                    return None
+                continue
+            t0 = (-half - o) / d
+            t1 = (half - o) / d
+            if t0 > t1:
+                t0, t1 = t1, t0
+            near = max(near, t0)
+            far = min(far, t1)
+        if near > far:
+            return None
+        return near, far
+    
+    def intersects(self, ray_origin, ray_direction):
+        span = self.slabs(ray_origin, ray_direction)
+        if span is None:
+            return None
+        for t in span:
+            if t > EPSILON:
+                return t
+        return None
+    
+    def intersections(self, ray_origin, ray_direction):
+        span = self.slabs(ray_origin, ray_direction)
+        return [t for t in span if t > EPSILON] if span else []
+    
+    def intersect_rays(self, origins, directions):
+        oc = origins - vector_array(self.center)
+        near = np.full(len(origins), -INF)
+        far = np.full(len(origins), INF)
+        for axis, half in zip(self.axes, self.half_sizes):
+            axis = vector_array(axis)
+            o = dot(oc, axis)
+            d = dot(directions, axis)
+            parallel = d == 0
+            safe = np.where(parallel, 1.0, d)
+            t0 = (-half - o) / safe
+            t1 = (half - o) / safe
+            outside = np.abs(o) > half
+            near = np.maximum(near, np.where(parallel, np.where(outside, INF, -INF), np.minimum(t0, t1)))
+            far = np.minimum(far, np.where(parallel, np.where(outside, -INF, INF), np.maximum(t0, t1)))
+        t = np.where(near > EPSILON, near, np.where(far > EPSILON, far, INF))
+        return np.where(near > far, INF, t)
+    
+    def get_normal(self, point):
+        # The face of the slab the point is furthest out in, measured in half sizes
+        offset = point - self.center
+        best = -1.0
+        normal = None
+        for axis, half in zip(self.axes, self.half_sizes):
+            o = offset.dot(axis)
+            ratio = abs(o) / half if half > 0 else INF
+            if ratio > best:
+                best = ratio
+                normal = axis if o >= 0 else axis * -1
+        return normal
+    
+    def normals_at(self, points):
+        offset = points - vector_array(self.center)
+        axes = np.array([vector_array(axis) for axis in self.axes])
+        o = np.stack([dot(offset, axis) for axis in axes], axis=1)
+        halves = np.array(self.half_sizes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(halves > 0, np.abs(o) / np.where(halves > 0, halves, 1.0), INF)
+        face = ratio.argmax(axis=1)
+        sign = np.where(o[np.arange(len(points)), face] >= 0, 1.0, -1.0)
+        return axes[face] * sign[:, None]
+    
+    def get_bounds(self):
+        c = self.center
+        extent = [sum(abs(component) * half for component, half in zip(components, self.half_sizes))
+                  for components in ((a.x for a in self.axes), (a.y for a in self.axes), (a.z for a in self.axes))]
+        return Vector(c.x - extent[0], c.y - extent[1], c.z - extent[2]), Vector(c.x + extent[0], c.y + extent[1], c.z + extent[2])
+    
+    def get_material(self):
+        return self.material
+
+
+# Cylinder around the segment start-end; without caps only the tube is there
+class EnhancedCylinder:
+    def __init__(self, start, end, radius, material, capped=True):
+        self.start = start
+        self.end = end
+        self.height = (end - start).magnitude()
+        self.axis = (end - start).normalize()
+        self.radius = radius
+        self.capped = capped
+        self.material = material
+        self.color = material.color
+    
+    def intersections(self, ray_origin, ray_direction):
+        # The ray is split into its parts along the axis and across it; the tube is a circle
+        # in the cross section and the caps are planes along the axis
+        oc = ray_origin - self.start
+        da = ray_direction.dot(self.axis)
+        oa = oc.dot(self.axis)
+        dp = ray_direction - self.axis * da
+        op = oc - self.axis * oa
+        r2 = self.radius * self.radius
+        hits = []
+        
+        a = dp.dot(dp)
+        if a > 0:
+            b = 2.0 * op.dot(dp)
+            c = op.dot(op) - r2
+            discriminant = b * b - 4 * a * c
+            if discriminant >= 0:
+                root = math.sqrt(discriminant)
+                for t in ((-b - root) / (2.0 * a), (-b + root) / (2.0 * a)):
+                    s = oa + da * t
+                    if 0 <= s <= self.height:
+                        hits.append(t)
+        
+        if self.capped and da != 0:
+            for s in (0.0, self.height):
+                t = (s - oa) / da
+                offset = op + dp * t
+                if offset.dot(offset) <= r2:
+                    hits.append(t)
+        
+        return sorted(t for t in hits if t > EPSILON)
+    
+    def intersects(self, ray_origin, ray_direction):
+        hits = self.intersections(ray_origin, ray_direction)
+        return hits[0] if hits else None
+    
+    def intersect_rays(self, origins, directions):
+        axis = vector_array(self.axis)
+        oc = origins - vector_array(self.start)
+        da = dot(directions, axis)
+        oa = dot(oc, axis)
+        dp = directions - axis * da[:, None]
+        op = oc - axis * oa[:, None]
+        r2 = self.radius * self.radius
+        candidates = []
+        
+        a = dot(dp, dp)
+        b = 2.0 * dot(op, dp)
+        c = dot(op, op) - r2
+        discriminant = b * b - 4 * a * c
+        tube = (a > 0) & (discriminant >= 0)
+        root = np.sqrt(np.where(tube, discriminant, 0.0))
+        two_a = 2.0 * np.where(tube, a, 1.0)
+        for t in ((-b - root) / two_a, (-b + root) / two_a):
+            s = oa + da * t
+            candidates.append(np.where(tube & (s >= 0) & (s <= self.height), t, INF))
+        
+        if self.capped:
+            axial = da != 0
+            for s in (0.0, self.height):
+                t = (s - oa) / np.where(axial, da, 1.0)
+                offset = op + dp * t[:, None]
+                candidates.append(np.where(axial & (dot(offset, offset) <= r2), t, INF))
+        
+        t = np.stack(candidates, axis=1)
+        return np.where(t > EPSILON, t, INF).min(axis=1)
+    
+    def get_normal(self, point):
+        offset = point - self.start
+        s = offset.dot(self.axis)
+        tolerance = 1e-7 * max(1.0, self.height)
+        if self.capped and s <= tolerance:
+            return self.axis * -1
+        if self.capped and s >= self.height - tolerance:
+            return self.axis
+        return (offset - self.axis * s).normalize()
+    
+    def normals_at(self, points):
+        axis = vector_array(self.axis)
+        offset = points - vector_array(self.start)
+        s = dot(offset, axis)
+        normals = normalize(offset - axis * s[:, None])
+        if self.capped:
+            tolerance = 1e-7 * max(1.0, self.height)
+            normals[s >= self.height - tolerance] = axis
+            normals[s <= tolerance] = axis * -1
+        return normals
+    
+    def get_bounds(self):
+        # Each end is a disk across the axis
+        ex, ey, ez = (self.radius * math.sqrt(max(0.0, 1.0 - n * n)) for n in (self.axis.x, self.axis.y, self.axis.z))
+        lo = Vector(min(self.start.x, self.end.x) - ex, min(self.start.y, self.end.y) - ey, min(self.start.z, self.end.z) - ez)
+        hi = Vector(max(self.start.x, self.end.x) + ex, max(self.start.y, self.end.y) + ey, max(self.start.z, self.end.z) + ez)
+        return lo, hi
+    
+    def get_material(self):
+        return self.material
@@ -0,0 +1,78 @@
+import numpy as np
+
+EPSILON = 0.0000001
+INF = float("inf")
+
+
+def dot(a, b):
+    # Component order matches Vector.dot so results agree bit for bit with trace_ray
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + a[..., 2] * b[..., 2]
+
+
+def cross(a, b):
+    return np.stack((a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+                     a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+                     a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]), axis=-1)
+
+
+def normalize(v):
+    # Mirrors Vector.normalize, including the fallback for zero-length vectors
+    length = np.sqrt(v[:, 0] ** 2 + v[:, 1] ** 2 + v[:, 2] ** 2)
+    zero = length == 0
+    out = v * (1.0 / np.where(zero, 1.0, length))[:, None]
+    out[zero] = (0.0, 0.0, 1.0)
+    return out
+
+
+def inverse_directions(directions):
+    safe = np.where(directions == 0, 1.0, directions)
+    return np.where(directions == 0, np.copysign(1e300, directions), 1.0 / safe)
+
+
+def box_hits(lo, hi, origins, inverse, limit):
+    # Slab test of (R, 3) rays against one box; True where the box is entered before limit
+    positive = inverse >= 0
+    t_near = (np.where(positive, lo, hi) - origins) * inverse
+    t_far = (np.where(positive, hi, lo) - origins) * inverse
+    t_near = np.maximum(t_near.max(axis=1), 0.0)
+    t_far = np.minimum(t_far.min(axis=1), limit)
+    return t_near <= t_far
+
+
+def intersect_spheres(origins, directions, centers, radii):
+    # (R, 3) rays against (S, 3) spheres -> (R, S) distances, inf on miss
+    oc = origins[:, None, :] - centers[None, :, :]
+    d = directions[:, None, :]
+    a = dot(d, d)
+    b = 2.0 * dot(oc, d)
+    c = dot(oc, oc) - radii[None, :] ** 2
+    discriminant = b * b - 4 * a * c
+    valid = discriminant >= 0
+    root = np.sqrt(np.where(valid, discriminant, 0.0))
+    t1 = (-b - root) / (2.0 * a)
+    t2 = (-b + root) / (2.0 * a)
+    t = np.where(t1 > 0, t1, np.where(t2 > 0, t2, INF))
+    return np.where(valid, t, INF)
+
+
+def intersect_triangles(origins, directions, v0, edge1, edge2):
+    # Batched Möller–Trumbore: (R, 3) rays against (T, 3) triangles -> (R, T) distances
+    d = directions[:, None, :]
+    h = cross(d, edge2[None, :, :])
+    a = dot(edge1[None, :, :], h)
+    parallel = (a > -EPSILON) & (a < EPSILON)
+    f = 1.0 / np.where(parallel, 1.0, a)
+    s = origins[:, None, :] - v0[None, :, :]
+    u = f * dot(s, h)
+    q = cross(s, edge1[None, :, :])
+    v = f * dot(d, q)
+    t = f * dot(edge2[None, :, :], q)
+    valid = ~parallel & (u >= 0.0) & (u <= 1.0) & (v >= 0.0) & (u + v <= 1.0) & (t > EPSILON)
+    return np.where(valid, t, INF)
+
+
+def closest_hits(t, keys):
+    # Per ray nearest distance in (R, N) and the column with the smallest key among ties
+    best_t = t.min(axis=1)
+    candidates = np.where(t == best_t[:, None], keys[None, :], np.iinfo(np.int64).max)
+    return best_t, candidates.argmin(axis=1)
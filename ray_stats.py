@@ -0,0 +1,86 @@
+import os
+import numpy as np
+from PIL import Image
+
+RAY_KINDS = ('primary', 'reflection', 'refraction', 'shadow')
+
+# Stops of the heatmap palette, from idle to most expensive
+HEAT_COLORS = np.array([(0, 0, 0), (40, 20, 120), (170, 30, 110), (240, 110, 30), (255, 230, 90), (255, 255, 255)],
+                       dtype=np.float64)
+
+
+# Counts of one tile or a whole render; a mesh or instance counts one test per ray, whatever
+# it tests inside. pixel_seconds is per pixel in row order, only kept for heatmaps.
+class RayStats:
+    def __init__(self):
+        self.rays = dict.fromkeys(RAY_KINDS, 0)
+        self.tests = {}
+        self.max_depth = 0
+        self.pixel_seconds = []
+        self.worker = None
+        self.seconds = 0.0
+        self.memory = None
+
+    def finish(self, seconds):
+        self.worker = os.getpid()
+        self.seconds = seconds
+        self.memory = resident_memory()
+
+    def to_json(self):
+        # Distributed workers send their tile counters back as JSON
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls()
+        stats.__dict__.update({key: data[key] for key in stats.__dict__ if key in data})
+        return stats
+
+    def count_tests(self, names):
+        tests = self.tests
+        for name in names:
+            tests[name] = tests.get(name, 0) + 1
+
+    def count_batch(self, name, count):
+        if count:
+            self.tests[name] = self.tests.get(name, 0) + count
+
+    def reach(self, depth):
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def merge(self, other):
+        for kind, count in other.rays.items():
+            self.rays[kind] += count
+        for name, count in other.tests.items():
+            self.count_batch(name, count)
+        self.reach(other.max_depth)
+
+    def report(self, seconds):
+        total = sum(self.rays.values())
+        rays = ", ".join(f"{self.rays[kind]} {kind}" for kind in RAY_KINDS)
+        print(f"Rays: {rays} ({total} total, {total / max(seconds, 1e-9):.0f} per second)")
+        tests = ", ".join(f"{name} {count}" for name, count in sorted(self.tests.items(), key=lambda item: -item[1]))
+        print(f"Intersection tests: {tests or 'none'}")
+        print(f"Deepest ray: depth {self.max_depth}")
+
+
+def resident_memory():
+    # Current resident size of this process in MiB, None where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def write_heatmap(path, seconds):
+    # False-color image of the time spent per pixel; the scale tops out at the 99th
+    # percentile so a few very slow pixels do not wash out the rest
+    top = np.percentile(seconds, 99) if seconds.size else 0.0
+    level = np.clip(seconds / top, 0.0, 1.0) if top > 0 else np.zeros_like(seconds)
+    position = level * (len(HEAT_COLORS) - 1)
+    lower = np.minimum(position.astype(np.int64), len(HEAT_COLORS) - 2)
+    fraction = (position - lower)[..., None]
+    colors = HEAT_COLORS[lower] * (1 - fraction) + HEAT_COLORS[lower + 1] * fraction
+    Image.fromarray(np.round(colors).astype(np.uint8), "RGB").save(path)
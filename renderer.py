@@ -1,11 +1,28 @@
+import os
 import time
 import math
+import random
+import bisect
 import multiprocessing
+from functools import partial
+import numpy as np
 from PIL import Image
 from vector import Vector
-from ray import Ray, EnhancedSphere, EnhancedTriangle
+from ray import Ray, CheckerMaterial, EnhancedSphere, EnhancedTriangle, EnhancedPlane, EnhancedDisk, EnhancedQuad, EnhancedBox, EnhancedCylinder
+from bvh import BVH
+from triangle_mesh import TriangleMesh
+from instancing import MeshInstance
+from wavefront import WavefrontScene, WavefrontTracer
 from mesh_builder import MeshBuilder
+from mesh_loader import load_mesh
 from camera import Camera
+from lighting import PointLight
+from tiles import make_tiles
+from checkpoint import RenderCheckpoint, scene_key
+from gbuffer import GBuffer, material_table, hit_owner, empty_samples, empty_terms, light_key, split_samples
+from ray_stats import RayStats, write_heatmap
+from distributed import TileServer
+from shared_scene import SharedScene, init_worker, call_worker, call_frame_worker, ignore_interrupts
 
 class ConsoleProgressListener():
     def __init__(self, update_frequency=5.0):
@@ -20,12 +37,25 @@ class ConsoleProgressListener():
         percentage = (completed / total) * 100
         
         if percentage - self.last_percentage >= self.update_frequency or percentage >= 100:       
-            print(f"Rendering: {percentage:.1f}% complete ({completed}/{total} pixels)")
+            print(f"Rendering: {percentage:.1f}% complete ({completed}/{total} tiles)")
             self.last_percentage = percentage
     
     def on_render_complete(self, time_taken):
         print(f"Rendering complete in {time_taken:.2f} seconds")
 
+class PreviewImageWriter():
+    def __init__(self, output_file="progress.png"):
+        self.output_file = output_file
+    
+    def on_progress_update(self, completed, total):
+        pass
+    
+    def on_preview_update(self, image, completed, total):
+        image.save(self.output_file)
+    
+    def on_render_complete(self, time_taken):
+        pass
+
 class Renderer:
     def __init__(self, width, height, samples_per_pixel=1):
         self.width = width
@@ -46,6 +76,56 @@ class Renderer:
         )
         
         self.use_advanced_camera = False
+        
+        self.use_bvh = True
+        self.accelerator = None
+        
+        self.backend = "recursive"
+        self.tile_size = 32
+        self.tile_order = "spiral"
+        self.wavefront_scene = None
+        
+        self.scene_distribution = "shared"
+        
+        self.adaptive_sampling = False
+        self.min_samples = 4
+        self.max_samples = 64
+        self.noise_threshold = 2.0
+        
+        self.progressive = False
+        self.progressive_block = 16
+        self.preview_interval = 2.0
+        
+        self.checkpoint = False
+        self.resume = False
+        self.checkpoint_interval = 10.0
+        
+        # With more lights than this, each shading point picks this many of them for shadow
+        # rays instead of testing all; 0 always tests every light
+        self.light_samples = 0
+        
+        # Reflection and refraction branches whose share of the pixel falls below
+        # min_contribution see the background, as if they had reached max_depth. From
+        # roulette_depth on, branches survive with probability equal to their share and are
+        # scaled up when they do (0 disables it). With branch_sampling a hit that would spawn
+        # both rays traces only one, picked in proportion to their contributions.
+        self.min_contribution = 0.0
+        self.roulette_depth = 0
+        self.branch_sampling = False
+        
+        # Ray and intersection counters, filled per tile while collect_stats is on; with
+        # cost_heatmap the time spent per pixel is also saved as a false-color image.
+        # tile_stats only has tiles report their rays, time and worker, for telemetry.
+        self.collect_stats = False
+        self.cost_heatmap = False
+        self.tile_stats = False
+        self.stats = None
+        
+        # "host:port" to hand the tiles of draw_scene to distributed.py workers over TCP
+        # instead of local processes; the render stops after serve_timeout seconds without
+        # a connected worker
+        self.serve_address = None
+        self.serve_timeout = 600.0
     
     def add_progress_listener(self, listener):
         if listener not in self.progress_listeners:
@@ -55,6 +135,23 @@ class Renderer:
         for listener in self.progress_listeners:
             listener.on_progress_update(completed, total)
     
+    def notify_preview(self, image, completed, total):
+        # Intermediate frames go to listeners that opt in with on_preview_update
+        for listener in self.progress_listeners:
+            if hasattr(listener, 'on_preview_update'):
+                listener.on_preview_update(image, completed, total)
+    
+    def notify_phase(self, phase):
+        # Listeners that opt in with on_phase_change hear when setup, build, trace or encode starts
+        for listener in self.progress_listeners:
+            if hasattr(listener, 'on_phase_change'):
+                listener.on_phase_change(phase)
+    
+    def notify_tile(self, stats):
+        for listener in self.progress_listeners:
+            if hasattr(listener, 'on_tile_complete'):
+                listener.on_tile_complete(stats)
+    
     def notify_complete(self, time_taken):
         for listener in self.progress_listeners:
             listener.on_render_complete(time_taken)
@@ -80,9 +177,54 @@ class Renderer:
     
     def add_object(self, obj):
         self.objects.append(obj)
+        self.accelerator = None
+        self.wavefront_scene = None
     
-    def add_objects(self, objects):
+    def add_objects(self, objects, as_mesh=False):
+        if as_mesh:
+            triangles = [obj for obj in objects if isinstance(obj, EnhancedTriangle)]
+            objects = [obj for obj in objects if not isinstance(obj, EnhancedTriangle)]
+            if triangles:
+                objects.append(TriangleMesh.from_triangles(triangles))
         self.objects.extend(objects)
+        self.accelerator = None
+        self.wavefront_scene = None
+    
+    def build_acceleration_structure(self):
+        if self.use_bvh and self.objects:
+            self.accelerator = BVH(self.objects)
+        else:
+            self.accelerator = None
+    
+    def build_wavefront_scene(self):
+        self.wavefront_scene = WavefrontScene(self.objects)
+    
+    def cast_ray(self, ray_origin, ray_direction, max_distance=float("inf")):
+        if self.accelerator is not None:
+            return self.accelerator.cast_ray(ray_origin, ray_direction, max_distance)
+        if self.stats is not None and self.collect_stats:
+            self.stats.count_tests(type(obj).__name__ for obj in self.objects)
+        return Ray.cast_ray(self.objects, ray_origin, ray_direction, max_distance)
+    
+    def transmittance(self, ray_origin, ray_direction, max_distance=float("inf")):
+        if self.accelerator is not None:
+            return self.accelerator.transmittance(ray_origin, ray_direction, max_distance)
+        if self.stats is not None and self.collect_stats:
+            self.stats.count_tests(type(obj).__name__ for obj in self.objects)
+        return Ray.transmittance(self.objects, ray_origin, ray_direction, max_distance)
+    
+    def add_instance(self, mesh, transform, material=None):
+        self.add_object(MeshInstance(mesh, transform, material))
+    
+    def add_mesh(self, source, material=None, group_materials=None, transform=None):
+        # source is a TriangleMesh or an .obj/.ply file; with a transform the mesh is placed as
+        # an instance so the file's own coordinates can stay as they are
+        mesh = source if isinstance(source, TriangleMesh) else load_mesh(source, material, group_materials)
+        if transform is not None:
+            self.add_instance(mesh, transform)
+        else:
+            self.add_object(mesh)
+        return mesh
     
     def add_sphere(self, center, radius, material):
         self.add_object(EnhancedSphere(center, radius, material))
@@ -90,17 +232,54 @@ class Renderer:
     def add_triangle(self, v0, v1, v2, material):
         self.add_object(EnhancedTriangle(v0, v1, v2, material))
     
-    def add_cube(self, center, size, material):
+    def add_plane(self, point, normal, material):
+        self.add_object(EnhancedPlane(point, normal, material))
+    
+    def add_disk(self, center, normal, radius, material):
+        self.add_object(EnhancedDisk(center, normal, radius, material))
+    
+    def add_quad(self, corner, edge1, edge2, material):
+        self.add_object(EnhancedQuad(corner, edge1, edge2, material))
+    
+    def add_box(self, min_corner, max_corner, material, rotation=(0, 0, 0)):
+        self.add_object(EnhancedBox(min_corner, max_corner, material, rotation))
+    
+    def add_cube(self, center, size, material, as_mesh=False, analytic=False):
+        if analytic:
+            half = size / 2
+            self.add_box(Vector(center.x - half, center.y - half, center.z - half),
+                         Vector(center.x + half, center.y + half, center.z + half), material)
+            return
         cube_triangles = MeshBuilder.create_cube(center, size, material.color)
+        if as_mesh:
+            self.add_object(TriangleMesh.from_triangles(cube_triangles, material))
+            return
         for triangle in cube_triangles:
             self.add_triangle(triangle.v0, triangle.v1, triangle.v2, material)
     
-    def add_cylinder(self, center, radius, height, segments, material):
+    def add_cylinder(self, center, radius, height, segments, material, as_mesh=False, analytic=False):
+        # The analytic cylinder is exact and ignores segments; it spans the same height along y
+        if analytic:
+            self.add_object(EnhancedCylinder(Vector(center.x, center.y + height/2, center.z),
+                                             Vector(center.x, center.y - height/2, center.z), radius, material))
+            return
         cylinder_triangles = MeshBuilder.create_cylinder(center, radius, height, segments, material.color)
+        if as_mesh:
+            self.add_object(TriangleMesh.from_triangles(cylinder_triangles, material))
+            return
         for triangle in cylinder_triangles:
             self.add_triangle(triangle.v0, triangle.v1, triangle.v2, material)
     
-    def add_checkerboard(self, y, size, dist, material1, material2):
+    def add_checkerboard(self, y, size, dist, material1, material2, as_mesh=False, procedural=False):
+        # The procedural floor is one endless plane that picks its material per hit point;
+        # dist only limits the triangle versions
+        if procedural:
+            self.add_plane(Vector(0, y, 0), Vector(0, -1, 0), CheckerMaterial(material1, material2, size))
+            return
+        
+        vertices = []
+        material_ids = []
+        
         for row in range(-dist, dist):
             for col in range(-dist, dist):
                 is_white = (row + col) % 2 == 0
@@ -111,8 +290,17 @@ class Renderer:
                 z1 = row * size
                 z2 = (row + 1) * size
                 
+                if as_mesh:
+                    vertices.extend([(x1, y, z1), (x2, y, z1), (x2, y, z2), (x1, y, z1), (x2, y, z2), (x1, y, z2)])
+                    material_ids.extend([0 if is_white else 1] * 2)
+                    continue
+                
                 self.add_triangle(Vector(x1, y, z1), Vector(x2, y, z1), Vector(x2, y, z2), material)
                 self.add_triangle(Vector(x1, y, z1), Vector(x2, y, z2), Vector(x1, y, z2), material)
+        
+        if as_mesh and vertices:
+            indices = [(i, i + 1, i + 2) for i in range(0, len(vertices), 3)]
+            self.add_object(TriangleMesh(vertices, indices, [material1, material2], material_ids))
     
     def reflect_ray(self, ray_dir, normal):
         return ray_dir - normal * (2 * ray_dir.dot(normal))
@@ -151,84 +339,108 @@ class Renderer:
         return (rs * rs + rp * rp) / 2
     
     def trace_shadow_ray(self, origin, direction, max_distance):
-        current_origin = origin.copy() if hasattr(origin, 'copy') else Vector(origin.x, origin.y, origin.z)
-        transparency = 1.0
+        # The segment stops just short of the light so a light sitting on a surface is not hidden by it
+        if self.stats is not None:
+            self.stats.rays['shadow'] += 1
+        return 1.0 - self.transmittance(origin, direction, max_distance - 0.001)
+    
+    def surface_brightness(self, hit_point, normal):
+        if self.light_samples and len(self.lights) > self.light_samples:
+            return self.sampled_brightness(hit_point, normal)
         
-        max_bounces = 10
-        for _ in range(max_bounces):
-            obj, t = Ray.cast_ray(self.objects, current_origin, direction, max_distance)
+        brightness = self.ambient_factor
+        
+        if not self.lights:
+            light_positions = [
+                Vector(-300, -300, -200),
+                Vector(300, -300, -200),
+            ]
             
-            if obj is None:
-                break
+            light_intensity = 1.0 - self.ambient_factor
+            
+            for light_pos in light_positions:
+                light_dir = (light_pos - hit_point).normalize()
                 
-            if hasattr(obj, 'get_material'):
-                material = obj.get_material()
-                if hasattr(material, 'transparency') and material.transparency > 0:
-                    transparency *= material.transparency
-                    
-                    if transparency < 0.01:
-                        break
-                        
-                    hit_point = current_origin + direction * t
-                    current_origin = hit_point + direction * 0.001
-                else:
-                    transparency = 0.0
-                    break
-            else:
-                transparency = 0.0
-                break
+                light_distance = (light_pos - hit_point).magnitude()
+                
+                shadow_origin = hit_point + normal * 0.001
+                
+                shadow_intensity = self.trace_shadow_ray(shadow_origin, light_dir, light_distance)
+                
+                if shadow_intensity < 1.0:
+                    diffuse = max(0, normal.dot(light_dir))
+                    brightness += diffuse * light_intensity * (1.0 - shadow_intensity) / len(light_positions)
+        else:
+            light_intensity = 1.0 - self.ambient_factor
+            
+            for light in self.lights:
+                light_dir = light.get_direction(hit_point)
+                light_distance = light.get_distance(hit_point)
+                
+                shadow_origin = hit_point + normal * 0.001
                 
-        return (1.0 - transparency)
+                shadow_intensity = self.trace_shadow_ray(shadow_origin, light_dir, light_distance)
+                
+                if shadow_intensity < 1.0:
+                    diffuse = max(0, normal.dot(light_dir))
+                    brightness += diffuse * light_intensity * light.intensity * (1.0 - shadow_intensity)
+        
+        return brightness
     
-    def trace_ray(self, ray_origin, ray_direction, depth=0, inside_medium=False):
+    def sampled_brightness(self, hit_point, normal):
+        # Lights are picked in proportion to their unshadowed contribution, intensity times
+        # cosine, and each pick is divided by its probability so the estimate stays unbiased.
+        # With that weight it comes down to the total unshadowed light times the mean
+        # visibility of the picked lights.
+        light_intensity = 1.0 - self.ambient_factor
+        directions = []
+        cumulative = []
+        total = 0.0
+        for light in self.lights:
+            light_dir = light.get_direction(hit_point)
+            total += max(0, normal.dot(light_dir)) * light.intensity
+            directions.append(light_dir)
+            cumulative.append(total)
+        
+        if total <= 0:
+            return self.ambient_factor
+        
+        shadow_origin = hit_point + normal * 0.001
+        visibility = 0.0
+        for k in range(self.light_samples):
+            # Stratified: one pick from each equal slice of the total weight
+            i = min(bisect.bisect_right(cumulative, (k + random.random()) / self.light_samples * total), len(self.lights) - 1)
+            shadow_intensity = self.trace_shadow_ray(shadow_origin, directions[i], self.lights[i].get_distance(hit_point))
+            visibility += 1.0 - shadow_intensity
+        
+        return self.ambient_factor + total * light_intensity * visibility / self.light_samples
+    
+    def roulette(self, weight, depth):
+        # Probability a branch with this share of the pixel survived with, or 0 when it did not
+        if self.roulette_depth and depth >= self.roulette_depth and weight < 1.0:
+            return weight if random.random() < weight else 0.0
+        return 1.0
+    
+    def trace_ray(self, ray_origin, ray_direction, depth=0, inside_medium=False, weight=1.0):
         if depth >= self.max_depth:
             return self.background_color
         
-        obj, t = Ray.cast_ray(self.objects, ray_origin, ray_direction)
+        stats = self.stats
+        if stats is not None:
+            stats.reach(depth)
+        
+        obj, t = self.cast_ray(ray_origin, ray_direction)
         
         if obj:
             hit_point = ray_origin + ray_direction * t
             normal = obj.get_normal(hit_point)
             
             material = obj.get_material()
+            if hasattr(material, 'material_at'):
+                material = material.material_at(hit_point, normal)
             local_color = material.color
             
-            brightness = self.ambient_factor
-            
-            if not self.lights:
-                light_positions = [
-                    Vector(-300, -300, -200),
-                    Vector(300, -300, -200),
-                ]
-                
-                light_intensity = 1.0 - self.ambient_factor
-                
-                for light_pos in light_positions:
-                    light_dir = (light_pos - hit_point).normalize()
-                    
-                    light_distance = (light_pos - hit_point).magnitude()
-                    
-                    shadow_origin = hit_point + normal * 0.001
-                    
-                    shadow_intensity = self.trace_shadow_ray(shadow_origin, light_dir, light_distance)
-                    
-                    if shadow_intensity < 1.0:
-                        diffuse = max(0, normal.dot(light_dir))
-                        brightness += diffuse * light_intensity * (1.0 - shadow_intensity) / len(light_positions)
-            else:
-                light_intensity = 1.0 - self.ambient_factor
-                
-                for light in self.lights:
-                    light_dir = light.get_direction(hit_point)
-                    light_distance = light.get_distance(hit_point)
-                    
-                    shadow_origin = hit_point + normal * 0.001
-                    
-                    shadow_intensity = self.trace_shadow_ray(shadow_origin, light_dir, light_distance)
-                    
-                    if shadow_intensity < 1.0:
-                        diffuse = max(0, normal.dot(light_dir))
-                        brightness += diffuse * light_intensity * light.intensity * (1.0 - shadow_intensity)
+            brightness = self.surface_brightness(hit_point, normal)
             
             r = int(local_color[0] * brightness)
             g = int(local_color[1] * brightness)
@@ -238,23 +450,15 @@ class Renderer:
             reflection_color = self.background_color
             refraction_color = self.background_color
             
-            if material.reflectivity > 0:
-                reflection_dir = self.reflect_ray(ray_direction, normal)
-                reflection_origin = hit_point + normal * 0.01
-                reflection_color = self.trace_ray(reflection_origin, reflection_dir, depth + 1, inside_medium)
+            reflective = material.reflectivity > 0
+            refractive = material.transparency > 0
             
-            if material.transparency > 0:
+            if refractive:
                 is_entering = ray_direction.dot(normal) < 0
                 
                 n1 = 1.0 if is_entering else material.refractive_index
                 n2 = material.refractive_index if is_entering else 1.0
                 
-                refraction_dir = self.refract_ray(ray_direction, normal, n1, n2)
-                
-                refraction_origin = hit_point + refraction_dir * 0.01
-                
-                refraction_color = self.trace_ray(refraction_origin, refraction_dir, depth + 1, not inside_medium)
-                
                 fresnel = self.fresnel(ray_direction, normal, n1, n2)
                 
                 reflection_contribution = material.reflectivity * (1 - material.transparency) + material.transparency * fresnel
@@ -270,6 +474,45 @@ class Renderer:
             
             direct_contribution = max(0.0, 1.0 - reflection_contribution - refraction_contribution)
             
+            if self.branch_sampling and reflective and refractive:
+                total = reflection_contribution + refraction_contribution
+                if random.random() * total < reflection_contribution:
+                    reflection_contribution = total
+                    refraction_contribution = 0.0
+                    refractive = False
+                else:
+                    reflection_contribution = 0.0
+                    refraction_contribution = total
+                    reflective = False
+            
+            # A branch below min_contribution keeps the background; one that lost the
+            # roulette adds nothing, and the survivors are scaled up to make up for it
+            if reflective and weight * reflection_contribution >= self.min_contribution:
+                survival = self.roulette(weight * reflection_contribution, depth + 1)
+                if survival:
+                    if stats is not None:
+                        stats.rays['reflection'] += 1
+                    reflection_contribution /= survival
+                    reflection_dir = self.reflect_ray(ray_direction, normal)
+                    reflection_origin = hit_point + normal * 0.01
+                    reflection_color = self.trace_ray(reflection_origin, reflection_dir, depth + 1, inside_medium,
+                                                      weight * reflection_contribution)
+                else:
+                    reflection_contribution = 0.0
+            
+            if refractive and weight * refraction_contribution >= self.min_contribution:
+                survival = self.roulette(weight * refraction_contribution, depth + 1)
+                if survival:
+                    if stats is not None:
+                        stats.rays['refraction'] += 1
+                    refraction_contribution /= survival
+                    refraction_dir = self.refract_ray(ray_direction, normal, n1, n2)
+                    refraction_origin = hit_point + refraction_dir * 0.01
+                    refraction_color = self.trace_ray(refraction_origin, refraction_dir, depth + 1, not inside_medium,
+                                                      weight * refraction_contribution)
+                else:
+                    refraction_contribution = 0.0
+            
             final_r = int(local_color[0] * direct_contribution + 
                         reflection_color[0] * reflection_contribution +
                         refraction_color[0] * refraction_contribution)
@@ -284,15 +527,18 @@ class Renderer:
         
         return self.background_color
     
-    def compute_pixel(self, xy):
-        x, y = xy
-        
-        r_total, g_total, b_total = 0, 0, 0
-        
+    def camera_ray(self, sample_x, sample_y):
+        if self.stats is not None:
+            self.stats.rays['primary'] += 1
+        if self.use_advanced_camera:
+            return self.camera.get_ray(sample_x, sample_y, self.width, self.height)
+        return self.camera.get_simple_ray(sample_x, sample_y, self.width, self.height)
+    
+    def sample_positions(self, x, y):
+        positions = []
         for s in range(self.samples_per_pixel):
             if self.samples_per_pixel > 1:
                 if self.samples_per_pixel > 4:
-                    import random
                     sample_x = x + random.random()
                     sample_y = y + random.random()
                 else:
@@ -300,11 +546,16 @@ class Renderer:
                     sample_y = y + (s // 2) * 0.5
             else:
                 sample_x, sample_y = x, y
-            
-            if self.use_advanced_camera:
-                ray_origin, ray_direction = self.camera.get_ray(sample_x, sample_y, self.width, self.height)
-            else:
-                ray_origin, ray_direction = self.camera.get_simple_ray(sample_x, sample_y, self.width, self.height)
+            positions.append((sample_x, sample_y))
+        return positions
+    
+    def compute_pixel(self, xy):
+        x, y = xy
+        
+        r_total, g_total, b_total = 0, 0, 0
+        
+        for sample_x, sample_y in self.sample_positions(x, y):
+            ray_origin, ray_direction = self.camera_ray(sample_x, sample_y)
             
             color = self.trace_ray(ray_origin, ray_direction, 0, None)
             
@@ -318,37 +569,540 @@ class Renderer:
         
         return x, y, (r_avg, g_avg, b_avg)
     
-    def draw_scene(self, output_file="raytraced_scene.png"):
-        pixels = self.image.load()
-        coords = [(x, y) for x in range(self.width) for y in range(self.height)]
-        total_pixels = len(coords)
+    @staticmethod
+    def adaptive_offset(s):
+        # The first four samples are jittered inside the quadrants of the pixel so that even the
+        # initial estimate sees the whole footprint; later samples are spread uniformly
+        if s < 4:
+            return (s % 2 + random.random()) * 0.5, (s // 2 + random.random()) * 0.5
+        return random.random(), random.random()
+    
+    @staticmethod
+    def sample_error(totals, squares, count):
+        # Standard error of the pixel mean in the noisiest channel
+        if count < 2:
+            return float("inf")
+        variance = max((squares[c] - totals[c] * totals[c] / count) / (count - 1) for c in range(3))
+        return math.sqrt(max(variance, 0.0) / count)
+    
+    def compute_pixel_adaptive(self, xy):
+        x, y = xy
+        totals = [0, 0, 0]
+        squares = [0, 0, 0]
+        count = 0
+        target = max(1, min(self.min_samples, self.max_samples))
+        
+        while True:
+            while count < target:
+                dx, dy = self.adaptive_offset(count)
+                ray_origin, ray_direction = self.camera_ray(x + dx, y + dy)
+                color = self.trace_ray(ray_origin, ray_direction, 0, None)
+                for c in range(3):
+                    totals[c] += color[c]
+                    squares[c] += color[c] * color[c]
+                count += 1
+            
+            if count >= self.max_samples or self.sample_error(totals, squares, count) <= self.noise_threshold:
+                break
+            target = min(self.max_samples, count * 2)
+        
+        return x, y, (totals[0] // count, totals[1] // count, totals[2] // count)
+    
+    def compute_pixels(self, xs, ys):
+        # Per-pixel times are only kept for the heatmap
+        stats = self.stats if self.cost_heatmap else None
+        if self.backend == "wavefront":
+            tracer = WavefrontTracer(self, self.wavefront_scene)
+            start = time.perf_counter()
+            data = tracer.render_pixels(np.array(xs), np.array(ys)).tobytes()
+            if stats is not None:
+                # The pixels are traced together, so they share the time evenly
+                stats.pixel_seconds.extend([(time.perf_counter() - start) / len(xs)] * len(xs))
+            return data
+        
+        compute_pixel = self.compute_pixel_adaptive if self.adaptive_sampling else self.compute_pixel
+        data = bytearray(len(xs) * 3)
+        i = 0
+        for xy in zip(xs, ys):
+            if stats is not None:
+                start = time.perf_counter()
+            data[i:i + 3] = bytes(compute_pixel(xy)[2])
+            if stats is not None:
+                stats.pixel_seconds.append(time.perf_counter() - start)
+            i += 3
+        return bytes(data)
+    
+    def set_stats(self, stats):
+        # Intersection tests are only counted for collect_stats; they cost far more to count
+        # than rays do
+        self.stats = stats
+        for structure in (self.accelerator, self.wavefront_scene):
+            if structure is not None:
+                structure.stats = stats if self.collect_stats else None
+    
+    def compute_tile(self, tile):
+        x0, y0, width, height = tile
+        xs = [x for y in range(y0, y0 + height) for x in range(x0, x0 + width)]
+        ys = [y for y in range(y0, y0 + height) for x in range(x0, x0 + width)]
+        if not (self.collect_stats or self.tile_stats):
+            return x0, y0, width, height, self.compute_pixels(xs, ys)
+        return (x0, y0, width, height) + self.measure_pixels(xs, ys)
+    
+    def measure_pixels(self, xs, ys):
+        # Every tile brings its own counters back for the parent to add up
+        stats = RayStats()
+        self.set_stats(stats)
+        start = time.perf_counter()
+        try:
+            data = self.compute_pixels(xs, ys)
+        finally:
+            self.set_stats(None)
+        stats.finish(time.perf_counter() - start)
+        return data, stats
+    
+    @staticmethod
+    def block_pixels(task):
+        # Pixels on this pass' grid that no coarser pass has already computed
+        x0, y0, width, height, step, previous = task
+        xs, ys = [], []
+        for y in range(y0, y0 + height, step):
+            for x in range(x0, x0 + width, step):
+                if previous and x % previous == 0 and y % previous == 0:
+                    continue
+                xs.append(x)
+                ys.append(y)
+        return xs, ys
+    
+    def compute_block_pass(self, task):
+        xs, ys = self.block_pixels(task)
+        if not self.tile_stats:
+            return task, self.compute_pixels(xs, ys)
+        return (task,) + self.measure_pixels(xs, ys)
+    
+    def compute_gbuffer_tile(self, tile):
+        x0, y0, width, height = tile
+        xs = [x for y in range(y0, y0 + height) for x in range(x0, x0 + width)]
+        ys = [y for y in range(y0, y0 + height) for x in range(x0, x0 + width)]
+        _, material_index = material_table(self.objects)
+        if self.backend == "wavefront":
+            tracer = WavefrontTracer(self, self.wavefront_scene)
+            return tile, tracer.gbuffer_samples(np.array(xs), np.array(ys), material_index)
+        
+        object_index = {id(obj): i for i, obj in enumerate(self.objects)}
+        samples = empty_samples(len(xs) * self.samples_per_pixel)
+        i = 0
+        for x, y in zip(xs, ys):
+            for sample_x, sample_y in self.sample_positions(x, y):
+                samples['sample_x'][i] = sample_x
+                samples['sample_y'][i] = sample_y
+                ray_origin, ray_direction = self.camera_ray(sample_x, sample_y)
+                obj, t = self.cast_ray(ray_origin, ray_direction)
+                if obj:
+                    hit_point = ray_origin + ray_direction * t
+                    normal = obj.get_normal(hit_point)
+                    samples['point'][i] = (hit_point.x, hit_point.y, hit_point.z)
+                    samples['normal'][i] = (normal.x, normal.y, normal.z)
+                    material = obj.get_material()
+                    if hasattr(material, 'material_at'):
+                        material = material.material_at(hit_point, normal)
+                    samples['material'][i] = material_index.get(id(material), -1)
+                    samples['object'][i] = object_index.get(id(hit_owner(obj)), -1)
+                i += 1
+        return tile, samples
+    
+    def active_lights(self):
+        # (light, intensity) pairs as surface_brightness uses them
+        if self.lights:
+            return [(light, light.intensity) for light in self.lights]
+        defaults = [PointLight(Vector(-300, -300, -200)), PointLight(Vector(300, -300, -200))]
+        return [(light, 1.0 / len(defaults)) for light in defaults]
+    
+    def light_terms(self, light, points, normals):
+        diffuse, visibility = empty_terms(len(points))
+        for i, (point, normal) in enumerate(zip(points, normals)):
+            hit_point, normal = Vector(*point), Vector(*normal)
+            light_dir = light.get_direction(hit_point)
+            light_distance = light.get_distance(hit_point)
+            
+            shadow_intensity = self.trace_shadow_ray(hit_point + normal * 0.001, light_dir, light_distance)
+            
+            diffuse[i] = max(0, normal.dot(light_dir))
+            visibility[i] = 1.0 - shadow_intensity
+        return diffuse, visibility
+    
+    def relight_tile(self, task):
+        # Same colors as trace_ray for the stored primary hits with the current lights;
+        # terms holds the stored per-light terms of the tile, None for lights to trace
+        (x0, y0, width, height), samples, cached_terms = task
+        terms = list(cached_terms)
+        materials, _ = material_table(self.objects)
+        if self.backend == "wavefront":
+            colors, terms = WavefrontTracer(self, self.wavefront_scene).relight_samples(samples, materials, terms)
+            colors = colors.astype(np.int64)
+        else:
+            material = samples['material']
+            diffuse, retrace = split_samples(material, materials)
+            points, normals = samples['point'][diffuse].tolist(), samples['normal'][diffuse].tolist()
+            light_intensity = 1.0 - self.ambient_factor
+            brightness = np.full(len(diffuse), self.ambient_factor)
+            
+            for i, (light, intensity) in enumerate(self.active_lights()):
+                if terms[i] is None:
+                    terms[i] = empty_terms(len(material))
+                    terms[i][0][diffuse], terms[i][1][diffuse] = self.light_terms(light, points, normals)
+                brightness += terms[i][0][diffuse] * light_intensity * intensity * terms[i][1][diffuse]
+            
+            colors = np.tile(np.array(self.background_color, dtype=np.int64), (len(material), 1))
+            if len(diffuse):
+                color = np.array([m.color for m in materials], dtype=np.float64).reshape(-1, 3)
+                colors[diffuse] = np.minimum(255, np.floor(color[material[diffuse]] * brightness[:, None]))
+            sample_x, sample_y = samples['sample_x'].tolist(), samples['sample_y'].tolist()
+            for i in retrace.tolist():
+                ray_origin, ray_direction = self.camera_ray(sample_x[i], sample_y[i])
+                colors[i] = self.trace_ray(ray_origin, ray_direction, 0, None)
+        
+        spp = self.samples_per_pixel
+        pixels = colors.reshape(-1, spp, 3).sum(axis=1) // spp
+        new_terms = [term if cached is None else None for term, cached in zip(terms, cached_terms)]
+        return x0, y0, width, height, pixels.astype(np.uint8).tobytes(), new_terms
+    
+    def prepare_render(self, verbose=True):
+        build_start = time.time()
+        if self.backend == "wavefront":
+            if self.wavefront_scene is None:
+                self.build_wavefront_scene()
+                if verbose:
+                    print(f"Built wavefront scene in {time.time() - build_start:.2f} seconds")
+        elif self.use_bvh and self.accelerator is None:
+            self.build_acceleration_structure()
+            if verbose:
+                print(f"Built BVH in {time.time() - build_start:.2f} seconds")
+    
+    def refit_scene(self):
+        # Animation frames keep the trees built for the first frame and only move their
+        # bounds; a tree that no longer matches the objects is rebuilt
+        if self.accelerator is not None and not self.accelerator.refit(self.objects):
+            self.accelerator = None
+        if self.wavefront_scene is not None and not self.wavefront_scene.refit(self.objects):
+            self.wavefront_scene = None
+        self.prepare_render(verbose=False)
+    
+    def open_pool(self, method="compute_tile", animated=False):
+        # Full renders can go to remote workers instead; the server stands in for the pool
+        if self.serve_address and method == "compute_tile" and not animated:
+            return TileServer(self, self.serve_address, self.serve_timeout), None, None
+        
+        # Shared mode copies the flattened scene into one shared memory block that every
+        # worker maps on start-up, so tasks only carry tile coordinates
+        if self.scene_distribution == "shared":
+            share_start = time.time()
+            shared = SharedScene(self)
+            print(f"Shared {shared.size / 1024:.0f} KiB of scene data in {time.time() - share_start:.2f} seconds")
+            pool = multiprocessing.Pool(initializer=init_worker, initargs=(shared.manifest,))
+            return pool, partial(call_frame_worker if animated else call_worker, method), shared
+        
+        self.prepare_render()
+        return multiprocessing.Pool(initializer=ignore_interrupts), getattr(self, method), None
+    
+    def open_checkpoint(self, output_file, mode):
+        if not (self.checkpoint or self.resume):
+            return None
         
+        checkpoint = RenderCheckpoint(f"{output_file}.checkpoint", scene_key(self, mode), self.checkpoint_interval)
+        checkpoint.open(resume=self.resume)
+        if checkpoint.stale:
+            print(f"Checkpoint {checkpoint.path} belongs to a different scene or settings, starting over")
+        elif checkpoint.completed:
+            print(f"Resuming from {checkpoint.path}: {len(checkpoint.completed)} finished tasks")
+        return checkpoint
+    
+    def close_checkpoint(self, checkpoint, finished):
+        if checkpoint is None:
+            return
+        if finished:
+            checkpoint.remove()
+        else:
+            checkpoint.close()
+            print(f"Checkpoint kept in {checkpoint.path} ({len(checkpoint.completed)} tasks), rerun with --resume")
+    
+    def draw_scene(self, output_file="raytraced_scene.png"):
         print(f"Rendering scene with {len(self.objects)} objects and {len(self.lights)} lights...")
         print(f"Image resolution: {self.width}x{self.height}")
         start_time = time.time()
         
-        progress_interval = max(1, total_pixels // 100)
-        completed_pixels = 0
+        tiles = make_tiles(self.width, self.height, self.tile_size, self.tile_order)
+        total_tiles = len(tiles)
+        completed_tiles = 0
         
-        with multiprocessing.Pool() as pool:
-            chunk_size = max(100, total_pixels // 20)
-            
-            for i, result in enumerate(pool.imap(self.compute_pixel, coords, chunk_size)):
-                x, y, color = result
-                pixels[x, y] = color
+        checkpoint = self.open_checkpoint(output_file, "tiles")
+        if checkpoint is not None:
+            for tile in tiles:
+                if tile in checkpoint.completed:
+                    x, y, width, height = tile
+                    self.image.paste(Image.frombytes("RGB", (width, height), checkpoint.completed[tile]), (x, y))
+                    completed_tiles += 1
+            tiles = [tile for tile in tiles if tile not in checkpoint.completed]
+        resumed_tiles = completed_tiles
+        
+        stats = RayStats() if self.collect_stats else None
+        cost = np.zeros((self.height, self.width)) if stats is not None and self.cost_heatmap else None
+        
+        finished = False
+        self.notify_phase("build")
+        pool, task, shared = self.open_pool()
+        self.notify_phase("trace")
+        try:
+            for result in pool.imap_unordered(task, tiles):
+                x, y, width, height, data = result[:5]
+                self.image.paste(Image.frombytes("RGB", (width, height), data), (x, y))
+                if checkpoint is not None:
+                    checkpoint.add((x, y, width, height), data)
+                if stats is not None:
+                    stats.merge(result[5])
+                if cost is not None:
+                    cost[y:y + height, x:x + width] = np.reshape(result[5].pixel_seconds, (height, width))
+                if len(result) > 5:
+                    self.notify_tile(result[5])
+                
+                completed_tiles += 1
+                self.notify_progress(completed_tiles, total_tiles)
+            finished = True
+        finally:
+            self.close_checkpoint(checkpoint, finished)
+            if shared is not None:
+                shared.close()
+            pool.terminate()
+            pool.join()
+        
+        end_time = time.time()
+        time_taken = end_time - start_time
+        print(f"Rendering finished in {time_taken:.2f} seconds")
+        if stats is not None:
+            stats.report(time_taken)
+            if resumed_tiles:
+                print(f"Counts cover the {total_tiles - resumed_tiles} tiles rendered in this run, "
+                      f"not the {resumed_tiles} restored from the checkpoint")
+        
+        self.notify_phase("encode")
+        self.image.save(output_file)
+        print(f"Scene saved as {output_file}")
+        
+        # Restored tiles have no timings and would show up as free
+        if cost is not None and resumed_tiles:
+            print("Cost heatmap skipped, part of the image was restored from a checkpoint")
+        elif cost is not None:
+            heatmap_file = f"{os.path.splitext(output_file)[0]}_cost.png"
+            write_heatmap(heatmap_file, cost)
+            print(f"Cost heatmap saved as {heatmap_file}")
+        
+        self.notify_complete(time_taken)
+    
+    def paint_block_pass(self, pixels, level, task, data):
+        # Fills each computed pixel's block, but only where nothing finer has landed yet
+        xs, ys = self.block_pixels(task)
+        xs = np.array(xs, dtype=np.int64)
+        ys = np.array(ys, dtype=np.int64)
+        colors = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        step = task[4]
+        for dy in range(step):
+            for dx in range(step):
+                bx, by = xs + dx, ys + dy
+                inside = (bx < self.width) & (by < self.height)
+                bx, by, block_colors = bx[inside], by[inside], colors[inside]
+                coarser = level[by, bx] > step
+                pixels[by[coarser], bx[coarser]] = block_colors[coarser]
+                level[by[coarser], bx[coarser]] = step
+    
+    def draw_progressive(self, output_file="raytraced_scene.png"):
+        # Passes go from progressive_block sized blocks down to single pixels. Each pass only
+        # computes the pixels earlier passes skipped, so the last pass leaves the same image
+        # as draw_scene; until then every pixel shows the finest block that covers it.
+        print(f"Rendering scene progressively with {len(self.objects)} objects and {len(self.lights)} lights...")
+        print(f"Image resolution: {self.width}x{self.height}")
+        start_time = time.time()
+        
+        steps = [max(1, self.progressive_block)]
+        while steps[-1] > 1:
+            steps.append(steps[-1] // 2)
+        
+        tasks = []
+        previous = 0
+        for step in steps:
+            for x, y, width, height in make_tiles(self.width, self.height, self.tile_size * step, self.tile_order):
+                tasks.append((x, y, width, height, step, previous))
+            previous = step
+        
+        pixels = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        level = np.full((self.height, self.width), steps[0] + 1, dtype=np.int32)
+        total_tasks = len(tasks)
+        completed_tasks = 0
+        
+        checkpoint = self.open_checkpoint(output_file, "progressive")
+        if checkpoint is not None:
+            for block_task in tasks:
+                if block_task in checkpoint.completed:
+                    self.paint_block_pass(pixels, level, block_task, checkpoint.completed[block_task])
+                    completed_tasks += 1
+            tasks = [block_task for block_task in tasks if block_task not in checkpoint.completed]
+            if completed_tasks:
+                self.notify_preview(Image.fromarray(pixels), completed_tasks, total_tasks)
+        last_preview = time.time()
+        
+        finished = False
+        self.notify_phase("build")
+        pool, task, shared = self.open_pool("compute_block_pass")
+        self.notify_phase("trace")
+        try:
+            for result in pool.imap_unordered(task, tasks):
+                block_task, data = result[:2]
+                if len(result) > 2:
+                    self.notify_tile(result[2])
+                self.paint_block_pass(pixels, level, block_task, data)
+                if checkpoint is not None:
+                    checkpoint.add(block_task, data)
                 
-                completed_pixels += 1
-                if completed_pixels % progress_interval == 0 or completed_pixels == total_pixels:
-                    self.notify_progress(completed_pixels, total_pixels)
+                completed_tasks += 1
+                self.notify_progress(completed_tasks, total_tasks)
+                if completed_tasks == total_tasks or time.time() - last_preview >= self.preview_interval:
+                    self.notify_preview(Image.fromarray(pixels), completed_tasks, total_tasks)
+                    last_preview = time.time()
+            finished = True
+        finally:
+            self.close_checkpoint(checkpoint, finished)
+            if shared is not None:
+                shared.close()
+            pool.terminate()
+            pool.join()
+        
+        self.image = Image.fromarray(pixels)
         
         end_time = time.time()
         time_taken = end_time - start_time
         print(f"Rendering finished in {time_taken:.2f} seconds")
         
+        self.notify_phase("encode")
+        self.image.save(output_file)
+        print(f"Scene saved as {output_file}")
+        
         self.notify_complete(time_taken)
+    
+    def save_gbuffer(self, path):
+        # One primary ray per camera sample; lights are not evaluated
+        print(f"Capturing G-buffer at {self.width}x{self.height} with {self.samples_per_pixel} samples per pixel...")
+        start_time = time.time()
+        tiles = make_tiles(self.width, self.height, self.tile_size, self.tile_order)
+        pool, task, shared = self.open_pool("compute_gbuffer_tile")
+        try:
+            results = {tile: samples for tile, samples in pool.imap_unordered(task, tiles)}
+        finally:
+            if shared is not None:
+                shared.close()
+            pool.terminate()
+            pool.join()
+        
+        gbuffer = GBuffer.from_tiles(self, [(tile, results[tile]) for tile in tiles])
+        gbuffer.save(path)
+        print(f"G-buffer saved as {path} in {time.time() - start_time:.2f} seconds")
+        return gbuffer
+    
+    def draw_relit(self, gbuffer, output_file="raytraced_scene.png", gbuffer_path=None):
+        # Shades the stored primary hits with the current lights instead of tracing the
+        # camera rays again; only reflective and transparent samples are retraced, and
+        # shadows are only traced for lights the G-buffer has no terms for yet
+        keys = [light_key(light) for light, _ in self.active_lights()]
+        reused = sum(key in gbuffer.light_terms for key in keys)
+        print(f"Relighting {self.width}x{self.height} from the G-buffer, reusing the shadows of {reused} of {len(keys)} lights...")
+        start_time = time.time()
+        tasks = [(tile, gbuffer.tile_samples(i), gbuffer.tile_light_terms(i, keys)) for i, tile in enumerate(gbuffer.tiles)]
+        tile_terms = {}
+        completed_tiles = 0
+        
+        self.notify_phase("build")
+        pool, task, shared = self.open_pool("relight_tile")
+        self.notify_phase("trace")
+        try:
+            for x, y, width, height, data, terms in pool.imap_unordered(task, tasks):
+                self.image.paste(Image.frombytes("RGB", (width, height), data), (x, y))
+                tile_terms[(x, y, width, height)] = terms
+                completed_tiles += 1
+                self.notify_progress(completed_tiles, len(tasks))
+        finally:
+            if shared is not None:
+                shared.close()
+            pool.terminate()
+            pool.join()
+        
+        time_taken = time.time() - start_time
+        print(f"Relighting finished in {time_taken:.2f} seconds")
         
+        self.notify_phase("encode")
         self.image.save(output_file)
         print(f"Scene saved as {output_file}")
+        
+        if gbuffer_path is not None and reused < len(keys):
+            # Keep the terms of this rig so the next tweak of its intensities is cheap
+            gbuffer.store_light_terms(keys, [[new if new is not None else cached for new, cached in zip(tile_terms[tile], terms)]
+                                             for tile, _, terms in tasks])
+            gbuffer.save(gbuffer_path)
+        
+        self.notify_complete(time_taken)
+    
+    def render_animation(self, frame_count, update_frame, output_pattern="frame_{:04d}.png"):
+        # update_frame(renderer, frame, frame_count) moves things for each frame. The pool,
+        # the shared scene block and the acceleration structures are set up once and then
+        # only refreshed: new positions are written into the block and the trees refit.
+        print(f"Rendering {frame_count} frames with {len(self.objects)} objects and {len(self.lights)} lights...")
+        print(f"Image resolution: {self.width}x{self.height}")
+        start_time = time.time()
+        
+        tiles = make_tiles(self.width, self.height, self.tile_size, self.tile_order)
+        update_frame(self, 0, frame_count)
+        
+        stats = RayStats() if self.collect_stats else None
+        self.notify_phase("build")
+        pool, task, shared = self.open_pool(animated=True)
+        self.notify_phase("trace")
+        try:
+            for frame in range(frame_count):
+                frame_start = time.time()
+                if frame:
+                    update_frame(self, frame, frame_count)
+                
+                if shared is not None:
+                    update = shared.update(self) if frame else None
+                    tasks = [(frame, update, tile) for tile in tiles]
+                else:
+                    # Pickled tasks carry the whole renderer, so only the local trees need refitting
+                    if frame:
+                        self.refit_scene()
+                    tasks = tiles
+                
+                self.image = Image.new("RGB", (self.width, self.height), (0, 0, 0))
+                completed_tiles = 0
+                for result in pool.imap_unordered(task, tasks):
+                    x, y, width, height, data = result[:5]
+                    self.image.paste(Image.frombytes("RGB", (width, height), data), (x, y))
+                    if stats is not None:
+                        stats.merge(result[5])
+                    if len(result) > 5:
+                        self.notify_tile(result[5])
+                    completed_tiles += 1
+                    self.notify_progress(completed_tiles, len(tiles))
+                
+                output_file = output_pattern.format(frame)
+                self.image.save(output_file)
+                print(f"Frame {frame + 1}/{frame_count} saved as {output_file} ({time.time() - frame_start:.2f} seconds)")
+        finally:
+            if shared is not None:
+                shared.close()
+            pool.terminate()
+            pool.join()
+        
+        time_taken = time.time() - start_time
+        print(f"Animation finished in {time_taken:.2f} seconds")
+        if stats is not None:
+            stats.report(time_taken)
+        self.notify_complete(time_taken)
     
     def render_preview(self, scale=0.25, max_depth=4, output_file="preview.png", samples=2):
         orig_width, orig_height = self.width, self.height
@@ -384,7 +1138,29 @@ class Renderer:
         
         return time_taken
 
-    def run(self, output_file="raytraced_scene.png", samples_per_pixel=None):
+    def run(self, output_file="raytraced_scene.png", samples_per_pixel=None, backend=None, scene_distribution=None,
+            adaptive=None, min_samples=None, max_samples=None, noise_threshold=None, progressive=None,
+            resume=None):
         if samples_per_pixel is not None:
             self.samples_per_pixel = samples_per_pixel
-        self.draw_scene(output_file)
\ No newline at end of file
+        if adaptive is not None:
+            self.adaptive_sampling = adaptive
+        if min_samples is not None:
+            self.min_samples = min_samples
+        if max_samples is not None:
+            self.max_samples = max_samples
+        if noise_threshold is not None:
+            self.noise_threshold = noise_threshold
+        if backend is not None:
+            self.backend = backend
+        if scene_distribution is not None:
+            self.scene_distribution = scene_distribution
+        if progressive is not None:
+            self.progressive = progressive
+        if resume is not None:
+            self.resume = resume
+        
+        if self.progressive:
+            self.draw_progressive(output_file)
+        else:
+            self.draw_scene(output_file)
\ No newline at end of file
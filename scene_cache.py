@@ -0,0 +1,123 @@
+import os
+import sys
+import mmap
+import pickle
+import struct
+import hashlib
+import numpy as np
+from shared_scene import flatten_objects, restore_objects, renderer_settings, ALIGNMENT
+from checkpoint import IGNORED_SETTINGS
+
+MAGIC = b"RTSCENE1\n"
+
+# Fonts, meshes and other data files read while setting up a scene; they are hashed
+# together with the sources, so replacing one invalidates the compiled scene
+data_files = set()
+
+
+def record_data_file(path):
+    data_files.add(os.path.abspath(path))
+
+
+def file_hash(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def source_hashes(scene_file):
+    # The scene file, the recorded data files and every module imported from the renderer's
+    # or the scene's directory tree; installed packages are not tracked
+    roots = [os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.path.abspath(scene_file))]
+    paths = {os.path.abspath(scene_file)} | data_files
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if not path or 'site-packages' in path:
+            continue
+        path = os.path.abspath(path)
+        if any(os.path.commonpath((root, path)) == root for root in roots):
+            paths.add(path)
+    return {path: file_hash(path) for path in sorted(paths)}
+
+
+def settings_snapshot(renderer):
+    return {key: pickle.dumps(value, protocol=4) for key, value in renderer_settings(renderer).items()}
+
+
+def setup_key(renderer):
+    # setup_scene may look at anything that is set before it runs, e.g. the image size
+    snapshot = settings_snapshot(renderer)
+    digest = hashlib.sha256()
+    for key in sorted(snapshot):
+        if key not in IGNORED_SETTINGS:
+            digest.update(key.encode())
+            digest.update(snapshot[key])
+    return digest.hexdigest()
+
+
+def compile_scene(path, renderer, scene_file, key, before):
+    # Stores what setup_scene built, with only the settings it changed since before; the
+    # geometry arrays are aligned so they can be mapped in place
+    layout, arrays, materials = flatten_objects(renderer.objects)
+    after = settings_snapshot(renderer)
+    settings = renderer_settings(renderer)
+    offsets = {}
+    size = 0
+    for name, array in arrays.items():
+        offsets[name] = (size, array.dtype.str, array.shape)
+        size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = pickle.dumps({
+        'layout': layout,
+        'materials': materials,
+        'settings': {name: settings[name] for name in after if after[name] != before.get(name)},
+        'arrays': offsets,
+    }, protocol=4)
+    sources = pickle.dumps(source_hashes(scene_file), protocol=4)
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(MAGIC)
+        f.write(key.encode("ascii") + b"\n")
+        f.write(struct.pack("<QQ", len(sources), len(header)))
+        f.write(sources)
+        f.write(header)
+        f.write(b"\0" * (-f.tell() % ALIGNMENT))
+        start = f.tell()
+        for name, array in arrays.items():
+            f.seek(start + offsets[name][0])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.seek(start + size)
+        f.truncate()
+    os.replace(temporary, path)
+    return size
+
+
+def load_compiled_scene(path, renderer, key):
+    # Replaces setup_scene when path was compiled from the same sources and settings;
+    # returns False when it is missing or stale
+    if not os.path.exists(path):
+        return False
+
+    with open(path, "rb") as f:
+        if f.readline() != MAGIC or f.readline().strip().decode("ascii", "replace") != key:
+            return False
+        source_size, header_size = struct.unpack("<QQ", f.read(16))
+        sources = pickle.loads(f.read(source_size))
+        if any(file_hash(source) != digest for source, digest in sources.items()):
+            return False
+        header = pickle.loads(f.read(header_size))
+        start = f.tell() + (-f.tell() % ALIGNMENT)
+        block = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # The views keep the mapping alive; meshes use them directly
+    views = {}
+    for name, (offset, dtype, shape) in header['arrays'].items():
+        views[name] = np.ndarray(shape, dtype=dtype, buffer=block, offset=start + offset)
+    renderer.objects = restore_objects(header['layout'], views, header['materials'])
+    renderer.__dict__.update(header['settings'])
+    renderer.accelerator = None
+    renderer.wavefront_scene = None
+    return True
@@ -1,7 +1,13 @@
 import math
+import numpy as np
 from vector import Vector
-from ray import EnhancedTriangle, Material
+from ray import EnhancedTriangle, EnhancedBox, EnhancedCylinder, Material
 from mesh_builder import MeshBuilder
+from triangle_mesh import TriangleMesh
+from instancing import Transform, MeshInstance
+
+# One mesh per shape and size, built around the origin and shared by every instanced placement
+_shape_meshes = {}
 
 def rotate_vertex(vertex, origin, rotation_degrees):
     angle_x = math.radians(rotation_degrees[0])
@@ -21,9 +27,70 @@ def rotate_vertex(vertex, origin, rotation_degrees):
     
     return Vector(x3 + origin.x, y3 + origin.y, z2 + origin.z)
 
-def create_rotated_shape(shape_type, center, size, rotation_degrees, color):
+def rotate_points(points, origin, rotation_degrees):
+    # rotate_vertex for an (n, 3) array of points
+    angle_x = math.radians(rotation_degrees[0])
+    angle_y = math.radians(rotation_degrees[1])
+    angle_z = math.radians(rotation_degrees[2])
+    
+    x = points[:, 0] - origin.x
+    y = points[:, 1] - origin.y
+    z = points[:, 2] - origin.z
+    
+    y1 = y * math.cos(angle_x) - z * math.sin(angle_x)
+    z1 = y * math.sin(angle_x) + z * math.cos(angle_x)
+    
+    x2 = x * math.cos(angle_y) + z1 * math.sin(angle_y)
+    z2 = -x * math.sin(angle_y) + z1 * math.cos(angle_y)
+    
+    x3 = x2 * math.cos(angle_z) - y1 * math.sin(angle_z)
+    y3 = x2 * math.sin(angle_z) + y1 * math.cos(angle_z)
+    
+    return np.stack((x3 + origin.x, y3 + origin.y, z2 + origin.z), axis=1)
+
+def make_turntable(renderer, turns=1.0):
+    # Frame callback for render_animation that orbits the current camera around its look-at point
+    camera = renderer.camera
+    position, look_at, up, fov = camera.position, camera.look_at, camera.up, camera.fov
+    
+    def update_frame(raster, frame, frame_count):
+        angle = 360.0 * turns * frame / frame_count
+        raster.set_camera(rotate_vertex(position, look_at, (0, angle, 0)), look_at, up, fov)
+    
+    return update_frame
+
+def shape_mesh(shape_type, size):
+    key = (shape_type, size)
+    if key not in _shape_meshes:
+        origin = Vector(0, 0, 0)
+        if shape_type == "cube":
+            triangles = MeshBuilder.create_cube(origin, size, (255, 255, 255))
+        elif shape_type == "pyramid":
+            triangles = MeshBuilder.create_pyramid(origin, size, size*1.5, (255, 255, 255))
+        elif shape_type == "cylinder":
+            triangles = MeshBuilder.create_cylinder(origin, size/2, size, 16, (255, 255, 255))
+        else:
+            raise ValueError(f"Unknown shape type: {shape_type}")
+        _shape_meshes[key] = TriangleMesh.from_triangles(triangles, Material((255, 255, 255)))
+    return _shape_meshes[key]
+
+def create_rotated_shape(shape_type, center, size, rotation_degrees, color, instanced=False, analytic=False):
     material = Material(color)
     
+    # Cubes and cylinders can also be single analytic primitives instead of triangles
+    if analytic and shape_type == "cube":
+        half = size / 2
+        return [EnhancedBox(Vector(center.x - half, center.y - half, center.z - half),
+                            Vector(center.x + half, center.y + half, center.z + half), material, rotation_degrees)]
+    if analytic and shape_type == "cylinder":
+        start = rotate_vertex(Vector(center.x, center.y + size/2, center.z), center, rotation_degrees)
+        end = rotate_vertex(Vector(center.x, center.y - size/2, center.z), center, rotation_degrees)
+        return [EnhancedCylinder(start, end, size/2, material)]
+    
+    if instanced and shape_type != "sphere":
+        transform = Transform.rotation(rotation_degrees).then(Transform.translation(center))
+        return [MeshInstance(shape_mesh(shape_type, size), transform, material)]
+    
     if shape_type == "cube":
         original_triangles = MeshBuilder.create_cube(center, size, color)
         
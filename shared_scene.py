@@ -0,0 +1,276 @@
+import gc
+import pickle
+import signal
+import numpy as np
+from multiprocessing import shared_memory
+from vector import Vector
+from ray import EnhancedSphere, EnhancedTriangle
+from triangle_mesh import TriangleMesh
+from instancing import MeshInstance
+
+ALIGNMENT = 64
+RENDERER_SKIPPED = ('objects', 'image', 'accelerator', 'wavefront_scene', 'progress_listeners', 'stats')
+
+_worker_renderer = None
+_worker_block = None
+_worker_views = None
+_worker_layout = None
+_worker_materials = None
+_worker_frame = None
+
+
+def flatten_objects(objects):
+    # Loose spheres and triangles go into flat rows, meshes contribute their arrays as they
+    # are; the layout keeps the original object order so nearest-hit ties resolve as before
+    layout = []
+    arrays = {}
+    sphere_rows = []
+    sphere_materials = []
+    triangle_rows = []
+    triangle_materials = []
+    materials = []
+    material_index = {}
+    shared_meshes = {}
+
+    def add_material(material):
+        if id(material) not in material_index:
+            material_index[id(material)] = len(materials)
+            materials.append(material)
+        return material_index[id(material)]
+
+    for obj in objects:
+        if type(obj) is EnhancedSphere:
+            layout.append(('sphere', len(sphere_rows)))
+            sphere_rows.append((obj.center.x, obj.center.y, obj.center.z, obj.radius))
+            sphere_materials.append(add_material(obj.get_material()))
+        elif type(obj) is EnhancedTriangle:
+            layout.append(('triangle', len(triangle_rows)))
+            triangle_rows.append((obj.v0.x, obj.v0.y, obj.v0.z, obj.v1.x, obj.v1.y, obj.v1.z,
+                                  obj.v2.x, obj.v2.y, obj.v2.z))
+            triangle_materials.append(add_material(obj.get_material()))
+        elif isinstance(obj, TriangleMesh):
+            layout.append(('mesh',) + flatten_mesh(obj, f"mesh{len(layout)}.", arrays))
+        elif type(obj) is MeshInstance:
+            # Every instance of a mesh points at the one copy of its arrays
+            if id(obj.mesh) not in shared_meshes:
+                shared_meshes[id(obj.mesh)] = (len(shared_meshes),) + flatten_mesh(obj.mesh, f"shared{len(shared_meshes)}.", arrays)
+            layout.append(('instance', shared_meshes[id(obj.mesh)], obj.transform, obj.material))
+        else:
+            layout.append(('object', obj))
+
+    arrays['spheres'] = np.array(sphere_rows, dtype=np.float64).reshape(-1, 4)
+    arrays['sphere_materials'] = np.array(sphere_materials, dtype=np.int32)
+    arrays['triangles'] = np.array(triangle_rows, dtype=np.float64).reshape(-1, 9)
+    arrays['triangle_materials'] = np.array(triangle_materials, dtype=np.int32)
+    return layout, arrays, materials
+
+
+def flatten_mesh(mesh, prefix, arrays):
+    state = {}
+    fields = {}
+    for key, value in mesh.__dict__.items():
+        if isinstance(value, np.ndarray):
+            arrays[prefix + key] = value
+            fields[key] = prefix + key
+        elif key not in ('_node_bounds', '_face_rows'):
+            state[key] = value
+    return state, fields
+
+
+def restore_mesh(state, fields, views):
+    mesh = TriangleMesh.__new__(TriangleMesh)
+    mesh.__dict__.update(state)
+    for key, name in fields.items():
+        setattr(mesh, key, views[name])
+    mesh._node_bounds = None
+    mesh._face_rows = None
+    return mesh
+
+
+def restore_objects(layout, views, materials):
+    # Meshes keep pointing at the views; loose primitives are rebuilt as small Python objects
+    # because the scalar ray path needs Vector fields
+    spheres = views['spheres'].tolist()
+    sphere_materials = views['sphere_materials'].tolist()
+    triangles = views['triangles'].tolist()
+    triangle_materials = views['triangle_materials'].tolist()
+    objects = []
+    shared_meshes = {}
+    for entry in layout:
+        if entry[0] == 'sphere':
+            x, y, z, radius = spheres[entry[1]]
+            objects.append(EnhancedSphere(Vector(x, y, z), radius, materials[sphere_materials[entry[1]]]))
+        elif entry[0] == 'triangle':
+            row = triangles[entry[1]]
+            objects.append(EnhancedTriangle(Vector(*row[0:3]), Vector(*row[3:6]), Vector(*row[6:9]),
+                                            materials[triangle_materials[entry[1]]]))
+        elif entry[0] == 'mesh':
+            objects.append(restore_mesh(entry[1], entry[2], views))
+        elif entry[0] == 'instance':
+            (slot, state, fields), transform, material = entry[1:]
+            if slot not in shared_meshes:
+                shared_meshes[slot] = restore_mesh(state, fields, views)
+            objects.append(MeshInstance(shared_meshes[slot], transform, material))
+        else:
+            objects.append(entry[1])
+    return objects
+
+
+def scene_signature(layout, arrays, materials):
+    # Everything a worker cannot pick up from new values in the existing block
+    meshes = [entry[1:] for entry in layout if entry[0] == 'mesh'] + [entry[1] for entry in layout if entry[0] == 'instance']
+    shapes = {name: (array.dtype.str, array.shape) for name, array in arrays.items()}
+    return tuple(entry[0] for entry in layout), shapes, pickle.dumps((materials, meshes), protocol=4)
+
+
+def renderer_settings(renderer):
+    return {key: value for key, value in renderer.__dict__.items() if key not in RENDERER_SKIPPED}
+
+
+class SharedScene:
+    def __init__(self, renderer):
+        self.block = None
+        self.share(renderer, *flatten_objects(renderer.objects))
+
+    def share(self, renderer, layout, arrays, materials):
+        offsets = {}
+        size = 0
+        for name, array in arrays.items():
+            offsets[name] = (size, array.dtype.str, array.shape)
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+        self.block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, array in arrays.items():
+            offset, dtype, shape = offsets[name]
+            np.ndarray(shape, dtype=dtype, buffer=self.block.buf, offset=offset)[...] = array
+
+        self.manifest = {
+            'block': self.block.name,
+            'arrays': offsets,
+            'layout': layout,
+            'materials': materials,
+            'renderer_class': type(renderer),
+            'settings': renderer_settings(renderer),
+        }
+        self.size = size
+        self.signature = scene_signature(layout, arrays, materials)
+
+    def update(self, renderer):
+        # Next animation frame. While the scene keeps its shape the new values are written
+        # over the old ones in place and workers only receive settings and instance
+        # transforms; anything else is shared again in a fresh block. Returns the pickled
+        # update each worker applies before its first tile of the frame.
+        layout, arrays, materials = flatten_objects(renderer.objects)
+        if scene_signature(layout, arrays, materials) != self.signature:
+            self.close()
+            self.share(renderer, layout, arrays, materials)
+            return pickle.dumps({'manifest': self.manifest}, protocol=4)
+
+        for name, array in arrays.items():
+            offset, dtype, shape = self.manifest['arrays'][name]
+            np.ndarray(shape, dtype=dtype, buffer=self.block.buf, offset=offset)[...] = array
+        update = {
+            'settings': renderer_settings(renderer),
+            'instances': {index: entry[2:] for index, entry in enumerate(layout) if entry[0] == 'instance'},
+            'objects': {index: entry[1] for index, entry in enumerate(layout) if entry[0] == 'object'},
+        }
+        return pickle.dumps(update, protocol=4)
+
+    def close(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def attach_views(block, offsets):
+    views = {}
+    for name, (offset, dtype, shape) in offsets.items():
+        view = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+        view.flags.writeable = False
+        views[name] = view
+    return views
+
+
+def ignore_interrupts():
+    # Ctrl-C is handled once by the parent, which saves what it has and stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def init_worker(manifest):
+    # Pool initializer: map the scene block and build this process' renderer around views into it
+    global _worker_renderer, _worker_block, _worker_views, _worker_layout, _worker_materials
+    ignore_interrupts()
+    _worker_block = shared_memory.SharedMemory(name=manifest['block'])
+    views = attach_views(_worker_block, manifest['arrays'])
+    _worker_views = views
+    _worker_layout = manifest['layout']
+    _worker_materials = manifest['materials']
+    objects = restore_objects(manifest['layout'], views, manifest['materials'])
+    _worker_renderer = build_worker_renderer(manifest['renderer_class'], manifest['settings'], objects)
+
+
+def build_worker_renderer(renderer_class, settings, objects):
+    # A renderer around already restored objects, without running __init__ or setup_scene
+    renderer = renderer_class.__new__(renderer_class)
+    renderer.__dict__.update(settings)
+    renderer.objects = objects
+    renderer.image = None
+    renderer.accelerator = None
+    renderer.wavefront_scene = None
+    renderer.stats = None
+    renderer.progress_listeners = []
+    renderer.prepare_render(verbose=False)
+    return renderer
+
+
+def call_worker(method, task):
+    return getattr(_worker_renderer, method)(task)
+
+
+def release_worker():
+    global _worker_renderer, _worker_block, _worker_views
+    _worker_renderer = None
+    _worker_views = None
+    gc.collect()
+    try:
+        _worker_block.close()
+    except BufferError:
+        # A view is still referenced somewhere; the mapping goes away together with it
+        pass
+    _worker_block = None
+
+
+def refresh_worker(update):
+    if 'manifest' in update:
+        release_worker()
+        init_worker(update['manifest'])
+        return
+
+    # The block already holds the new positions; rebuild the light Python objects around
+    # it and let the acceleration structures refit to them
+    layout = list(_worker_layout)
+    for index, (transform, material) in update['instances'].items():
+        layout[index] = ('instance', layout[index][1], transform, material)
+    for index, obj in update['objects'].items():
+        layout[index] = ('object', obj)
+    renderer = _worker_renderer
+    renderer.__dict__.update(update['settings'])
+    renderer.objects = restore_objects(layout, _worker_views, _worker_materials)
+    renderer.refit_scene()
+
+
+def call_frame_worker(method, task):
+    # Animation tasks are (frame, update, work); the update is applied once per frame
+    global _worker_frame
+    frame, update, work = task
+    if update is not None and frame != _worker_frame:
+        refresh_worker(pickle.loads(update))
+    _worker_frame = frame
+    return getattr(_worker_renderer, method)(work)
@@ -0,0 +1,151 @@
+import json
+import time
+import socket
+import threading
+from ray_stats import resident_memory
+
+
+def open_stream(target):
+    # "unix:/path" and "tcp:host:port" connect to a listening socket, anything else is a
+    # file that records are appended to; either way every record is flushed as one line
+    if target.startswith("unix:"):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(target[5:])
+        return connection.makefile("w", buffering=1)
+    if target.startswith("tcp:"):
+        host, port = target[4:].rsplit(":", 1)
+        return socket.create_connection((host, int(port))).makefile("w", buffering=1)
+    return open(target, "a", buffering=1)
+
+
+# Writes a "progress" JSON line every interval, even without finished tiles, so a stalled
+# worker shows growing idle_seconds; a "summary" line ends the render
+class TelemetryListener:
+    def __init__(self, target, interval=5.0):
+        self.target = target
+        self.interval = interval
+        self.stream = open_stream(target)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = time.time()
+        self.phase = None
+        self.phase_started = self.started
+        self.phase_seconds = {}
+        self.trace_started = None
+        self.completed = 0
+        self.total = 0
+        self.workers = {}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.emit(self.progress_record())
+
+    def emit(self, record):
+        with self.lock:
+            if self.stream is None:
+                return
+            try:
+                self.stream.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print(f"Telemetry to {self.target} stopped: {e}")
+                self.stream = None
+
+    def end_phase(self, now):
+        if self.phase is not None:
+            self.phase_seconds[self.phase] = self.phase_seconds.get(self.phase, 0.0) + now - self.phase_started
+
+    def on_phase_change(self, phase):
+        with self.lock:
+            now = time.time()
+            self.end_phase(now)
+            self.phase = phase
+            self.phase_started = now
+            if phase == "trace" and self.trace_started is None:
+                self.trace_started = now
+        self.start()
+        self.emit(self.progress_record())
+
+    def on_tile_complete(self, stats):
+        with self.lock:
+            worker = self.workers.setdefault(stats.worker, {'tiles': 0, 'rays': 0, 'seconds': 0.0, 'memory': None,
+                                                            'peak_memory': None, 'last_tile': None})
+            worker['tiles'] += 1
+            worker['rays'] += sum(stats.rays.values())
+            worker['seconds'] += stats.seconds
+            worker['memory'] = stats.memory
+            if stats.memory is not None:
+                worker['peak_memory'] = max(worker['peak_memory'] or 0.0, stats.memory)
+            worker['last_tile'] = time.time()
+
+    def on_progress_update(self, completed, total):
+        with self.lock:
+            self.completed = completed
+            self.total = total
+            if self.trace_started is None:
+                self.trace_started = time.time()
+        self.start()
+
+    def worker_records(self, now):
+        # Rays per second are measured over the time a worker spent on its tiles
+        return [{
+            'pid': pid,
+            'tiles': worker['tiles'],
+            'rays': worker['rays'],
+            'rays_per_second': worker['rays'] / worker['seconds'] if worker['seconds'] > 0 else 0.0,
+            'rss_mib': worker['memory'],
+            'peak_rss_mib': worker['peak_memory'],
+            'idle_seconds': now - worker['last_tile'],
+        } for pid, worker in sorted(self.workers.items())]
+
+    def progress_record(self):
+        with self.lock:
+            now = time.time()
+            eta = None
+            if self.trace_started is not None and 0 < self.completed < self.total:
+                eta = (now - self.trace_started) / self.completed * (self.total - self.completed)
+            workers = self.worker_records(now)
+            return {
+                'type': "progress",
+                'time': now,
+                'elapsed_seconds': now - self.started,
+                'phase': self.phase,
+                'completed_tiles': self.completed,
+                'total_tiles': self.total,
+                'eta_seconds': eta,
+                'rays_per_second': sum(worker['rays_per_second'] for worker in workers),
+                'rss_mib': resident_memory(),
+                'workers': workers,
+            }
+
+    def on_render_complete(self, time_taken):
+        self.stopped.set()
+        with self.lock:
+            now = time.time()
+            self.end_phase(now)
+            self.phase = None
+            workers = self.worker_records(now)
+            rays = sum(worker['rays'] for worker in workers)
+            record = {
+                'type': "summary",
+                'time': now,
+                'elapsed_seconds': now - self.started,
+                'render_seconds': time_taken,
+                'completed_tiles': self.completed,
+                'total_tiles': self.total,
+                'rays': rays,
+                'rays_per_second': rays / time_taken if time_taken > 0 else 0.0,
+                'phase_seconds': self.phase_seconds,
+                'rss_mib': resident_memory(),
+                'workers': workers,
+            }
+        self.emit(record)
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
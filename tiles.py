@@ -0,0 +1,68 @@
+TILE_ORDERS = ("spiral", "hilbert", "scanline")
+
+
+def spiral_order(cols, rows):
+    # Square spiral walked outward from the centre tile, so the middle of the frame finishes first
+    x, y = (cols - 1) // 2, (rows - 1) // 2
+    dx, dy = 1, 0
+    cells = []
+    step = 1
+    while len(cells) < cols * rows:
+        for _ in range(2):
+            for _ in range(step):
+                if 0 <= x < cols and 0 <= y < rows:
+                    cells.append((x, y))
+                x, y = x + dx, y + dy
+            dx, dy = -dy, dx
+        step += 1
+    return cells
+
+
+def hilbert_point(n, d):
+    x = y = 0
+    s = 1
+    while s < n:
+        rx = 1 & (d // 2)
+        ry = 1 & (d ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        d //= 4
+        s *= 2
+    return x, y
+
+
+def hilbert_order(cols, rows):
+    n = 1
+    while n < max(cols, rows):
+        n *= 2
+    cells = []
+    for d in range(n * n):
+        x, y = hilbert_point(n, d)
+        if x < cols and y < rows:
+            cells.append((x, y))
+    return cells
+
+
+def make_tiles(width, height, tile_size=32, order="spiral"):
+    cols = -(-width // tile_size)
+    rows = -(-height // tile_size)
+
+    if order == "spiral":
+        cells = spiral_order(cols, rows)
+    elif order == "hilbert":
+        cells = hilbert_order(cols, rows)
+    elif order == "scanline":
+        cells = [(col, row) for row in range(rows) for col in range(cols)]
+    else:
+        raise ValueError(f"Unknown tile order: {order}")
+
+    tiles = []
+    for col, row in cells:
+        x = col * tile_size
+        y = row * tile_size
+        tiles.append((x, y, min(tile_size, width - x), min(tile_size, height - y)))
+    return tiles
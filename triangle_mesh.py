@@ -0,0 +1,336 @@
+import numpy as np
+from vector import Vector
+from bvh import ray_inverse, box_entry
+from ray_batch import INF, EPSILON, cross, normalize, inverse_directions, box_hits, intersect_triangles, closest_hits
+
+NO_FACE = np.iinfo(np.int64).max
+
+
+def spread_bits(x):
+    x = x & np.uint64(0x3ff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x30000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x300f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x9249249)
+    return x
+
+
+def morton_order(points):
+    lo = points.min(axis=0)
+    extent = points.max(axis=0) - lo
+    extent[extent == 0] = 1.0
+    q = ((points - lo) / extent * 1023).astype(np.uint64)
+    codes = spread_bits(q[:, 0]) | (spread_bits(q[:, 1]) << np.uint64(1)) | (spread_bits(q[:, 2]) << np.uint64(2))
+    return np.argsort(codes, kind='stable')
+
+
+class MeshFace:
+    __slots__ = ('mesh', 'index', 'material', 'color')
+
+    def __init__(self, mesh, index):
+        self.mesh = mesh
+        self.index = index
+        self.material = mesh.materials[mesh.material_ids[index]]
+        self.color = self.material.color
+
+    def __eq__(self, other):
+        return isinstance(other, MeshFace) and other.mesh is self.mesh and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.mesh), self.index))
+
+    def intersects(self, ray_origin, ray_direction):
+        t, _ = self.mesh.intersect(ray_origin, ray_direction, faces=np.array([self.index]))
+        return t if t < INF else None
+
+    def get_normal(self, _):
+        return Vector(*self.mesh.normals[self.index].tolist())
+
+    def get_material(self):
+        return self.material
+
+    def get_bounds(self):
+        corners = self.mesh.vertices[self.mesh.indices[self.index]]
+        return Vector(*corners.min(axis=0).tolist()), Vector(*corners.max(axis=0).tolist())
+
+
+class TriangleMesh:
+    def __init__(self, vertices, indices, materials, material_ids=None, leaf_size=8):
+        if not isinstance(materials, (list, tuple)):
+            materials = [materials]
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape(-1, 3)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int32).reshape(-1, 3)
+        self.materials = list(materials)
+        if material_ids is None:
+            material_ids = np.zeros(len(self.indices), dtype=np.uint16)
+        self.material_ids = np.ascontiguousarray(material_ids, dtype=np.uint16)
+        self.material = self.materials[0]
+        self.color = self.material.color
+        self.leaf_size = leaf_size
+        self.order = None
+        self.update_geometry()
+
+    @classmethod
+    def from_triangles(cls, triangles, material=None):
+        vertex_index = {}
+        vertices = []
+        indices = []
+        materials = []
+        material_index = {}
+        material_ids = []
+
+        for triangle in triangles:
+            face = []
+            for v in (triangle.v0, triangle.v1, triangle.v2):
+                key = (v.x, v.y, v.z)
+                if key not in vertex_index:
+                    vertex_index[key] = len(vertices)
+                    vertices.append(key)
+                face.append(vertex_index[key])
+            indices.append(face)
+
+            face_material = material if material is not None else triangle.get_material()
+            if id(face_material) not in material_index:
+                material_index[id(face_material)] = len(materials)
+                materials.append(face_material)
+            material_ids.append(material_index[id(face_material)])
+
+        return cls(vertices, indices, materials, material_ids)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getstate__(self):
+        # Only the source arrays travel; edges, normals and tree bounds are rebuilt on load
+        derived = ('v0', 'edge1', 'edge2', 'normals', 'node_lo', 'node_hi', '_node_bounds', '_face_rows')
+        return {key: value for key, value in self.__dict__.items() if key not in derived}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.update_geometry(rebuild=False)
+
+    def update_geometry(self, rebuild=True):
+        v0 = self.vertices[self.indices[:, 0]]
+        v1 = self.vertices[self.indices[:, 1]]
+        v2 = self.vertices[self.indices[:, 2]]
+        self.v0 = v0
+        self.edge1 = v1 - v0
+        self.edge2 = v2 - v0
+        self.normals = normalize(cross(self.edge1, self.edge2))
+
+        face_lo = np.minimum(np.minimum(v0, v1), v2)
+        face_hi = np.maximum(np.maximum(v0, v1), v2)
+        pad = 1e-6 * np.maximum(1.0, np.maximum(np.abs(face_lo).max(axis=1), np.abs(face_hi).max(axis=1)))
+        face_lo -= pad[:, None]
+        face_hi += pad[:, None]
+
+        if rebuild or self.order is None or len(self.order) != len(self.indices):
+            self.order = morton_order((face_lo + face_hi) * 0.5) if len(self.indices) else np.zeros(0, dtype=np.int64)
+        self._refit(face_lo, face_hi)
+
+    def _refit(self, face_lo, face_hi):
+        # Implicit binary tree over runs of leaf_size faces in Morton order; node i has
+        # children 2i+1 and 2i+2 and the leaves start at index leaf_width - 1
+        count = len(self.order)
+        leaf_count = max(1, -(-count // self.leaf_size))
+        width = 1 << (leaf_count - 1).bit_length()
+        node_lo = np.full((2 * width - 1, 3), INF)
+        node_hi = np.full((2 * width - 1, 3), -INF)
+        if count:
+            starts = np.arange(0, count, self.leaf_size)
+            node_lo[width - 1:width - 1 + len(starts)] = np.minimum.reduceat(face_lo[self.order], starts, axis=0)
+            node_hi[width - 1:width - 1 + len(starts)] = np.maximum.reduceat(face_hi[self.order], starts, axis=0)
+
+        level = width
+        while level > 1:
+            parents = level // 2
+            node_lo[parents - 1:level - 1] = node_lo[level - 1:2 * level - 1].reshape(parents, 2, 3).min(axis=1)
+            node_hi[parents - 1:level - 1] = node_hi[level - 1:2 * level - 1].reshape(parents, 2, 3).max(axis=1)
+            level = parents
+
+        self.leaf_width = width
+        self.node_lo = node_lo
+        self.node_hi = node_hi
+        self._node_bounds = None
+        self._face_rows = None
+
+    def leaf_faces(self, node):
+        leaf = node - (self.leaf_width - 1)
+        return self.order[leaf * self.leaf_size:(leaf + 1) * self.leaf_size]
+
+    def _mirror_lists(self):
+        # Single rays are cheaper in plain Python than through numpy, so the tree and
+        # the precomputed edges are mirrored into lists the first time they are needed
+        if self._node_bounds is None:
+            self._node_bounds = np.hstack((self.node_lo, self.node_hi)).tolist()
+            self._face_rows = np.hstack((self.v0, self.edge1, self.edge2)).tolist()
+
+    def intersect(self, ray_origin, ray_direction, max_distance=INF, faces=None):
+        self._mirror_lists()
+        rows = self._face_rows
+        best_t = INF
+        best_face = NO_FACE
+
+        dx, dy, dz = ray_direction.x, ray_direction.y, ray_direction.z
+        ox, oy, oz = ray_origin.x, ray_origin.y, ray_origin.z
+
+        if faces is None:
+            bounds = self._node_bounds
+            ix, iy, iz = ray_inverse(ray_direction)
+            first_leaf = self.leaf_width - 1
+            order = self.order
+            leaf_size = self.leaf_size
+            stack = [0]
+            while stack:
+                node = stack.pop()
+                limit = best_t if best_t < max_distance else max_distance
+                if box_entry(bounds[node], ox, oy, oz, ix, iy, iz, limit) is None:
+                    continue
+                if node < first_leaf:
+                    stack.append(2 * node + 2)
+                    stack.append(2 * node + 1)
+                    continue
+                leaf = (node - first_leaf) * leaf_size
+                candidates = order[leaf:leaf + leaf_size].tolist()
+                best_t, best_face = self._closest_face(candidates, rows, ox, oy, oz, dx, dy, dz, best_t, best_face, max_distance)
+        else:
+            best_t, best_face = self._closest_face(list(faces), rows, ox, oy, oz, dx, dy, dz, best_t, best_face, max_distance)
+
+        if best_face == NO_FACE:
+            return INF, -1
+        return best_t, best_face
+
+    @staticmethod
+    def _closest_face(faces, rows, ox, oy, oz, dx, dy, dz, best_t, best_face, max_distance):
+        # Same arithmetic as EnhancedTriangle.intersects with the edges already in place
+        for face in faces:
+            v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z = rows[face]
+            hx = dy * e2z - dz * e2y
+            hy = dz * e2x - dx * e2z
+            hz = dx * e2y - dy * e2x
+            a = e1x * hx + e1y * hy + e1z * hz
+            if -EPSILON < a < EPSILON:
+                continue
+            f = 1.0 / a
+            sx, sy, sz = ox - v0x, oy - v0y, oz - v0z
+            u = f * (sx * hx + sy * hy + sz * hz)
+            if u < 0.0 or u > 1.0:
+                continue
+            qx = sy * e1z - sz * e1y
+            qy = sz * e1x - sx * e1z
+            qz = sx * e1y - sy * e1x
+            v = f * (dx * qx + dy * qy + dz * qz)
+            if v < 0.0 or u + v > 1.0:
+                continue
+            t = f * (e2x * qx + e2y * qy + e2z * qz)
+            if t > EPSILON and t < max_distance and (t < best_t or (t == best_t and face < best_face)):
+                best_t, best_face = t, face
+        return best_t, best_face
+
+    def occluders(self, ray_origin, ray_direction, max_distance=INF, transparencies=None):
+        # Transparent faces crossed before max_distance as (t, transparency), or None as
+        # soon as an opaque face blocks the segment
+        self._mirror_lists()
+        rows = self._face_rows
+        bounds = self._node_bounds
+        if transparencies is None:
+            transparencies = [getattr(material, 'transparency', 0.0) for material in self.materials]
+        material_ids = self.material_ids
+        hits = []
+
+        dx, dy, dz = ray_direction.x, ray_direction.y, ray_direction.z
+        ox, oy, oz = ray_origin.x, ray_origin.y, ray_origin.z
+        ix, iy, iz = ray_inverse(ray_direction)
+        first_leaf = self.leaf_width - 1
+        order = self.order
+        leaf_size = self.leaf_size
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if box_entry(bounds[node], ox, oy, oz, ix, iy, iz, max_distance) is None:
+                continue
+            if node < first_leaf:
+                stack.append(2 * node + 2)
+                stack.append(2 * node + 1)
+                continue
+            leaf = (node - first_leaf) * leaf_size
+            for face in order[leaf:leaf + leaf_size].tolist():
+                v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z = rows[face]
+                hx = dy * e2z - dz * e2y
+                hy = dz * e2x - dx * e2z
+                hz = dx * e2y - dy * e2x
+                a = e1x * hx + e1y * hy + e1z * hz
+                if -EPSILON < a < EPSILON:
+                    continue
+                f = 1.0 / a
+                sx, sy, sz = ox - v0x, oy - v0y, oz - v0z
+                u = f * (sx * hx + sy * hy + sz * hz)
+                if u < 0.0 or u > 1.0:
+                    continue
+                qx = sy * e1z - sz * e1y
+                qy = sz * e1x - sx * e1z
+                qz = sx * e1y - sy * e1x
+                v = f * (dx * qx + dy * qy + dz * qz)
+                if v < 0.0 or u + v > 1.0:
+                    continue
+                t = f * (e2x * qx + e2y * qy + e2z * qz)
+                if t > EPSILON and t < max_distance:
+                    transparency = transparencies[material_ids[face]]
+                    if transparency <= 0:
+                        return None
+                    hits.append((t, transparency))
+        return hits
+
+    def intersect_batch(self, origins, directions, max_distance=INF):
+        count = len(origins)
+        best_t = np.full(count, INF)
+        best_face = np.full(count, NO_FACE, dtype=np.int64)
+        max_distance = np.broadcast_to(np.asarray(max_distance, dtype=np.float64), (count,))
+
+        if count and len(self.order):
+            inverse = inverse_directions(directions)
+            first_leaf = self.leaf_width - 1
+            stack = [(0, np.arange(count))]
+            while stack:
+                node, rays = stack.pop()
+                limit = np.minimum(best_t[rays], max_distance[rays])
+                rays = rays[box_hits(self.node_lo[node], self.node_hi[node], origins[rays], inverse[rays], limit)]
+                if not len(rays):
+                    continue
+                if node < first_leaf:
+                    stack.append((2 * node + 2, rays))
+                    stack.append((2 * node + 1, rays))
+                    continue
+
+                leaf = self.leaf_faces(node)
+                t = intersect_triangles(origins[rays], directions[rays], self.v0[leaf], self.edge1[leaf], self.edge2[leaf])
+                t, column = closest_hits(t, leaf)
+                face = leaf[column]
+                current = best_t[rays]
+                better = (t < max_distance[rays]) & ((t < current) | ((t == current) & (face < best_face[rays])))
+                best_t[rays[better]] = t[better]
+                best_face[rays[better]] = face[better]
+
+        best_face[best_face == NO_FACE] = -1
+        return best_t, best_face
+
+    def intersects(self, ray_origin, ray_direction):
+        t, _ = self.intersect(ray_origin, ray_direction)
+        return t if t < INF else None
+
+    def cast(self, ray_origin, ray_direction, max_distance=INF):
+        t, face = self.intersect(ray_origin, ray_direction, max_distance)
+        if face < 0:
+            return None, INF
+        return MeshFace(self, face), t
+
+    def face(self, index):
+        return MeshFace(self, index)
+
+    def get_bounds(self):
+        used = self.vertices[self.indices.ravel()] if len(self.indices) else np.zeros((1, 3))
+        return Vector(*used.min(axis=0).tolist()), Vector(*used.max(axis=0).tolist())
+
+    def get_material(self):
+        return self.material
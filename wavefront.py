@@ -0,0 +1,747 @@
+import numpy as np
+from vector import Vector
+from ray import EnhancedSphere, EnhancedTriangle
+from lighting import PointLight, DirectionalLight
+from bvh import BVH, build_nodes
+from triangle_mesh import TriangleMesh
+from instancing import MeshInstance
+from gbuffer import split_samples, empty_terms
+from ray_batch import (INF, dot, normalize, inverse_directions, box_hits, intersect_spheres,
+                       intersect_triangles, closest_hits)
+
+KIND_NONE = 0
+KIND_SPHERE = 1
+KIND_TRIANGLE = 2
+KIND_MESH = 3
+KIND_OTHER = 4
+KIND_INSTANCE = 5
+KIND_ANALYTIC = 6
+
+INSTANCE_SHIFT = 32
+
+NO_KEY = np.iinfo(np.int64).max
+
+
+def hit_key(object_index, face=0):
+    # Sort key for equal-distance hits: scene order first, then face order inside a mesh
+    return (object_index << 32) | face
+
+
+class WavefrontScene:
+    def __init__(self, objects, max_leaf_size=8):
+        self.materials = []
+        self._material_index = {}
+        self.checkers = []
+        # A RayStats instance while the renderer collects statistics
+        self.stats = None
+
+        spheres, triangles, meshes, instances, analytic, unbounded, others = [], [], [], [], [], [], []
+        for index, obj in enumerate(objects):
+            if isinstance(obj, EnhancedSphere):
+                spheres.append((index, obj))
+            elif isinstance(obj, EnhancedTriangle):
+                triangles.append((index, obj))
+            elif isinstance(obj, TriangleMesh):
+                meshes.append((index, obj))
+            elif isinstance(obj, MeshInstance):
+                instances.append((index, obj))
+            elif hasattr(obj, 'intersect_rays'):
+                # Analytic primitives without finite bounds, like planes, are tested on every ray
+                if np.isfinite(BVH.object_bounds(obj)).all():
+                    analytic.append((index, obj))
+                else:
+                    unbounded.append((index, obj))
+            else:
+                others.append((index, obj))
+
+        prims = ([(KIND_SPHERE, item) for item in spheres] + [(KIND_TRIANGLE, item) for item in triangles] +
+                 [(KIND_MESH, item) for item in meshes] + [(KIND_INSTANCE, item) for item in instances] +
+                 [(KIND_ANALYTIC, item) for item in analytic])
+        nodes, order = build_nodes([BVH.object_bounds(obj) for _, (_, obj) in prims], max_leaf_size)
+
+        # Reorder primitives so every leaf owns one contiguous run of each primitive kind
+        ordered = {KIND_SPHERE: [], KIND_TRIANGLE: [], KIND_MESH: [], KIND_INSTANCE: [], KIND_ANALYTIC: []}
+        self.node_children = []
+        self.node_leaf = []
+        self.node_spans = []
+        for node in nodes:
+            self.node_children.append((node[1], node[2], node[5]))
+            self.node_spans.append((node[3], node[4]))
+            if node[4]:
+                starts = {kind: len(items) for kind, items in ordered.items()}
+                for i in order[node[3]:node[3] + node[4]]:
+                    kind, item = prims[i]
+                    ordered[kind].append(item)
+                self.node_leaf.append(tuple((starts[kind], len(ordered[kind]))
+                                            for kind in (KIND_SPHERE, KIND_TRIANGLE, KIND_MESH, KIND_INSTANCE, KIND_ANALYTIC)))
+            else:
+                self.node_leaf.append(None)
+
+        # The tables below only remember scene indices so refit can refill them from moved objects
+        self.object_types = [type(obj) for obj in objects]
+        self.leaf_objects = [prims[i][1][0] for i in order]
+        self.sphere_objects = [index for index, _ in ordered[KIND_SPHERE]]
+        self.sphere_keys = np.array([hit_key(index) for index in self.sphere_objects], dtype=np.int64)
+        self.triangle_objects = [index for index, _ in ordered[KIND_TRIANGLE]]
+        self.triangle_keys = np.array([hit_key(index) for index in self.triangle_objects], dtype=np.int64)
+        self.mesh_objects = [index for index, _ in ordered[KIND_MESH]]
+        self.instance_objects = [index for index, _ in ordered[KIND_INSTANCE]]
+        # Unbounded primitives come after the ones in the tree
+        self.analytic_objects = [index for index, _ in ordered[KIND_ANALYTIC] + unbounded]
+        self.unbounded_start = len(ordered[KIND_ANALYTIC])
+        self.other_objects = [index for index, _ in others]
+        self.fill(objects)
+
+    def fill(self, objects):
+        bounds = np.array([BVH.object_bounds(objects[index]) for index in self.leaf_objects], dtype=np.float64).reshape(-1, 6)
+        node_bounds = np.empty((len(self.node_spans), 6))
+        for node in range(len(self.node_spans) - 1, -1, -1):
+            start, count = self.node_spans[node]
+            if count:
+                node_lo = bounds[start:start + count, :3].min(axis=0)
+                node_hi = bounds[start:start + count, 3:].max(axis=0)
+            else:
+                left, right, _ = self.node_children[node]
+                node_lo = np.minimum(node_bounds[left, :3], node_bounds[right, :3])
+                node_hi = np.maximum(node_bounds[left, 3:], node_bounds[right, 3:])
+            node_bounds[node, :3] = node_lo
+            node_bounds[node, 3:] = node_hi
+        self.node_bounds = node_bounds
+
+        spheres = [objects[index] for index in self.sphere_objects]
+        self.sphere_centers = np.array([(o.center.x, o.center.y, o.center.z) for o in spheres], dtype=np.float64).reshape(-1, 3)
+        self.sphere_radii = np.array([o.radius for o in spheres], dtype=np.float64)
+        self.sphere_materials = np.array([self.material_id(o.get_material()) for o in spheres], dtype=np.int64)
+
+        triangles = [objects[index] for index in self.triangle_objects]
+        v0 = np.array([(o.v0.x, o.v0.y, o.v0.z) for o in triangles], dtype=np.float64).reshape(-1, 3)
+        v1 = np.array([(o.v1.x, o.v1.y, o.v1.z) for o in triangles], dtype=np.float64).reshape(-1, 3)
+        v2 = np.array([(o.v2.x, o.v2.y, o.v2.z) for o in triangles], dtype=np.float64).reshape(-1, 3)
+        self.triangle_v0 = v0
+        self.triangle_edge1 = v1 - v0
+        self.triangle_edge2 = v2 - v0
+        self.triangle_normals = np.array([(o.normal.x, o.normal.y, o.normal.z) for o in triangles], dtype=np.float64).reshape(-1, 3)
+        self.triangle_materials = np.array([self.material_id(o.get_material()) for o in triangles], dtype=np.int64)
+
+        # Mesh hits are stored as offset + face into the concatenated per-face tables
+        self.meshes = [objects[index] for index in self.mesh_objects]
+        self.mesh_offsets = np.cumsum([0] + [len(mesh) for mesh in self.meshes])
+        self.mesh_normals = np.concatenate([mesh.normals for mesh in self.meshes]) if self.meshes else np.zeros((0, 3))
+        self.mesh_materials = np.concatenate(
+            [np.array([self.material_id(m) for m in mesh.materials], dtype=np.int64)[mesh.material_ids]
+             for mesh in self.meshes]) if self.meshes else np.zeros(0, dtype=np.int64)
+
+        # Instance hits are stored as slot << INSTANCE_SHIFT | face; the shared meshes keep
+        # their object-space tables and normals are moved to world space per hit
+        self.instances = [objects[index] for index in self.instance_objects]
+        self.instance_materials = [
+            np.array([self.material_id(instance.material)] * len(instance.mesh.materials) if instance.material is not None
+                     else [self.material_id(m) for m in instance.mesh.materials], dtype=np.int64)[instance.mesh.material_ids]
+            for instance in self.instances]
+
+        self.analytic = [objects[index] for index in self.analytic_objects]
+        self.analytic_materials = np.array([self.material_id(o.get_material()) for o in self.analytic], dtype=np.int64)
+
+        # Anything without a batched intersection routine is traced one ray at a time
+        self.others = [(index, objects[index]) for index in self.other_objects]
+        self.other_materials = np.array([self.material_id(o.get_material()) if hasattr(o, 'get_material') else -1
+                                         for _, o in self.others], dtype=np.int64)
+
+        self.material_colors = np.array([m.color for m in self.materials], dtype=np.float64).reshape(-1, 3)
+        self.material_reflectivity = np.array([m.reflectivity for m in self.materials], dtype=np.float64)
+        self.material_transparency = np.array([m.transparency for m in self.materials], dtype=np.float64)
+        self.material_ior = np.array([m.refractive_index for m in self.materials], dtype=np.float64)
+
+    def refit(self, objects):
+        # Animation frames keep the tree and the primitive order and only refill the tables;
+        # False when the objects no longer match them
+        objects = list(objects)
+        if [type(obj) for obj in objects] != self.object_types:
+            return False
+        if [len(objects[index]) for index in self.mesh_objects] != [len(mesh) for mesh in self.meshes]:
+            return False
+        if [len(objects[index].mesh) for index in self.instance_objects] != [len(instance.mesh) for instance in self.instances]:
+            return False
+        if not np.isfinite([BVH.object_bounds(objects[index]) for index in self.leaf_objects]).all():
+            return False
+        self.fill(objects)
+        return True
+
+    def material_id(self, material):
+        key = id(material)
+        if key not in self._material_index:
+            self._material_index[key] = len(self.materials)
+            self.materials.append(material)
+            if hasattr(material, 'material_at'):
+                self.checkers.append((self._material_index[key], material, self.material_id(material.material1),
+                                      self.material_id(material.material2)))
+        return self._material_index[key]
+
+    def resolve_materials(self, material, points, normals):
+        # Hits on checker materials take one of the checker's two materials by hit point
+        for checker_id, checker, first, second in self.checkers:
+            hits = np.nonzero(material == checker_id)[0]
+            if len(hits):
+                material[hits] = np.where(checker.first_at(points[hits], normals[hits]), first, second)
+        return material
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_material_index'] = {}
+        return state
+
+    def intersect(self, origins, directions, max_distance):
+        count = len(origins)
+        t_hit = np.full(count, INF)
+        kind = np.zeros(count, dtype=np.int8)
+        prim = np.full(count, -1, dtype=np.int64)
+        key = np.full(count, NO_KEY, dtype=np.int64)
+        max_distance = np.broadcast_to(np.asarray(max_distance, dtype=np.float64), (count,))
+        state = (t_hit, kind, prim, key, max_distance)
+        stats = self.stats
+
+        if count and len(self.node_children):
+            inverse = inverse_directions(directions)
+            stack = [(0, np.arange(count))]
+            while stack:
+                node_index, rays = stack.pop()
+                bounds = self.node_bounds[node_index]
+                limit = np.minimum(t_hit[rays], max_distance[rays])
+                rays = rays[box_hits(bounds[:3], bounds[3:], origins[rays], inverse[rays], limit)]
+                if not len(rays):
+                    continue
+
+                leaf = self.node_leaf[node_index]
+                if leaf is None:
+                    left, right, axis = self.node_children[node_index]
+                    if directions[rays, axis].sum() < 0:
+                        stack.append((left, rays))
+                        stack.append((right, rays))
+                    else:
+                        stack.append((right, rays))
+                        stack.append((left, rays))
+                    continue
+
+                (s_start, s_end), (t_start, t_end), (m_start, m_end), (i_start, i_end), (a_start, a_end) = leaf
+                if stats is not None:
+                    self.count_leaf_tests(stats, leaf, len(rays))
+                if s_end > s_start:
+                    t = intersect_spheres(origins[rays], directions[rays],
+                                          self.sphere_centers[s_start:s_end], self.sphere_radii[s_start:s_end])
+                    best_t, column = closest_hits(t, self.sphere_keys[s_start:s_end])
+                    self._update(rays, best_t, self.sphere_keys[s_start + column], KIND_SPHERE, s_start + column, state)
+                if t_end > t_start:
+                    t = intersect_triangles(origins[rays], directions[rays], self.triangle_v0[t_start:t_end],
+                                            self.triangle_edge1[t_start:t_end], self.triangle_edge2[t_start:t_end])
+                    best_t, column = closest_hits(t, self.triangle_keys[t_start:t_end])
+                    self._update(rays, best_t, self.triangle_keys[t_start + column], KIND_TRIANGLE, t_start + column, state)
+                for slot in range(m_start, m_end):
+                    # Inclusive limit so an equal-distance face can still win the key comparison
+                    limit = np.minimum(np.nextafter(t_hit[rays], INF), max_distance[rays])
+                    best_t, face = self.meshes[slot].intersect_batch(origins[rays], directions[rays], limit)
+                    face = np.maximum(face, 0)
+                    self._update(rays, best_t, hit_key(self.mesh_objects[slot], face), KIND_MESH,
+                                 self.mesh_offsets[slot] + face, state)
+                for slot in range(i_start, i_end):
+                    limit = np.minimum(np.nextafter(t_hit[rays], INF), max_distance[rays])
+                    best_t, face = self.instances[slot].intersect_batch(origins[rays], directions[rays], limit)
+                    face = np.maximum(face, 0)
+                    self._update(rays, best_t, hit_key(self.instance_objects[slot], face), KIND_INSTANCE,
+                                 (slot << INSTANCE_SHIFT) | face, state)
+                for slot in range(a_start, a_end):
+                    self._update_analytic(slot, rays, origins, directions, state)
+
+        for slot in range(self.unbounded_start, len(self.analytic)):
+            if stats is not None:
+                stats.count_batch(type(self.analytic[slot]).__name__, count)
+            self._update_analytic(slot, np.arange(count), origins, directions, state)
+
+        for other_index, (object_index, obj) in enumerate(self.others):
+            if stats is not None:
+                stats.count_batch(type(obj).__name__, count)
+            for i in range(count):
+                t = obj.intersects(Vector(*origins[i]), Vector(*directions[i]))
+                if t and t < max_distance[i] and (t < t_hit[i] or (t == t_hit[i] and hit_key(object_index) < key[i])):
+                    t_hit[i] = t
+                    kind[i] = KIND_OTHER
+                    prim[i] = other_index
+                    key[i] = hit_key(object_index)
+
+        return t_hit, kind, prim
+
+    def count_leaf_tests(self, stats, leaf, count):
+        # Every ray that reaches a leaf is tested against each primitive in it
+        (s_start, s_end), (t_start, t_end), (m_start, m_end), (i_start, i_end), (a_start, a_end) = leaf
+        stats.count_batch('EnhancedSphere', (s_end - s_start) * count)
+        stats.count_batch('EnhancedTriangle', (t_end - t_start) * count)
+        stats.count_batch('TriangleMesh', (m_end - m_start) * count)
+        stats.count_batch('MeshInstance', (i_end - i_start) * count)
+        for slot in range(a_start, a_end):
+            stats.count_batch(type(self.analytic[slot]).__name__, count)
+
+    def _update_analytic(self, slot, rays, origins, directions, state):
+        best_t = self.analytic[slot].intersect_rays(origins[rays], directions[rays])
+        self._update(rays, best_t, np.full(len(rays), hit_key(self.analytic_objects[slot]), dtype=np.int64), KIND_ANALYTIC,
+                     np.full(len(rays), slot, dtype=np.int64), state)
+
+    @staticmethod
+    def _update(rays, best_t, best_key, prim_kind, best_prim, state):
+        # Equal distances resolve to the earlier scene object, matching Ray.cast_ray
+        t_hit, kind, prim, key, max_distance = state
+        current = t_hit[rays]
+        closer = (best_t < max_distance[rays]) & ((best_t < current) | ((best_t == current) & (best_key < key[rays])))
+        rays = rays[closer]
+        t_hit[rays] = best_t[closer]
+        kind[rays] = prim_kind
+        prim[rays] = best_prim[closer]
+        key[rays] = best_key[closer]
+
+    def hit_materials(self, kind, prim):
+        material = np.full(len(kind), -1, dtype=np.int64)
+        for prim_kind, table in ((KIND_SPHERE, self.sphere_materials),
+                                 (KIND_TRIANGLE, self.triangle_materials),
+                                 (KIND_MESH, self.mesh_materials),
+                                 (KIND_ANALYTIC, self.analytic_materials),
+                                 (KIND_OTHER, self.other_materials)):
+            mask = kind == prim_kind
+            material[mask] = table[prim[mask]]
+        for slot, faces, hits in self._instance_hits(kind, prim):
+            material[hits] = self.instance_materials[slot][faces]
+        return material
+
+    def hit_objects(self, kind, prim):
+        # Index of the scene object each hit belongs to, -1 for misses
+        objects = np.full(len(kind), -1, dtype=np.int64)
+        for prim_kind, table in ((KIND_SPHERE, self.sphere_objects),
+                                 (KIND_TRIANGLE, self.triangle_objects),
+                                 (KIND_ANALYTIC, self.analytic_objects),
+                                 (KIND_OTHER, self.other_objects)):
+            mask = kind == prim_kind
+            objects[mask] = np.array(table, dtype=np.int64)[prim[mask]]
+        mask = kind == KIND_MESH
+        slots = np.searchsorted(self.mesh_offsets, prim[mask], side='right') - 1
+        objects[mask] = np.array(self.mesh_objects, dtype=np.int64)[slots]
+        mask = kind == KIND_INSTANCE
+        objects[mask] = np.array(self.instance_objects, dtype=np.int64)[prim[mask] >> INSTANCE_SHIFT]
+        return objects
+
+    def _instance_hits(self, kind, prim):
+        hits = np.nonzero(kind == KIND_INSTANCE)[0]
+        slots = prim[hits] >> INSTANCE_SHIFT
+        for slot in np.unique(slots).tolist():
+            group = hits[slots == slot]
+            yield slot, prim[group] & ((1 << INSTANCE_SHIFT) - 1), group
+
+    def hit_normals(self, points, kind, prim):
+        normals = np.zeros_like(points)
+        mask = kind == KIND_SPHERE
+        normals[mask] = normalize(points[mask] - self.sphere_centers[prim[mask]])
+        mask = kind == KIND_TRIANGLE
+        normals[mask] = self.triangle_normals[prim[mask]]
+        mask = kind == KIND_MESH
+        normals[mask] = self.mesh_normals[prim[mask]]
+        for slot, faces, hits in self._instance_hits(kind, prim):
+            instance = self.instances[slot]
+            normals[hits] = instance.transform.normals_to_world(instance.mesh.normals[faces])
+        mask = kind == KIND_ANALYTIC
+        for slot in np.unique(prim[mask]).tolist():
+            hits = np.nonzero(mask & (prim == slot))[0]
+            normals[hits] = self.analytic[slot].normals_at(points[hits])
+        for i in np.nonzero(kind == KIND_OTHER)[0]:
+            n = self.others[prim[i]][1].get_normal(Vector(*points[i]))
+            normals[i] = (n.x, n.y, n.z)
+        return normals
+
+
+class WavefrontTracer:
+    def __init__(self, renderer, scene):
+        self.renderer = renderer
+        self.scene = scene
+        self.background = np.array(renderer.background_color, dtype=np.float64)
+
+    def camera_rays(self, xs, ys):
+        return self.primary_rays(*self.sample_positions(xs, ys))
+
+    def sample_positions(self, xs, ys):
+        renderer = self.renderer
+        spp = renderer.samples_per_pixel
+        count = len(xs)
+        xs = np.repeat(np.asarray(xs, dtype=np.float64), spp)
+        ys = np.repeat(np.asarray(ys, dtype=np.float64), spp)
+
+        if spp > 4:
+            xs = xs + np.random.random(len(xs))
+            ys = ys + np.random.random(len(ys))
+        elif spp > 1:
+            s = np.tile(np.arange(spp), count)
+            xs = xs + (s % 2) * 0.5
+            ys = ys + (s // 2) * 0.5
+
+        return xs, ys
+
+    def primary_rays(self, xs, ys):
+        renderer = self.renderer
+        count = len(xs)
+        if renderer.stats is not None:
+            renderer.stats.rays['primary'] += count
+        if renderer.use_advanced_camera:
+            camera = renderer.camera
+            ndc_x = (2.0 * xs / renderer.width - 1.0) * camera.aspect_ratio
+            ndc_y = 1.0 - 2.0 * ys / renderer.height
+            forward = np.array((camera.forward.x, camera.forward.y, camera.forward.z)) * camera.image_distance
+            right = np.array((camera.right.x, camera.right.y, camera.right.z))
+            up = np.array((camera.true_up.x, camera.true_up.y, camera.true_up.z))
+            directions = normalize(forward[None, :] + right[None, :] * ndc_x[:, None] + up[None, :] * ndc_y[:, None])
+            position = camera.position
+            origins = np.tile((position.x, position.y, position.z), (count, 1)).astype(np.float64)
+        else:
+            origins = np.stack((xs - renderer.width / 2, ys - renderer.height / 2, np.full(count, -500.0)), axis=1)
+            directions = np.tile((0.0, 0.0, 1.0), (count, 1))
+
+        return origins, directions
+
+    def render_tile(self, x0, y0, width, height):
+        ys, xs = np.mgrid[y0:y0 + height, x0:x0 + width]
+        return self.render_pixels(xs.ravel(), ys.ravel()).reshape(height, width, 3)
+
+    def render_pixels(self, xs, ys):
+        # (N,) pixel coordinates -> (N, 3) uint8 colors
+        if self.renderer.adaptive_sampling:
+            return self.render_pixels_adaptive(xs, ys)
+        spp = self.renderer.samples_per_pixel
+        origins, directions = self.camera_rays(xs, ys)
+        samples = self.trace(origins, directions).astype(np.int64)
+        pixels = samples.reshape(-1, spp, 3).sum(axis=1) // spp
+        return pixels.astype(np.uint8)
+
+    def render_pixels_adaptive(self, xs, ys):
+        # Every pixel that is still noisy holds the same sample count, so each round doubles
+        # it for the whole remaining set in one wave, like compute_pixel_adaptive
+        renderer = self.renderer
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        pixel_count = len(xs)
+        totals = np.zeros((pixel_count, 3), dtype=np.int64)
+        squares = np.zeros((pixel_count, 3), dtype=np.int64)
+        counts = np.zeros(pixel_count, dtype=np.int64)
+        active = np.arange(pixel_count)
+        count = 0
+        batch = max(1, min(renderer.min_samples, renderer.max_samples))
+
+        while len(active):
+            pixels = np.repeat(active, batch)
+            s = np.tile(np.arange(count, count + batch), len(active))
+            strata = s < 4
+            dx = np.where(strata, (s % 2 + np.random.random(len(s))) * 0.5, np.random.random(len(s)))
+            dy = np.where(strata, (s // 2 + np.random.random(len(s))) * 0.5, np.random.random(len(s)))
+
+            colors = self.trace(*self.primary_rays(xs[pixels] + dx, ys[pixels] + dy)).astype(np.int64)
+            colors = colors.reshape(len(active), batch, 3)
+            totals[active] += colors.sum(axis=1)
+            squares[active] += (colors * colors).sum(axis=1)
+            count += batch
+            counts[active] = count
+
+            if count >= renderer.max_samples:
+                break
+            if count > 1:
+                variance = (squares[active] - totals[active] * totals[active] / count) / (count - 1)
+                error = np.sqrt(np.maximum(variance.max(axis=1), 0.0) / count)
+                active = active[error > renderer.noise_threshold]
+            batch = min(renderer.max_samples, count * 2) - count
+
+        return (totals // counts[:, None]).astype(np.uint8)
+
+    def gbuffer_samples(self, xs, ys, material_index):
+        # Primary hits of every camera sample of the given pixels; see gbuffer.GBuffer
+        scene = self.scene
+        sample_x, sample_y = self.sample_positions(xs, ys)
+        origins, directions = self.primary_rays(sample_x, sample_y)
+        t, kind, prim = scene.intersect(origins, directions, INF)
+        hit = np.nonzero(kind != KIND_NONE)[0]
+
+        points = np.zeros_like(origins)
+        normals = np.zeros_like(origins)
+        points[hit] = origins[hit] + directions[hit] * t[hit][:, None]
+        normals[hit] = scene.hit_normals(points[hit], kind[hit], prim[hit])
+        table = np.array([material_index.get(id(m), -1) for m in scene.materials] + [-1], dtype=np.int32)
+        return {
+            'sample_x': sample_x,
+            'sample_y': sample_y,
+            'point': points,
+            'normal': normals,
+            'material': table[scene.resolve_materials(scene.hit_materials(kind, prim), points, normals)],
+            'object': scene.hit_objects(kind, prim).astype(np.int32),
+        }
+
+    def relight_samples(self, samples, materials, terms):
+        # Opaque diffuse hits only need their direct lighting again, from the stored
+        # per-light terms where the light has not moved; reflective and transparent
+        # hits are traced from the camera as usual. Returns the colors and the terms.
+        colors = np.tile(self.background, (len(samples['material']), 1))
+        material = samples['material']
+        diffuse, retrace = split_samples(material, materials)
+        points, normals = samples['point'][diffuse], samples['normal'][diffuse]
+        light_intensity = 1.0 - self.renderer.ambient_factor
+        lit = np.zeros(len(diffuse))
+        terms = list(terms)
+
+        for i, (light, intensity) in enumerate(self.lights()):
+            if terms[i] is None:
+                terms[i] = empty_terms(len(material))
+                terms[i][0][diffuse], terms[i][1][diffuse] = self.light_terms(light, points, normals)
+            lit += terms[i][0][diffuse] * light_intensity * intensity * terms[i][1][diffuse]
+
+        if len(diffuse):
+            brightness = np.full(len(diffuse), self.renderer.ambient_factor)
+            brightness += lit
+            color = np.array([m.color for m in materials], dtype=np.float64).reshape(-1, 3)
+            colors[diffuse] = np.minimum(255, np.floor(color[material[diffuse]] * brightness[:, None]))
+        if len(retrace):
+            colors[retrace] = self.trace(*self.primary_rays(samples['sample_x'][retrace], samples['sample_y'][retrace]))
+        return colors, terms
+
+    def trace(self, origins, directions):
+        # Each wave holds every ray of one recursion depth. Hits record where their
+        # reflection and refraction children landed in the next wave so colors can be
+        # resolved bottom-up with the same per-level rounding as trace_ray.
+        renderer = self.renderer
+        waves = []
+        weights = np.ones(len(origins))
+        depth = 0
+        while True:
+            wave = {'colors': np.tile(self.background, (len(origins), 1))}
+            waves.append(wave)
+            if not len(origins) or depth >= renderer.max_depth:
+                break
+            if renderer.stats is not None:
+                renderer.stats.reach(depth)
+
+            t, kind, prim = self.scene.intersect(origins, directions, INF)
+            hit = np.nonzero(kind != KIND_NONE)[0]
+            wave['hit'] = hit
+            origins, directions, weights = self.shade(origins[hit], directions[hit], t[hit], kind[hit], prim[hit],
+                                                      weights[hit], depth, wave)
+            depth += 1
+
+        for level in range(len(waves) - 2, -1, -1):
+            wave = waves[level]
+            child_colors = np.vstack((waves[level + 1]['colors'], self.background))
+            reflection_color = child_colors[wave['reflect_child']]
+            refraction_color = child_colors[wave['refract_child']]
+            color = (wave['local'] * wave['direct'][:, None] +
+                     reflection_color * wave['reflect'][:, None] +
+                     refraction_color * wave['refract'][:, None])
+            wave['colors'][wave['hit']] = np.minimum(255, np.floor(color))
+
+        return waves[0]['colors']
+
+    def shade(self, origins, directions, t, kind, prim, weights, depth, wave):
+        scene = self.scene
+        points = origins + directions * t[:, None]
+        normals = scene.hit_normals(points, kind, prim)
+        material = scene.resolve_materials(scene.hit_materials(kind, prim), points, normals)
+
+        brightness = np.full(len(points), self.renderer.ambient_factor)
+        brightness += self.direct_lighting(points, normals)
+        local = np.floor(scene.material_colors[material] * brightness[:, None])
+
+        reflectivity = scene.material_reflectivity[material]
+        transparency = scene.material_transparency[material]
+        ior = scene.material_ior[material]
+
+        transparent = transparency > 0
+        entering = dot(directions, normals) < 0
+        n1 = np.where(entering, 1.0, ior)
+        n2 = np.where(entering, ior, 1.0)
+        fresnel = self.fresnel(directions, normals, n1, n2)
+
+        reflection_contribution = np.where(transparent, reflectivity * (1 - transparency) + transparency * fresnel, reflectivity)
+        refraction_contribution = np.where(transparent, transparency * (1.0 - fresnel), 0.0)
+        total = reflection_contribution + refraction_contribution
+        scale = np.where(total > 1.0, total, 1.0)
+        reflection_contribution = reflection_contribution / scale
+        refraction_contribution = refraction_contribution / scale
+
+        wave['local'] = local
+        wave['direct'] = np.maximum(0.0, 1.0 - reflection_contribution - refraction_contribution)
+
+        reflective = reflectivity > 0
+        refractive = transparency > 0
+        if self.renderer.branch_sampling:
+            both = np.nonzero(reflective & refractive)[0]
+            total = reflection_contribution[both] + refraction_contribution[both]
+            pick = np.random.random(len(both)) * total < reflection_contribution[both]
+            reflection_contribution[both] = np.where(pick, total, 0.0)
+            refraction_contribution[both] = np.where(pick, 0.0, total)
+            reflective[both[~pick]] = False
+            refractive[both[pick]] = False
+
+        reflection_contribution, reflective = self.prune_branches(reflection_contribution, reflective, weights, depth)
+        refraction_contribution, refractive = self.prune_branches(refraction_contribution, refractive, weights, depth)
+        wave['reflect'] = reflection_contribution
+        wave['refract'] = refraction_contribution
+
+        # Rays that are not spawned see the background, stored one past the end of the next wave
+        reflective = np.nonzero(reflective)[0]
+        refractive = np.nonzero(refractive)[0]
+        stats = self.renderer.stats
+        if stats is not None:
+            stats.rays['reflection'] += len(reflective)
+            stats.rays['refraction'] += len(refractive)
+        next_count = len(reflective) + len(refractive)
+        wave['reflect_child'] = np.full(len(points), next_count, dtype=np.int64)
+        wave['reflect_child'][reflective] = np.arange(len(reflective))
+        wave['refract_child'] = np.full(len(points), next_count, dtype=np.int64)
+        wave['refract_child'][refractive] = np.arange(len(refractive)) + len(reflective)
+
+        reflect_dirs = self.reflect(directions[reflective], normals[reflective])
+        reflect_origins = points[reflective] + normals[reflective] * 0.01
+
+        refract_dirs = self.refract(directions[refractive], normals[refractive], n1[refractive], n2[refractive])
+        refract_origins = points[refractive] + refract_dirs * 0.01
+
+        return (np.concatenate((reflect_origins, refract_origins)),
+                np.concatenate((reflect_dirs, refract_dirs)),
+                np.concatenate((weights[reflective] * reflection_contribution[reflective],
+                                weights[refractive] * refraction_contribution[refractive])))
+
+    def prune_branches(self, contribution, spawn, weights, depth):
+        # Renderer.trace_ray's min_contribution cut and roulette for one kind of child ray of
+        # every hit at this depth; returns the rescaled contributions and which rays to spawn
+        renderer = self.renderer
+        share = weights * contribution
+        spawn = spawn & (share >= renderer.min_contribution)
+        if renderer.roulette_depth and depth + 1 >= renderer.roulette_depth:
+            contested = spawn & (share < 1.0)
+            lost = contested & (np.random.random(len(share)) >= share)
+            survived = contested & ~lost
+            contribution = np.divide(contribution, share, out=contribution.copy(), where=survived)
+            contribution[lost] = 0.0
+            spawn = spawn & ~lost
+        return contribution, spawn
+
+    def lights(self):
+        return self.renderer.active_lights()
+
+    def direct_lighting(self, points, normals):
+        renderer = self.renderer
+        if renderer.light_samples and len(renderer.lights) > renderer.light_samples:
+            return self.sampled_lighting(points, normals)
+        
+        light_intensity = 1.0 - self.renderer.ambient_factor
+        brightness = np.zeros(len(points))
+
+        for light, intensity in self.lights():
+            diffuse, transmittance = self.light_terms(light, points, normals)
+            brightness += diffuse * light_intensity * intensity * transmittance
+
+        return brightness
+
+    def sampled_lighting(self, points, normals):
+        # Renderer.sampled_brightness without the ambient term; the picks of all points and
+        # strata that landed on the same light share one batch of shadow rays
+        renderer = self.renderer
+        count = renderer.light_samples
+        rays = [self.light_rays(light, points) for light in renderer.lights]
+        weights = np.stack([np.maximum(0, dot(normals, light_dirs)) * light.intensity
+                            for light, (light_dirs, _) in zip(renderer.lights, rays)], axis=1)
+        cumulative = np.cumsum(weights, axis=1)
+        total = cumulative[:, -1]
+
+        lit = np.nonzero(total > 0)[0]
+        strata = (np.arange(count)[None, :] + np.random.random((len(lit), count))) / count * total[lit, None]
+        picks = np.minimum((cumulative[lit, None, :] <= strata[:, :, None]).sum(axis=2), len(renderer.lights) - 1)
+        origins = points + normals * 0.001
+        visibility = np.zeros(len(points))
+        for i in np.unique(picks).tolist():
+            group = lit[np.nonzero(picks == i)[0]]
+            light_dirs, distances = rays[i]
+            np.add.at(visibility, group, self.shadow_transmittance(origins[group], light_dirs[group], distances[group] - 0.001))
+        return total * (1.0 - renderer.ambient_factor) * visibility / count
+
+    def light_rays(self, light, points):
+        # Unit directions towards the light and the distance to it for every point
+        if isinstance(light, PointLight):
+            position = np.array((light.position.x, light.position.y, light.position.z))
+            to_light = position[None, :] - points
+            light_dirs = normalize(to_light)
+            distances = np.sqrt(dot(to_light, to_light))
+        elif isinstance(light, DirectionalLight):
+            light_dirs = np.tile((light.direction.x, light.direction.y, light.direction.z), (len(points), 1)).astype(np.float64)
+            distances = np.full(len(points), INF)
+        else:
+            light_dirs = np.empty_like(points)
+            distances = np.empty(len(points))
+            for i, p in enumerate(points):
+                d = light.get_direction(Vector(*p))
+                light_dirs[i] = (d.x, d.y, d.z)
+                distances[i] = light.get_distance(Vector(*p))
+        return light_dirs, distances
+
+    def light_terms(self, light, points, normals):
+        # The parts of one light's contribution that do not depend on its intensity
+        light_dirs, distances = self.light_rays(light, points)
+        transmittance = self.shadow_transmittance(points + normals * 0.001, light_dirs, distances - 0.001)
+        return np.maximum(0, dot(normals, light_dirs)), transmittance
+
+    def shadow_transmittance(self, origins, directions, max_distance):
+        # Same rules as Ray.transmittance: an opaque occluder blocks the light, transparent ones
+        # multiply along the segment and anything under 1% counts as fully blocked. Batches step
+        # 0.001 past each transparent hit and keep measuring the distance left to the light.
+        scene = self.scene
+        if self.renderer.stats is not None:
+            self.renderer.stats.rays['shadow'] += len(origins)
+        transmittance = np.ones(len(origins))
+        active = np.arange(len(origins))
+        current = origins.copy()
+        remaining = np.array(max_distance, dtype=np.float64)
+
+        while len(active):
+            t, kind, prim = scene.intersect(current[active], directions[active], remaining[active])
+            hit = kind != KIND_NONE
+            active, t, kind, prim = active[hit], t[hit], kind[hit], prim[hit]
+
+            material = scene.hit_materials(kind, prim)
+            occluder = np.where(material >= 0, scene.material_transparency[np.maximum(material, 0)], 0.0)
+            transmittance[active] *= occluder
+            transmittance[active[transmittance[active] < 0.01]] = 0.0
+
+            keep = transmittance[active] > 0
+            active, t = active[keep], t[keep]
+            current[active] += directions[active] * t[:, None]
+            current[active] += directions[active] * 0.001
+            remaining[active] -= t + 0.001
+
+        return transmittance
+
+    @staticmethod
+    def reflect(directions, normals):
+        return directions - normals * (2 * dot(directions, normals))[:, None]
+
+    @staticmethod
+    def _orient(directions, normals, n1, n2):
+        flip = dot(directions, normals) > 0
+        normals = np.where(flip[:, None], -normals, normals)
+        return normals, np.where(flip, n2, n1), np.where(flip, n1, n2)
+
+    def refract(self, directions, normals, n1, n2):
+        normals, n1, n2 = self._orient(directions, normals, n1, n2)
+        ratio = n1 / n2
+        cos_i = -dot(directions, normals)
+        sin2_t = ratio * ratio * (1 - cos_i * cos_i)
+        total_reflection = sin2_t > 1
+        cos_t = np.sqrt(np.where(total_reflection, 0.0, 1 - sin2_t))
+        refracted = directions * ratio[:, None] + normals * (ratio * cos_i - cos_t)[:, None]
+        return np.where(total_reflection[:, None], self.reflect(directions, normals), refracted)
+
+    def fresnel(self, directions, normals, n1, n2):
+        normals, n1, n2 = self._orient(directions, normals, n1, n2)
+        cos_i = -dot(directions, normals)
+        sin2_t = (n1 / n2) ** 2 * (1 - cos_i ** 2)
+        total_reflection = sin2_t > 1
+        cos_t = np.sqrt(np.where(total_reflection, 0.0, 1 - sin2_t))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = ((n1 * cos_i) - (n2 * cos_t)) / ((n1 * cos_i) + (n2 * cos_t))
+            rp = ((n1 * cos_t) - (n2 * cos_i)) / ((n1 * cos_t) + (n2 * cos_i))
+        return np.where(total_reflection, 1.0, (rs * rs + rp * rp) / 2)